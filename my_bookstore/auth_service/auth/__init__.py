@@ -2,12 +2,22 @@ from flask import Flask
 from flask_bcrypt import Bcrypt
 from flask_marshmallow import Marshmallow
 from flask_sqlalchemy import SQLAlchemy
+from service_common.metrics import Metrics
+from service_common.pooling import init_pooling, pool_stats
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from .config import Config
+from .hashing import PasswordHasher
+from .throttle import LoginThrottle
+from .cache import UserCache
 
 db = SQLAlchemy()
 ma = Marshmallow()
 bcrypt = Bcrypt()
+password_hasher = PasswordHasher(bcrypt)
+login_throttle = LoginThrottle()
+user_cache = UserCache()
+metrics = Metrics('auth')
 
 
 def create_app(config=Config) -> Flask:
@@ -19,15 +29,31 @@ def create_app(config=Config) -> Flask:
     app = Flask(__name__)
     app.config.from_object(config)
 
+    # First, so that it measures as much of each request as possible
+    metrics.init_app(app)
+    init_pooling(app)  # Before initializing SQLAlchemy
     db.init_app(app)
     ma.init_app(app)  # Order matters: Initialize SQLAlchemy before Marshmallow
     bcrypt.init_app(app)
+    password_hasher.init_app(app)
+    login_throttle.init_app(app)
+    user_cache.init_app(app)
+    metrics.collect('password_hasher', password_hasher.stats)
+    metrics.collect('login_throttle', login_throttle.stats)
+    metrics.collect('user_cache', user_cache.stats)
+    metrics.collect('db_pool', lambda: pool_stats(db, app))
+
+    # The source IP of the authentication attempts is forwarded by the calling
+    # service in "X-Forwarded-For".
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
 
     # Implementation with extension:
     from .api import api_bp
     app.register_blueprint(api_bp)
 
-    # Create and initialize the database
-    db.create_all(app=app)
+    # The database is created and upgraded by "flask migrate", once per
+    # deployment, rather than by every worker process.
+    from .migrations import migrate_command
+    app.cli.add_command(migrate_command)
 
     return app
@@ -12,7 +12,16 @@ from .resources.auth import AccessToken, UserAuth, UserList
 # Create an API-related blueprint
 api_bp = Blueprint(name='api', import_name=__name__)
 
-api = Api(api_bp)
+# The requests which cannot get a database connection within the pool timeout
+# (sqlalchemy.exc.TimeoutError) are told to retry later.
+errors = {
+    'TimeoutError': {
+        'message': 'The database is busy. Please retry later.',
+        'status': 503
+    }
+}
+
+api = Api(api_bp, errors=errors)
 api.add_resource(UserList, '/users')
 api.add_resource(UserAuth, '/user-auth')
 api.add_resource(AccessToken, '/access-token')
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Caching-related module.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from flask import Flask
+
+
+class CachedUser(NamedTuple):
+    """
+    Cached user, with the fields needed to authenticate it and to issue its
+    access tokens.
+    """
+    id: int
+    username: str
+    password: str  # Password hash
+
+
+class UserCache:
+    """
+    Bounded, in-process LRU cache of the users by username, so that the
+    repeated authentications and access token requests of the same users don't
+    query the database.
+    The entries are invalidated when the users are created or updated in the
+    same worker process, and expire after a TTL, which bounds how long the
+    other worker processes may serve a stale entry.
+    """
+
+    def __init__(self, app: Optional[Flask]=None):
+        """
+        Constructor with parameters.
+        :param app: Flask
+        """
+        self.enabled = False
+        self.maxsize = 10000
+        self.ttl = 300
+        self._entries = OrderedDict()  # username -> (expires_at, CachedUser)
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """
+        Initializes the cache with the given application's configurations.
+        :param app: Flask
+        :return: None
+        """
+        self.enabled = app.config['USER_CACHE_ENABLED']
+        self.maxsize = app.config['USER_CACHE_SIZE']
+        self.ttl = app.config['USER_CACHE_TTL']
+        self.clear()
+
+    def get(self, username: str) -> Optional[CachedUser]:
+        """
+        Gets the cached user with the given username.
+        :param username: str
+        :return: CachedUser or None
+        """
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[0] <= now:
+                if entry is not None:  # Expired
+                    del self._entries[username]
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(username)
+            self._counters['hits'] += 1
+            return entry[1]
+
+    def set(self, user: CachedUser) -> None:
+        """
+        Caches the given user, evicting the least recently used one if the
+        cache is full.
+        :param user: CachedUser
+        :return: None
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[user.username] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(user.username)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str) -> None:
+        """
+        Removes the user with the given username from the cache, if present.
+        :param username: str
+        :return: None
+        """
+        with self._lock:
+            self._entries.pop(username, None)
+            self._counters['invalidations'] += 1
+
+    def clear(self) -> None:
+        """
+        Removes all the users.
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss/invalidation counters and the current size of the
+        cache.
+        :return: dict
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['size'] = len(self._entries)
+        stats['maxsize'] = self.maxsize
+        return stats
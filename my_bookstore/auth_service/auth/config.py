@@ -14,11 +14,72 @@ class Config:
 
     # Generate the secret key using secrets.token_hex(16)
     SECRET_KEY = os.environ['FLASK_SECRET_KEY']
+    # Key to sign the access tokens with, which is shared with bookstore_service
+    # so that it can verify the access tokens locally
+    ACCESS_TOKEN_SECRET_KEY = os.environ.get(
+        'ACCESS_TOKEN_SECRET_KEY', SECRET_KEY
+    )
+
+    # Cost factor of the password hashes (also used by Flask-Bcrypt). The hashes
+    # made with another cost factor are rehashed on the next successful login.
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    # Native threads hashing the passwords in each worker, off the gevent event
+    # loop, and max number of pending hashes per worker before rejecting the
+    # requests with 503
+    PASSWORD_HASH_THREADS = 2
+    PASSWORD_HASH_MAX_PENDING = 64
+
+    # Configure the throttling of failed authentication attempts: each failed
+    # attempt takes a token from the bucket of its username (or token) and from
+    # the bucket of its source IP, and the attempts are rejected with 429 while
+    # either bucket is empty. The buckets refill at the given rates (per
+    # second) up to the given bursts.
+    # Without a Redis URL, the state is kept in each worker process.
+    LOGIN_THROTTLE_ENABLED = True
+    LOGIN_THROTTLE_REDIS_URL = os.environ.get('LOGIN_THROTTLE_REDIS_URL')
+    LOGIN_THROTTLE_USERNAME_RATE = 0.1
+    LOGIN_THROTTLE_USERNAME_BURST = 10
+    LOGIN_THROTTLE_IP_RATE = 1
+    LOGIN_THROTTLE_IP_BURST = 50
+    # How long failed credentials are rejected again without being evaluated
+    LOGIN_THROTTLE_FAILURE_TTL = 60  # In seconds
+    LOGIN_THROTTLE_MAX_KEYS = 100000  # Per worker process, without Redis
+
+    # Configure the in-process cache of the users (ID and password hash) by
+    # username, per worker process. The entries are invalidated by the changes
+    # made in the same worker, and expire after the TTL otherwise.
+    USER_CACHE_ENABLED = True
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 300  # In seconds
 
     # Configure the SQLAlchemy-related options
     postgres_user = os.environ['POSTGRES_USER']
     postgres_password = os.environ['POSTGRES_PASSWORD']
-    postgres_hostname = 'db'
+    postgres_hostname = os.environ.get('POSTGRES_HOSTNAME', 'db')
     postgres_db = 'bookstore'
     SQLALCHEMY_DATABASE_URI = f'postgres://{postgres_user}:{postgres_password}@{postgres_hostname}/{postgres_db}'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Configure the connection pool of each worker. With gevent workers, many
+    # more requests than connections are in flight, and the ones that don't
+    # get a connection within the pool timeout fail with 503.
+    # Mind that the pools of all the workers (of both services) must fit in
+    # the max connections of the database.
+    # In gevent mode, psycopg2 waits for the database cooperatively.
+    DB_GEVENT_MODE = True
+    DB_POOL_SIZE = 5
+    DB_MAX_OVERFLOW = 5
+    DB_POOL_TIMEOUT = 5  # In seconds
+    DB_POOL_PRE_PING = True  # Detect the connections closed by the server
+    DB_POOL_RECYCLE = 1800  # Close the connections older than this (seconds)
+    # When connecting to PgBouncer in transaction pooling mode (with
+    # POSTGRES_HOSTNAME pointing to it), let PgBouncer do the pooling.
+    DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', '').lower() == 'true'
+
+    # Configure the metrics, which are served in Prometheus text format at
+    # "/metrics" (not exposed through nginx). Each worker process flushes its
+    # metrics to a file in the metrics directory every flush interval, and the
+    # files of all the workers are aggregated when serving them.
+    METRICS_ENABLED = True
+    METRICS_DIR = os.environ.get('METRICS_DIR')  # A temporary one if not set
+    METRICS_FLUSH_INTERVAL = 5  # In seconds
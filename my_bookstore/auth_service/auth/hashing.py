@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""
+Password hashing module.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, Tuple
+
+from flask import Flask, abort
+from flask_bcrypt import Bcrypt
+
+
+class PasswordHasher:
+    """
+    Password hasher, which runs the bcrypt hashing and verification in a
+    bounded pool of native threads.
+    bcrypt is CPU-bound C code that never yields to the gevent event loop, so
+    running it in a greenlet would freeze all the other greenlets of the worker
+    for the whole hash. The native threads release the GIL while hashing, so
+    the event loop keeps serving the other requests meanwhile.
+    When too many hashes are pending, the requests are rejected with 503 rather
+    than queued up indefinitely.
+    """
+
+    def __init__(self, bcrypt: Bcrypt, app: Optional[Flask]=None):
+        """
+        Constructor with parameters.
+        :param bcrypt: Bcrypt
+        :param app: Flask
+        """
+        self._bcrypt = bcrypt
+        self.log_rounds = 12
+        self._threads = 2
+        self._max_pending = 64
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._counters = {
+            'hashes': 0,
+            'rejections': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+            'exec_seconds_total': 0.0,
+            'exec_seconds_max': 0.0
+        }
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """
+        Initializes the hasher with the given application's configurations.
+        :param app: Flask
+        :return: None
+        """
+        self.log_rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self._threads = app.config['PASSWORD_HASH_THREADS']
+        self._max_pending = app.config['PASSWORD_HASH_MAX_PENDING']
+        self._pool = None
+
+    def generate(self, password: str) -> str:
+        """
+        Hashes the given password, with the configured cost factor.
+        :param password: str
+        :return: str
+        """
+        password_hash = self._run(self._bcrypt.generate_password_hash, password)
+        return password_hash.decode('utf-8')
+
+    def check(self, password_hash: str, password: str) -> bool:
+        """
+        Checks the given password against the given hash.
+        :param password_hash: str
+        :param password: str
+        :return: bool
+        """
+        return self._run(
+            self._bcrypt.check_password_hash, password_hash, password
+        )
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """
+        Checks whether the given hash was made with a different cost factor than
+        the configured one.
+        :param password_hash: str
+        :return: bool
+        """
+        # bcrypt hashes look like "$2b$<cost>$<salt and checksum>".
+        try:
+            return int(password_hash.split('$')[2]) != self.log_rounds
+        except (IndexError, ValueError):
+            return True
+
+    def stats(self) -> dict:
+        """
+        Returns the queue and timing statistics of the hashes.
+        :return: dict
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['pending'] = self._pending
+        stats['threads'] = self._threads
+        stats['max_pending'] = self._max_pending
+        return stats
+
+    def _run(self, func: Callable, *args):
+        """
+        Private helper method to run the given hashing function in the thread
+        pool, and wait for its result without blocking the event loop.
+        Aborts with 503 if too many hashes are pending.
+        :param func: Callable
+        :param args:
+        :return:
+        """
+        with self._lock:
+            if self._pending >= self._max_pending:
+                self._counters['rejections'] += 1
+                abort(503, description='Too many pending password checks')
+            self._pending += 1
+        try:
+            submitted_at = time.perf_counter()
+            result, started_at, finished_at = self._spawn(
+                _timed_call, func, *args
+            )
+        finally:
+            with self._lock:
+                self._pending -= 1
+        self._record(started_at - submitted_at, finished_at - started_at)
+        return result
+
+    def _record(self, wait: float, execution: float) -> None:
+        """
+        Private helper method to record the time a hash waited in the queue and
+        the time it took.
+        :param wait: float
+        :param execution: float
+        :return: None
+        """
+        with self._lock:
+            counters = self._counters
+            counters['hashes'] += 1
+            counters['wait_seconds_total'] += wait
+            counters['wait_seconds_max'] = max(
+                counters['wait_seconds_max'], wait
+            )
+            counters['exec_seconds_total'] += execution
+            counters['exec_seconds_max'] = max(
+                counters['exec_seconds_max'], execution
+            )
+
+    def _spawn(self, func: Callable, *args):
+        """
+        Private helper method to run the given function in the thread pool of
+        the current process, and wait for its result.
+        Under gevent, the standard library's threads are monkey-patched into
+        greenlets, so gevent's pool of native threads is used instead, whose
+        results are waited for cooperatively.
+        Threads must not be shared across forked worker processes, so the pool
+        is lazily created in each process.
+        :param func: Callable
+        :param args:
+        :return:
+        """
+        pid = os.getpid()
+        if self._pool is None or self._pool_pid != pid:
+            if _gevent_patched():
+                from gevent.threadpool import ThreadPool
+                self._pool = ThreadPool(maxsize=self._threads)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self._threads)
+            self._pool_pid = pid
+        if isinstance(self._pool, ThreadPoolExecutor):
+            return self._pool.submit(func, *args).result()
+        return self._pool.apply(func, args)
+
+
+def _timed_call(func: Callable, *args) -> Tuple[Any, float, float]:
+    """
+    Private helper function to call the given function, and return its result
+    along with the times it started and finished.
+    This runs in a pool thread, so it doesn't touch any shared state.
+    :param func: Callable
+    :param args:
+    :return: tuple(Any, float, float)
+    """
+    started_at = time.perf_counter()
+    result = func(*args)
+    return result, started_at, time.perf_counter()
+
+
+def _gevent_patched() -> bool:
+    """
+    Private helper function to check whether the standard library's threads are
+    monkey-patched by gevent.
+    :return: bool
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+Database migrations module.
+
+The schema is managed by versioned migrations, which are applied once per
+deployment with "flask migrate", rather than by every worker process at
+startup. New migrations are appended with the next version number, and
+applied migrations are never modified.
+"""
+
+from datetime import datetime
+from typing import Callable, List, NamedTuple
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import (
+    Column, DateTime, Integer, MetaData, String, Table, func, select, text
+)
+from sqlalchemy.engine import Connection
+
+from . import db
+
+# Key of the advisory lock, which makes concurrent runs of the migrations wait
+# for each other (PostgreSQL only)
+_LOCK_KEY = 727402
+
+# Versions of the applied migrations, kept out of the models' metadata
+_versions = Table(
+    'auth_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False, default=datetime.utcnow)
+)
+
+# Tables as the migrations that create them left them, rather than the current
+# models, so that the effect of the applied migrations never changes.
+_tables = MetaData()
+_users = Table(
+    'users', _tables,
+    Column('id', Integer, primary_key=True),
+    Column('username', String(120), nullable=False, unique=True, index=True),
+    Column('email', String(50), unique=True),
+    Column('password', String(60), nullable=False)
+)
+
+
+class Migration(NamedTuple):
+    """
+    Versioned migration of the schema (and the data).
+    """
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+
+MIGRATIONS = []
+
+
+def migration(version: int, description: str) -> Callable:
+    """
+    Decorator to register the decorated function as the migration with the
+    given version.
+    :param version: int
+    :param description: str
+    :return: Callable
+    """
+    def decorator(upgrade: Callable[[Connection], None]) -> Callable:
+        assert version == len(MIGRATIONS) + 1, 'Versions must be consecutive'
+        MIGRATIONS.append(Migration(version, description, upgrade))
+        return upgrade
+
+    return decorator
+
+
+@migration(1, 'Create the users table')
+def _create_tables(connection: Connection) -> None:
+    # The databases created before the migrations (by "db.create_all()")
+    # already have it.
+    _users.create(bind=connection, checkfirst=True)
+
+
+def migrate() -> List[Migration]:
+    """
+    Applies the pending migrations in order, each in its own transaction.
+    :return: list[Migration]
+    """
+    applied = []
+    with db.get_engine().connect() as connection:
+        postgresql = connection.dialect.name == 'postgresql'
+        if postgresql:
+            connection.execute(
+                text('SELECT pg_advisory_lock(:key)'), key=_LOCK_KEY
+            )
+        try:
+            _versions.create(bind=connection, checkfirst=True)
+            current = connection.execute(
+                select([func.max(_versions.c.version)])
+            ).scalar() or 0
+            for pending in MIGRATIONS[current:]:
+                with connection.begin():
+                    pending.upgrade(connection)
+                    connection.execute(_versions.insert().values(
+                        version=pending.version,
+                        description=pending.description
+                    ))
+                applied.append(pending)
+        finally:
+            if postgresql:
+                connection.execute(
+                    text('SELECT pg_advisory_unlock(:key)'), key=_LOCK_KEY
+                )
+    return applied
+
+
+@click.command('migrate')
+@with_appcontext
+def migrate_command() -> None:
+    """
+    Applies the pending database migrations.
+    """
+    applied = migrate()
+    for pending in applied:
+        click.echo(f'Applied migration {pending.version}: {pending.description}')
+    if not applied:
+        click.echo('The database is up to date.')
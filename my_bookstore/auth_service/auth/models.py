@@ -4,7 +4,8 @@
 Authentication-related models module.
 """
 
-from typing import Tuple
+import functools
+from typing import Optional, Tuple
 
 from flask import current_app
 from itsdangerous import (
@@ -13,7 +14,8 @@ from itsdangerous import (
 )
 from marshmallow import EXCLUDE, fields, validate
 
-from . import db, ma
+from . import db, ma, user_cache
+from .cache import CachedUser
 
 
 class User(db.Model):
@@ -35,21 +37,66 @@ class User(db.Model):
     password = db.Column(db.String(PASSWORD_MAX_LEN), nullable=False)
 
     @staticmethod
-    def verify_access_token(access_token: str):
+    def lookup(username: str) -> Optional[CachedUser]:
+        """
+        Static method to find the user with the given username, from the user
+        cache if possible.
+        :param username: str
+        :return: CachedUser or None
+        """
+        user = user_cache.get(username)
+        if user is None:
+            row = db.session.query(
+                User.id, User.username, User.password
+            ).filter_by(username=username).first()
+            if row is None:
+                return None
+            user = CachedUser(*row)
+            user_cache.set(user)
+        return user
+
+    @staticmethod
+    def verify_access_token(access_token: str) -> Optional[str]:
         """
         Static method to verify the given access token.
         :param access_token: str
-        :return: User or None
+        :return: str or None
         """
-        serializer = Serializer(secret_key=current_app.config['SECRET_KEY'])
+        serializer = _token_serializer(
+            current_app.config['ACCESS_TOKEN_SECRET_KEY']
+        )
         try:
             data = serializer.loads(access_token)
         except SignatureExpired:  # Valid access token, but expired
             return None
         except BadSignature:  # Invalid access token
             return None
-        found_user = User.query.get(data['id'])
-        return found_user
+        if 'username' in data:  # No need to query the database
+            return data['username']
+        # Access tokens issued before the username was put in the claims
+        return db.session.query(User.username).filter_by(
+            id=data['id']
+        ).scalar()
+
+    @staticmethod
+    def make_access_token(id: int, username: str,
+                          expires_in: int=600) -> Tuple[str, int]:
+        """
+        Static method to generate an access token for the user with the given
+        ID and username, with the given expiration time.
+        :param id: int
+        :param username: str
+        :param expires_in: int
+        :return: tuple(str, int)
+        """
+        serializer = _token_serializer(
+            current_app.config['ACCESS_TOKEN_SECRET_KEY'], expires_in
+        )
+        # The username is carried in the claims, so that the access tokens are
+        # verified without querying the database, and other services sharing
+        # the key can authenticate the user without calling this service.
+        claims = {'id': id, 'username': username}
+        return serializer.dumps(claims).decode('ascii'), expires_in
 
     def gen_access_token(self, expires_in: int=600) -> Tuple[str, int]:
         """
@@ -57,10 +104,21 @@ class User(db.Model):
         :param expires_in: int
         :return: tuple(str, int)
         """
-        serializer = Serializer(
-            secret_key=current_app.config['SECRET_KEY'], expires_in=expires_in
-        )
-        return serializer.dumps({'id': self.id}), expires_in
+        return User.make_access_token(self.id, self.username, expires_in)
+
+
+@functools.lru_cache(maxsize=None)
+def _token_serializer(secret_key: str,
+                      expires_in: Optional[int]=None) -> Serializer:
+    """
+    Private helper function to get the serializer to sign and verify access
+    tokens with the given key and expiration time, which is reused across the
+    requests.
+    :param secret_key: str
+    :param expires_in: int
+    :return: Serializer
+    """
+    return Serializer(secret_key=secret_key, expires_in=expires_in)
 
 
 class UserSchema(ma.Schema):
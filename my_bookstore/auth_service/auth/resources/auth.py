@@ -8,7 +8,7 @@ from flask import request
 from flask_restful import Resource
 from marshmallow import ValidationError
 
-from .. import bcrypt, db
+from .. import db, login_throttle, password_hasher, user_cache
 from ..models import User, user_schema
 
 
@@ -32,7 +32,7 @@ class UserList(Resource):
         email = user_data['email']
         password = user_data['password']
 
-        if User.query.filter_by(username=username).first():
+        if User.lookup(username):
             return {
                 'status': 'error',
                 'message': 'User already exist'
@@ -41,10 +41,11 @@ class UserList(Resource):
         new_user = User(
             username=username,
             email=email,
-            password=bcrypt.generate_password_hash(password).decode('utf-8')
+            password=password_hasher.generate(password)
         )
         db.session.add(new_user)
         db.session.commit()
+        user_cache.invalidate(username)
         return {
             'status': 'success',
             'data': {
@@ -67,23 +68,50 @@ class UserAuth(Resource):
         auth_data = request.json
         username_or_token = auth_data['username_or_token']
         password = auth_data['password']
+        # The source IP is forwarded by the calling service.
+        ip = request.remote_addr
 
-        # Verify as if username_or_token is an access token
-        found_username = None
-        found_user = User.verify_access_token(username_or_token)
-        if found_user:
-            found_username = found_user.username
-        else:
+        # Reject the repeated failed attempts before any database lookup or
+        # password check.
+        retry_after = login_throttle.retry_after(username_or_token, ip)
+        if retry_after is not None:
+            return {
+                'status': 'error',
+                'message': 'Too many failed authentication attempts. '
+                           'Please retry later.'
+            }, 429, {'Retry-After': str(retry_after)}
+        if login_throttle.is_known_failure(username_or_token, password):
+            login_throttle.record_failure(
+                username_or_token, password, ip, remember=False
+            )
+            return _authentication_failed()
+        login_throttle.record_evaluation()
+
+        # Verify as if username_or_token is an access token, which doesn't
+        # query the database.
+        user = None
+        found_username = User.verify_access_token(username_or_token)
+        if found_username is None:
             # Verify the username and password combination
-            user = User.query.filter_by(username=username_or_token).first()
-            if user and bcrypt.check_password_hash(user.password, password):
+            user = User.lookup(username_or_token)
+            if user and password_hasher.check(user.password, password):
                 found_username = user.username
+                if password_hasher.needs_rehash(user.password):
+                    # Transparently upgrade the hash to the current cost
+                    # factor, now that we know the plaintext password.
+                    User.query.filter_by(id=user.id).update({
+                        User.password: password_hasher.generate(password)
+                    })
+                    db.session.commit()
+                    user_cache.invalidate(user.username)
 
         if found_username is None:  # User not found
-            return {
-                'status': 'error',
-                'message': 'User not found. Authentication failed.'
-            }, 401
+            # Only the wrong passwords of existing users are remembered, since
+            # unknown users may register in the meantime.
+            login_throttle.record_failure(
+                username_or_token, password, ip, remember=user is not None
+            )
+            return _authentication_failed()
         return {
             'status': 'success',
             'data': found_username
@@ -100,9 +128,25 @@ class AccessToken(Resource):
         Gets an access token for the current logged-in user.
         :return:
         """
-        user = User.query.filter_by(username=request.json['username']).first()
-        access_token, duration = user.gen_access_token()
+        user = User.lookup(request.json['username'])
+        if user is None:
+            return {
+                'status': 'error',
+                'message': 'User not found'
+            }, 404
+        access_token, duration = User.make_access_token(user.id, user.username)
         return {
-            'access token': access_token.decode('ascii'),
+            'access token': access_token,
             'duration in seconds': duration
         }
+
+
+def _authentication_failed() -> tuple:
+    """
+    Private helper function to make the response to a failed authentication.
+    :return: tuple
+    """
+    return {
+        'status': 'error',
+        'message': 'User not found. Authentication failed.'
+    }, 401
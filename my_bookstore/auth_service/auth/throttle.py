@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+
+"""
+Throttling of failed authentication attempts module.
+"""
+
+import hashlib
+import hmac
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from flask import Flask
+
+
+class LocalThrottleBackend:
+    """
+    In-process backend of the login throttle, whose state is kept in each
+    worker process.
+    """
+
+    def __init__(self, max_keys: int=100000):
+        """
+        Constructor with parameters.
+        :param max_keys: int
+        """
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+        self._failures = OrderedDict()  # key -> expires_at
+        self._lock = threading.Lock()
+        self.errors = ()  # Never fails
+
+    def take(self, key: str, rate: float, burst: float, cost: float) -> float:
+        """
+        Refills the token bucket under the given key, takes the given number of
+        tokens from it, and returns the number of tokens left.
+        :param key: str
+        :param rate: float
+        :param burst: float
+        :param cost: float
+        :return: float
+        """
+        now = time.time()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate) - cost
+            if cost:
+                self._buckets[key] = (tokens, now)
+                self._buckets.move_to_end(key)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+        return tokens
+
+    def add_failure(self, key: str, ttl: float) -> None:
+        """
+        Remembers the given failed credentials for the given TTL.
+        :param key: str
+        :param ttl: float
+        :return: None
+        """
+        with self._lock:
+            self._failures[key] = time.monotonic() + ttl
+            self._failures.move_to_end(key)
+            if len(self._failures) > self.max_keys:
+                self._failures.popitem(last=False)
+
+    def has_failure(self, key: str) -> bool:
+        """
+        Checks whether the given credentials failed recently.
+        :param key: str
+        :return: bool
+        """
+        with self._lock:
+            expires_at = self._failures.get(key)
+            if expires_at is None:
+                return False
+            if expires_at <= time.monotonic():
+                del self._failures[key]
+                return False
+            return True
+
+
+class RedisThrottleBackend:
+    """
+    Redis backend of the login throttle, whose state is shared by all the
+    worker processes.
+    """
+
+    # Refilling and taking from a bucket is done atomically in Redis.
+    TAKE_SCRIPT = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local now, cost = tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(state[1]) or burst
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - updated_at) * rate) - cost
+if cost > 0 then
+    redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+    redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+end
+return tostring(tokens)
+"""
+
+    def __init__(self, url: str):
+        """
+        Constructor with parameters.
+        :param url: str
+        """
+        import redis  # Only needed with this backend
+
+        self._redis = redis.StrictRedis.from_url(url, decode_responses=True)
+        self._take = self._redis.register_script(self.TAKE_SCRIPT)
+        self.errors = (redis.RedisError,)
+
+    def take(self, key: str, rate: float, burst: float, cost: float) -> float:
+        """
+        Refills the token bucket under the given key, takes the given number of
+        tokens from it, and returns the number of tokens left.
+        :param key: str
+        :param rate: float
+        :param burst: float
+        :param cost: float
+        :return: float
+        """
+        return float(
+            self._take(keys=[key], args=[rate, burst, time.time(), cost])
+        )
+
+    def add_failure(self, key: str, ttl: float) -> None:
+        """
+        Remembers the given failed credentials for the given TTL.
+        :param key: str
+        :param ttl: float
+        :return: None
+        """
+        self._redis.set(key, 1, px=int(ttl * 1000))
+
+    def has_failure(self, key: str) -> bool:
+        """
+        Checks whether the given credentials failed recently.
+        :param key: str
+        :return: bool
+        """
+        return self._redis.exists(key) > 0
+
+
+class LoginThrottle:
+    """
+    Guard against repeated failed authentication attempts, so that they cannot
+    burn the CPU with database lookups and bcrypt checks.
+    * Recently failed credentials are remembered (negative cache), and are
+      rejected again without being evaluated.
+    * Failed attempts take tokens from a bucket per username (or token) and
+      from a bucket per source IP. Once a bucket is empty, the attempts are
+      rejected with 429 until it refills, before being evaluated.
+    Successful attempts don't take any token, so valid clients are never
+    throttled by their own traffic.
+    Failures of the backend let the attempts be evaluated as usual.
+    """
+
+    def __init__(self, app: Optional[Flask]=None):
+        """
+        Constructor with parameters.
+        :param app: Flask
+        """
+        self._backend = None
+        self._secret = b''
+        self._username_limit = (0.1, 10)
+        self._ip_limit = (1, 50)
+        self._failure_ttl = 60
+        self._lock = threading.Lock()
+        self._counters = {
+            'evaluated': 0, 'rejected': 0, 'negative_hits': 0, 'errors': 0
+        }
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """
+        Initializes the throttle with the given application's configurations.
+        :param app: Flask
+        :return: None
+        """
+        if not app.config['LOGIN_THROTTLE_ENABLED']:
+            self._backend = None
+        elif app.config['LOGIN_THROTTLE_REDIS_URL']:
+            self._backend = RedisThrottleBackend(
+                app.config['LOGIN_THROTTLE_REDIS_URL']
+            )
+        else:
+            self._backend = LocalThrottleBackend(
+                max_keys=app.config['LOGIN_THROTTLE_MAX_KEYS']
+            )
+        self._secret = app.config['SECRET_KEY'].encode('utf-8')
+        self._username_limit = (
+            app.config['LOGIN_THROTTLE_USERNAME_RATE'],
+            app.config['LOGIN_THROTTLE_USERNAME_BURST']
+        )
+        self._ip_limit = (
+            app.config['LOGIN_THROTTLE_IP_RATE'],
+            app.config['LOGIN_THROTTLE_IP_BURST']
+        )
+        self._failure_ttl = app.config['LOGIN_THROTTLE_FAILURE_TTL']
+
+    def retry_after(self, username_or_token: str,
+                    ip: Optional[str]) -> Optional[int]:
+        """
+        Checks whether an attempt with the given username (or token) from the
+        given IP should be rejected, and if so, returns the number of seconds
+        after which it can be retried.
+        :param username_or_token: str
+        :param ip: str
+        :return: int or None
+        """
+        if self._backend is None:
+            return None
+        waits = []
+        try:
+            for key, (rate, burst) in self._buckets(username_or_token, ip):
+                tokens = self._backend.take(key, rate, burst, cost=0)
+                if tokens < 1:
+                    waits.append(math.ceil((1 - tokens) / rate))
+        except self._backend.errors:
+            self._count('errors')
+            return None
+        if waits:
+            self._count('rejected')
+            return max(waits)
+        return None
+
+    def is_known_failure(self, username_or_token: str, password: str) -> bool:
+        """
+        Checks whether the given credentials failed recently.
+        :param username_or_token: str
+        :param password: str
+        :return: bool
+        """
+        if self._backend is None:
+            return False
+        try:
+            known = self._backend.has_failure(
+                self._failure_key(username_or_token, password)
+            )
+        except self._backend.errors:
+            self._count('errors')
+            return False
+        if known:
+            self._count('negative_hits')
+        return known
+
+    def record_evaluation(self) -> None:
+        """
+        Counts an attempt that was fully evaluated.
+        :return: None
+        """
+        self._count('evaluated')
+
+    def record_failure(self, username_or_token: str, password: str,
+                       ip: Optional[str], remember: bool=True) -> None:
+        """
+        Records a failed attempt with the given credentials from the given IP.
+        :param username_or_token: str
+        :param password: str
+        :param ip: str
+        :param remember: bool
+        :return: None
+        """
+        if self._backend is None:
+            return
+        try:
+            for key, (rate, burst) in self._buckets(username_or_token, ip):
+                self._backend.take(key, rate, burst, cost=1)
+            if remember:
+                self._backend.add_failure(
+                    self._failure_key(username_or_token, password),
+                    self._failure_ttl
+                )
+        except self._backend.errors:
+            self._count('errors')
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the evaluated and rejected attempts.
+        :return: dict
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def _buckets(self, username_or_token: str, ip: Optional[str]) -> list:
+        """
+        Private helper method to get the keys and the limits of the buckets of
+        the given username (or token) and IP.
+        :param username_or_token: str
+        :param ip: str
+        :return: list[tuple(str, tuple(float, float))]
+        """
+        buckets = [(
+            f'throttle:user:{self._digest(username_or_token)}',
+            self._username_limit
+        )]
+        if ip:
+            buckets.append((f'throttle:ip:{ip}', self._ip_limit))
+        return buckets
+
+    def _failure_key(self, username_or_token: str, password: str) -> str:
+        """
+        Private helper method to make the key of the given failed credentials.
+        The plaintext credentials are never stored.
+        :param username_or_token: str
+        :param password: str
+        :return: str
+        """
+        digest = self._digest(f'{username_or_token}\x00{password}')
+        return f'throttle:failure:{digest}'
+
+    def _digest(self, value: str) -> str:
+        """
+        Private helper method to compute a keyed hash of the given value.
+        :param value: str
+        :return: str
+        """
+        return hmac.new(
+            self._secret, value.encode('utf-8'), hashlib.sha256
+        ).hexdigest()
+
+    def _count(self, name: str) -> None:
+        """
+        Private helper method to increment the given counter.
+        :param name: str
+        :return: None
+        """
+        with self._lock:
+            self._counters[name] += 1
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+"""
+Gunicorn configuration module.
+"""
+
+import os
+import time
+
+# Since we want everyone outside the Docker container to be able to access the
+# application, we set the host to be "0.0.0.0"
+bind = '0.0.0.0:8000'
+# For IO-bound application and a 4-core machine, we use (2 x # of CPUs + 1) as
+# the number of workers (processes), and for each worker, we use asynchronous
+# worker type based on "gevent", and allows 1000 client connections per worker.
+workers = 9
+worker_class = 'gevent'
+worker_connections = 1000
+
+# Load the application once in the master process, so that the forked workers
+# share it copy-on-write, and start without importing or building anything.
+# Note that the workers then don't reload the code on HUP.
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+# The standard library must be monkey-patched before the application is
+# imported (in the master process, when preloaded), so that all the locks and
+# sockets it creates are cooperative.
+if worker_class == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+_started_at = time.monotonic()
+
+
+def when_ready(server) -> None:
+    server.log.info(
+        'Master ready in %.3f seconds', time.monotonic() - _started_at
+    )
+
+
+def pre_fork(server, worker) -> None:
+    worker.forked_at = time.monotonic()
+
+
+def post_worker_init(worker) -> None:
+    worker.log.info(
+        'Worker (pid: %s) started in %.3f seconds',
+        worker.pid, time.monotonic() - worker.forked_at
+    )
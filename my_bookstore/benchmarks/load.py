@@ -0,0 +1,598 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load benchmark of bookstore_service and auth_service, run in-process.
+
+Both applications run in this process, and bookstore_service calls
+auth_service through an in-process transport rather than the network. The
+requests are sent by a fixed number of concurrent threads, for a fixed
+duration per scenario.
+
+Usage:
+$ python benchmarks/load.py run [--database-url URL] [--authors 100]
+      [--books 10000] [--concurrency 8] [--duration 5] [--output FILE]
+$ python benchmarks/load.py compare BASELINE.json RESULTS.json
+      [--threshold 10]
+"""
+
+import argparse
+import base64
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, NamedTuple, Tuple
+from urllib.parse import urlsplit
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..', 'bookstore_service'))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..', 'auth_service'))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..', 'service_common'))
+# The configurations require these, even though the benchmark may run on
+# SQLite.
+os.environ.setdefault('FLASK_SECRET_KEY', 'benchmark')
+os.environ.setdefault('POSTGRES_USER', 'benchmark')
+os.environ.setdefault('POSTGRES_PASSWORD', 'benchmark')
+os.environ.setdefault('ACCESS_TOKEN_SECRET_KEY', 'benchmark-access-token')
+os.environ.setdefault(
+    'METRICS_DIR', os.path.join(tempfile.gettempdir(), 'benchmark_metrics')
+)
+
+import requests  # noqa: E402
+from requests.adapters import BaseAdapter  # noqa: E402
+from requests.structures import CaseInsensitiveDict  # noqa: E402
+from werkzeug.test import EnvironBuilder, run_wsgi_app  # noqa: E402
+
+import auth  # noqa: E402
+import bookstore  # noqa: E402
+from auth.config import Config as AuthConfig  # noqa: E402
+from bookstore.config import Config as BookstoreConfig  # noqa: E402
+
+USER_SERVICE_URL = 'http://auth-service.local'
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark-password'
+PAGE_SIZE = 20
+
+
+class WSGIAdapter(BaseAdapter):
+    """
+    Transport adapter of "requests", which sends the requests straight to a
+    WSGI application in the same process.
+    """
+
+    def __init__(self, app):
+        """
+        Constructor with parameters.
+        :param app: WSGI application
+        """
+        super().__init__()
+        self._app = app
+
+    def send(self, request: requests.PreparedRequest, stream: bool=False,
+             timeout=None, verify=True, cert=None,
+             proxies=None) -> requests.Response:
+        url = urlsplit(request.url)
+        headers = dict(request.headers)
+        headers.pop('Content-Length', None)
+        content_type = headers.pop('Content-Type', None)
+        body = request.body
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        environ = EnvironBuilder(
+            path=url.path, query_string=url.query, method=request.method,
+            headers=headers, data=body, content_type=content_type
+        ).get_environ()
+        app_iter, status, response_headers = run_wsgi_app(
+            self._app, environ, buffered=True
+        )
+
+        response = requests.Response()
+        response.status_code = int(status.split(' ', 1)[0])
+        response.reason = status.split(' ', 1)[-1]
+        response.headers = CaseInsensitiveDict(response_headers)
+        response._content = b''.join(app_iter)
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+class Scenario(NamedTuple):
+    """
+    Benchmark scenario, whose request maker returns the method, the path and
+    the keyword arguments of the test client's "open()" of a request, and the
+    expected status codes.
+    """
+    name: str
+    service: str  # "bookstore" or "auth"
+    make_request: Callable[[random.Random], Tuple[str, str, dict, tuple]]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Runs the benchmark')
+    run_parser.add_argument(
+        '--database-url',
+        help='Database shared by both services (SQLite files in a temporary '
+             'directory if not given)'
+    )
+    run_parser.add_argument(
+        '--reset', action='store_true',
+        help='Drop the tables of both services first (careful!)'
+    )
+    run_parser.add_argument('--authors', type=int, default=100)
+    run_parser.add_argument('--books', type=int, default=10000)
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument(
+        '--duration', type=float, default=5, help='In seconds, per scenario'
+    )
+    run_parser.add_argument('--warmup', type=int, default=20)
+    run_parser.add_argument(
+        '--bcrypt-rounds', type=int, default=AuthConfig.BCRYPT_LOG_ROUNDS
+    )
+    run_parser.add_argument(
+        '--no-response-cache', action='store_true',
+        help='Disable the response cache of bookstore_service'
+    )
+    run_parser.add_argument(
+        '--scenarios', help='Comma-separated names of the scenarios to run'
+    )
+    run_parser.add_argument('--seed', type=int, default=42)
+    run_parser.add_argument(
+        '--output', help='Results file (in "benchmarks/results/" by default)'
+    )
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compares results, and flags regressions'
+    )
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument(
+        '--threshold', type=float, default=10,
+        help='Max tolerated drop of RPS, or increase of p95, in percent'
+    )
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(0 if compare(args) else 1)
+
+
+def run(args: argparse.Namespace) -> None:
+    """
+    Runs the benchmark with the given arguments, and saves the results.
+    :param args: Namespace
+    :return: None
+    """
+    bookstore_app, auth_app = _create_apps(args)
+    dataset = _prepare_dataset(bookstore_app, auth_app, args)
+    scenarios = _scenarios(dataset)
+    if args.scenarios:
+        names = args.scenarios.split(',')
+        scenarios = [scenario for scenario in scenarios
+                     if scenario.name in names]
+    apps = {'bookstore': bookstore_app, 'auth': auth_app}
+
+    print(
+        f'{"scenario":<24}{"requests":>10}{"errors":>8}{"rps":>10}'
+        f'{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"sql/req":>9}'
+    )
+    results = {}
+    for scenario in scenarios:
+        result = _run_scenario(scenario, apps[scenario.service], args)
+        results[scenario.name] = result
+        print(
+            f'{scenario.name:<24}{result["requests"]:>10}'
+            f'{result["errors"]:>8}{result["rps"]:>10.1f}'
+            f'{result["p50_ms"]:>10.2f}{result["p95_ms"]:>10.2f}'
+            f'{result["p99_ms"]:>10.2f}{result["sql_per_request"]:>9.2f}'
+        )
+
+    output = args.output or os.path.join(
+        BENCHMARKS_DIR, 'results',
+        f'{datetime.now().strftime("%Y%m%d-%H%M%S")}.json'
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'meta': _meta(args, dataset),
+            'scenarios': results
+        }, f, indent=2)
+    print(f'Results saved to {output}')
+
+
+def compare(args: argparse.Namespace) -> bool:
+    """
+    Compares the results with the baseline, and returns whether there is no
+    regression.
+    :param args: Namespace
+    :return: bool
+    """
+    with open(args.baseline) as f:
+        baseline = json.load(f)['scenarios']
+    with open(args.results) as f:
+        results = json.load(f)['scenarios']
+
+    print(
+        f'{"scenario":<24}{"rps":>10}{"change":>9}{"p95 ms":>10}{"change":>9}'
+    )
+    ok = True
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        rps_change = _change(baseline[name]['rps'], result['rps'])
+        p95_change = _change(baseline[name]['p95_ms'], result['p95_ms'])
+        regressed = (
+            rps_change < -args.threshold or p95_change > args.threshold
+        )
+        ok = ok and not regressed
+        print(
+            f'{name:<24}{result["rps"]:>10.1f}{rps_change:>+8.1f}%'
+            f'{result["p95_ms"]:>10.2f}{p95_change:>+8.1f}%'
+            f'{"  REGRESSION" if regressed else ""}'
+        )
+    return ok
+
+
+def _create_apps(args: argparse.Namespace) -> tuple:
+    """
+    Private helper function to create both applications, with bookstore_service
+    calling auth_service in-process.
+    :param args: Namespace
+    :return: tuple(Flask, Flask)
+    """
+    if args.database_url:
+        bookstore_url = auth_url = args.database_url
+    else:
+        directory = tempfile.mkdtemp(prefix='benchmark_')
+        bookstore_url = f'sqlite:///{os.path.join(directory, "bookstore.db")}'
+        auth_url = f'sqlite:///{os.path.join(directory, "auth.db")}'
+
+    class BenchmarkBookstoreConfig(BookstoreConfig):
+        SQLALCHEMY_DATABASE_URI = bookstore_url
+        SQLALCHEMY_BINDS = {}
+        SQLALCHEMY_REPLICA_BINDS = []
+        USER_SERVICE_URL = USER_SERVICE_URL
+        RESPONSE_CACHE_BACKEND = (
+            None if args.no_response_cache else 'local'
+        )
+
+    class BenchmarkAuthConfig(AuthConfig):
+        SQLALCHEMY_DATABASE_URI = auth_url
+        BCRYPT_LOG_ROUNDS = args.bcrypt_rounds
+        # All the requests come from the same address.
+        LOGIN_THROTTLE_ENABLED = False
+
+    bookstore_app = bookstore.create_app(BenchmarkBookstoreConfig)
+    auth_app = auth.create_app(BenchmarkAuthConfig)
+    bookstore.user_service.session.mount(
+        USER_SERVICE_URL, WSGIAdapter(auth_app)
+    )
+    return bookstore_app, auth_app
+
+
+def _prepare_dataset(bookstore_app, auth_app,
+                     args: argparse.Namespace) -> dict:
+    """
+    Private helper function to migrate the databases, and seed them with the
+    dataset of the configured size, unless already seeded.
+    :param bookstore_app: Flask
+    :param auth_app: Flask
+    :param args: Namespace
+    :return: dict
+    """
+    from auth.migrations import migrate as migrate_auth
+    from auth.models import User
+    from bookstore.migrations import migrate as migrate_bookstore
+    from bookstore.models import Author, Book, CollectionCount
+
+    rng = random.Random(args.seed)
+    with bookstore_app.app_context():
+        if args.reset:
+            _drop_tables(bookstore.db, 'bookstore_migrations')
+        migrate_bookstore()
+        if Author.query.first() is None:
+            _bulk_insert(Author, [
+                {'name': f'Author {i}', 'email': f'author{i}@example.com'}
+                for i in range(args.authors)
+            ])
+            author_ids = [
+                author_id for author_id, in bookstore.db.session.query(
+                    Author.id
+                )
+            ]
+            _bulk_insert(Book, [
+                {
+                    'title': f'Book {i}',
+                    'author_id': rng.choice(author_ids),
+                    'description': f'Description of the book {i}',
+                    'date_published': date(2000, 1, 1) + timedelta(days=i % 7000)
+                }
+                for i in range(args.books)
+            ])
+            CollectionCount.adjust(Author, args.authors)
+            CollectionCount.adjust(Book, args.books)
+            bookstore.db.session.commit()
+        author_names = [
+            name for name, in bookstore.db.session.query(Author.name)
+        ]
+        book_ids = [
+            book_id for book_id, in bookstore.db.session.query(Book.id)
+        ]
+
+    with auth_app.app_context():
+        if args.reset:
+            _drop_tables(auth.db, 'auth_migrations')
+        migrate_auth()
+        user = User.query.filter_by(username=USERNAME).first()
+        if user is None:
+            user = User(
+                username=USERNAME, email='benchmark@example.com',
+                password=auth.password_hasher.generate(PASSWORD)
+            )
+            auth.db.session.add(user)
+            auth.db.session.commit()
+        access_token, _ = user.gen_access_token(expires_in=24 * 3600)
+
+    return {
+        'author_names': author_names,
+        'book_ids': book_ids,
+        'access_token': access_token
+    }
+
+
+def _scenarios(dataset: dict) -> List[Scenario]:
+    """
+    Private helper function to make the scenarios over the given dataset.
+    :param dataset: dict
+    :return: list[Scenario]
+    """
+    token_headers = _basic_auth(dataset['access_token'], 'unused')
+    password_headers = _basic_auth(USERNAME, PASSWORD)
+    book_ids = dataset['book_ids']
+    author_names = dataset['author_names']
+    last_page = max(1, math.ceil(len(book_ids) / PAGE_SIZE))
+    middle_page = max(1, last_page // 2)
+
+    def list_books(page: int):
+        path = f'/bookstore/books?page={page}&per_page={PAGE_SIZE}'
+        return lambda rng: ('GET', path, {'headers': token_headers}, (200,))
+
+    def get_book(rng: random.Random):
+        path = f'/bookstore/books/{rng.choice(book_ids)}'
+        return 'GET', path, {'headers': token_headers}, (200,)
+
+    def put_book(rng: random.Random):
+        path = f'/bookstore/books/{rng.choice(book_ids)}'
+        return 'PUT', path, {
+            'headers': token_headers,
+            'json': {'description': f'Updated {rng.random()}'}
+        }, (200, 412)  # 412 on concurrent updates of the same book
+
+    def post_book(rng: random.Random):
+        return 'POST', '/bookstore/books', {
+            'headers': token_headers,
+            'json': {
+                'title': f'New book {rng.random()}',
+                'author_name': rng.choice(author_names),
+                'description': 'A new book'
+            }
+        }, (200,)
+
+    def access_token(rng: random.Random):
+        return 'GET', '/bookstore/access-token', {
+            'headers': password_headers
+        }, (200,)
+
+    def auth_with(username_or_token: str, password: str):
+        body = {'username_or_token': username_or_token, 'password': password}
+        return lambda rng: ('GET', '/user-auth', {'json': body}, (200,))
+
+    return [
+        Scenario('list_books_first_page', 'bookstore', list_books(1)),
+        Scenario('list_books_middle_page', 'bookstore', list_books(middle_page)),
+        Scenario('list_books_last_page', 'bookstore', list_books(last_page)),
+        Scenario('get_book', 'bookstore', get_book),
+        Scenario('put_book', 'bookstore', put_book),
+        Scenario('post_book', 'bookstore', post_book),
+        Scenario('access_token', 'bookstore', access_token),
+        Scenario(
+            'token_auth', 'auth', auth_with(dataset['access_token'], 'unused')
+        ),
+        Scenario('password_auth', 'auth', auth_with(USERNAME, PASSWORD))
+    ]
+
+
+def _run_scenario(scenario: Scenario, app,
+                  args: argparse.Namespace) -> dict:
+    """
+    Private helper function to run the given scenario against the given
+    application, with the configured concurrency and duration.
+    :param scenario: Scenario
+    :param app: Flask
+    :param args: Namespace
+    :return: dict
+    """
+    client = app.test_client()
+    rng = random.Random(args.seed)
+    for _ in range(args.warmup):
+        _send(client, scenario.make_request(rng))
+
+    sql_before = _sql_statements()
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def work(worker_seed: int) -> None:
+        worker_client = app.test_client()
+        worker_rng = random.Random(worker_seed)
+        worker_latencies, worker_errors = [], 0
+        while time.perf_counter() < deadline:
+            started_at = time.perf_counter()
+            ok = _send(worker_client, scenario.make_request(worker_rng))
+            worker_latencies.append(time.perf_counter() - started_at)
+            worker_errors += not ok
+        with lock:
+            latencies.extend(worker_latencies)
+            errors[0] += worker_errors
+
+    started_at = time.perf_counter()
+    threads = [
+        threading.Thread(target=work, args=(args.seed + i,))
+        for i in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started_at
+    statements = _sql_statements() - sql_before
+
+    latencies.sort()
+    n = len(latencies)
+    return {
+        'requests': n,
+        'errors': errors[0],
+        'rps': n / elapsed,
+        'mean_ms': sum(latencies) / n * 1e3 if n else 0.0,
+        'p50_ms': _percentile(latencies, 0.50) * 1e3,
+        'p95_ms': _percentile(latencies, 0.95) * 1e3,
+        'p99_ms': _percentile(latencies, 0.99) * 1e3,
+        'sql_per_request': statements / n if n else 0.0
+    }
+
+
+def _send(client, request: tuple) -> bool:
+    """
+    Private helper function to send the given request with the given test
+    client, and check its status code.
+    :param client: FlaskClient
+    :param request: tuple(str, str, dict, tuple)
+    :return: bool
+    """
+    method, path, kwargs, expected_statuses = request
+    response = client.open(path, method=method, **kwargs)
+    response.close()
+    return response.status_code in expected_statuses
+
+
+def _sql_statements() -> float:
+    """
+    Private helper function to get the total number of SQL statements run by
+    the requests to both applications so far, from their metrics.
+    :return: float
+    """
+    total = 0.0
+    for metrics in (bookstore.metrics, auth.metrics):
+        for _, data in metrics.request_sql_statements.snapshot():
+            total += data[-1]  # The sum of the histogram
+    return total
+
+
+def _percentile(values: List[float], q: float) -> float:
+    """
+    Private helper function to get the given percentile of the given sorted
+    values (nearest rank).
+    :param values: list[float]
+    :param q: float
+    :return: float
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+
+def _change(before: float, after: float) -> float:
+    """
+    Private helper function to get the relative change between the given
+    values, in percent.
+    :param before: float
+    :param after: float
+    :return: float
+    """
+    return (after - before) / before * 100 if before else 0.0
+
+
+def _basic_auth(username: str, password: str) -> Dict[str, str]:
+    """
+    Private helper function to make the headers of HTTP basic authentication.
+    :param username: str
+    :param password: str
+    :return: dict
+    """
+    credentials = base64.b64encode(f'{username}:{password}'.encode('utf-8'))
+    return {'Authorization': f'Basic {credentials.decode("ascii")}'}
+
+
+def _bulk_insert(model, rows: List[dict], chunk_size: int=5000) -> None:
+    """
+    Private helper function to insert the given rows of the given model in
+    chunks, within the current transaction.
+    :param model: db.Model
+    :param rows: list[dict]
+    :param chunk_size: int
+    :return: None
+    """
+    session = bookstore.db.session
+    for i in range(0, len(rows), chunk_size):
+        session.execute(model.__table__.insert(), rows[i:i + chunk_size])
+
+
+def _drop_tables(db, migrations_table: str) -> None:
+    """
+    Private helper function to drop the tables of the given service.
+    :param db: SQLAlchemy
+    :param migrations_table: str
+    :return: None
+    """
+    db.drop_all(bind=None)
+    db.session.execute(f'DROP TABLE IF EXISTS {migrations_table}')
+    db.session.commit()
+
+
+def _meta(args: argparse.Namespace, dataset: dict) -> dict:
+    """
+    Private helper function to describe the environment of the run.
+    :param args: Namespace
+    :param dataset: dict
+    :return: dict
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': 'sqlite' if not args.database_url else urlsplit(
+            args.database_url
+        ).scheme,
+        'authors': len(dataset['author_names']),
+        'books': len(dataset['book_ids']),
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'bcrypt_rounds': args.bcrypt_rounds,
+        'response_cache': not args.no_response_cache
+    }
+
+
+if __name__ == '__main__':
+    main()
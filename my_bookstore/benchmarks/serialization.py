@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark of the serialization of the bookstore responses, comparing the
+marshmallow schemas with the compiled dumpers.
+
+Usage:
+$ python benchmarks/serialization.py [--rows 100] [--repeat 200]
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+from datetime import date, timedelta
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', 'bookstore_service')
+)
+# The configurations require these, even though the benchmark runs on SQLite.
+os.environ.setdefault('FLASK_SECRET_KEY', 'benchmark')
+os.environ.setdefault('POSTGRES_USER', 'benchmark')
+os.environ.setdefault('POSTGRES_PASSWORD', 'benchmark')
+
+from sqlalchemy.orm import joinedload, selectinload  # noqa: E402
+
+from bookstore import create_app, db  # noqa: E402
+from bookstore.config import Config  # noqa: E402
+from bookstore.migrations import migrate  # noqa: E402
+from bookstore.models import (  # noqa: E402
+    Author, Book, author_schema, authors_schema, book_schema, books_schema
+)
+from bookstore.serialization import dump, encode_json  # noqa: E402
+
+
+class BenchmarkConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    RESPONSE_CACHE_BACKEND = None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        migrate()
+        _seed(args.rows)
+        books = Book.query.options(joinedload(Book.author)).all()
+        authors = Author.query.options(selectinload(Author.books)).all()
+
+    cases = [
+        ('books_schema (list page)', books_schema, books),
+        ('authors_schema (list page)', authors_schema, authors),
+        ('book_schema (item)', book_schema, books[0]),
+        ('author_schema (item)', author_schema, authors[0])
+    ]
+    print(f'{"case":<28}{"marshmallow":>14}{"compiled":>14}{"speedup":>10}')
+    with app.test_request_context(base_url='http://localhost/bookstore'):
+        for name, schema, obj in cases:
+            expected = json.dumps(schema.dump(obj)).encode('ascii')
+            actual = encode_json(dump(schema, obj))
+            assert actual == expected, f'Different output for {name}'
+
+            slow = _best_of(
+                lambda: json.dumps(schema.dump(obj)), args.repeat
+            )
+            fast = _best_of(
+                lambda: encode_json(dump(schema, obj)), args.repeat
+            )
+            print(
+                f'{name:<28}{slow * 1e3:>11.3f} ms{fast * 1e3:>11.3f} ms'
+                f'{slow / fast:>9.1f}x'
+            )
+
+
+def _seed(n_books: int) -> None:
+    """
+    Private helper function to seed the database with the given number of
+    books, by 10 authors.
+    :param n_books: int
+    :return: None
+    """
+    authors = [Author(name=f'Author {i}') for i in range(10)]
+    db.session.add_all(authors)
+    db.session.flush()
+    db.session.add_all(
+        Book(
+            title=f'Book {i}', author_id=authors[i % 10].id,
+            description='Description', date_published=date(2000, 1, 1) +
+            timedelta(days=i)
+        )
+        for i in range(n_books)
+    )
+    db.session.commit()
+
+
+def _best_of(func, repeat: int) -> float:
+    """
+    Private helper function to get the best time of the given function.
+    :param func:
+    :param repeat: int
+    :return: float
+    """
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+
+"""
+Serving benchmark of bookstore_service, comparing the server modes.
+
+For each server mode ("wsgi" with gevent workers, "asgi" with uvicorn
+workers), bookstore_service is run by Gunicorn with its own configuration,
+and loaded over HTTP by a fixed number of concurrent keep-alive connections,
+for a fixed duration per number of connections. The requests are the item and
+list GETs of books, authenticated with access tokens verified locally (so
+without auth_service).
+It reports the requests per second, the p50 / p99 latencies, and the memory
+(RSS) of the server processes, in total and per concurrent connection.
+
+Usage:
+$ python benchmarks/serving.py [--database-url URL] [--authors 100]
+      [--books 10000] [--modes wsgi,asgi] [--workers 1]
+      [--connections 10,100,1000] [--duration 10] [--warmup 2]
+      [--output FILE]
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from typing import List
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.join(BENCHMARKS_DIR, '..', 'bookstore_service')
+COMMON_DIR = os.path.join(BENCHMARKS_DIR, '..', 'service_common')
+sys.path.insert(0, SERVICE_DIR)
+sys.path.insert(0, COMMON_DIR)
+# The configurations require these, even though the benchmark may run on
+# SQLite.
+os.environ.setdefault('FLASK_SECRET_KEY', 'benchmark')
+os.environ.setdefault('POSTGRES_USER', 'benchmark')
+os.environ.setdefault('POSTGRES_PASSWORD', 'benchmark')
+os.environ.setdefault('ACCESS_TOKEN_SECRET_KEY', 'benchmark-access-token')
+
+from itsdangerous import (  # noqa: E402
+    TimedJSONWebSignatureSerializer as Serializer
+)
+
+import bookstore  # noqa: E402
+from bookstore.config import Config  # noqa: E402
+
+PAGE_SIZE = 20
+
+
+class BenchmarkConfig(Config):
+    """
+    Configuration of the benchmarked bookstore_service, passed to the server
+    processes through environment variables.
+    """
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'BENCHMARK_DATABASE_URL', Config.SQLALCHEMY_DATABASE_URI
+    )
+    USER_SERVICE_URL = 'http://127.0.0.1:9'  # Not called
+    # Each request should hit the database, rather than the cache of each
+    # worker.
+    RESPONSE_CACHE_BACKEND = (
+        'local'
+        if os.environ.get('BENCHMARK_RESPONSE_CACHE') == 'true' else None
+    )
+    METRICS_ENABLED = False
+
+
+def create_benchmark_app():
+    """
+    Factory of the application served by Gunicorn in the benchmark, according
+    to SERVER_MODE.
+    :return: WSGI or ASGI application
+    """
+    return bookstore.create_server_app(BenchmarkConfig)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        '--database-url',
+        help='Database of bookstore_service (an SQLite file in a temporary '
+             'directory if not given)'
+    )
+    parser.add_argument('--authors', type=int, default=100)
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--modes', default='wsgi,asgi')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument(
+        '--connections', default='10,100,1000',
+        help='Comma-separated numbers of concurrent connections'
+    )
+    parser.add_argument(
+        '--duration', type=float, default=10,
+        help='In seconds, per number of connections'
+    )
+    parser.add_argument(
+        '--warmup', type=float, default=2, help='In seconds, per server mode'
+    )
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument(
+        '--response-cache', action='store_true',
+        help='Enable the response cache of each worker'
+    )
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument(
+        '--output',
+        help='Path of the JSON results (benchmarks/results/serving-<time>.json '
+             'if not given)'
+    )
+    args = parser.parse_args()
+
+    database_url = args.database_url or 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(prefix='bookstore_serving_'), 'bookstore.db'
+    )
+    os.environ['BENCHMARK_DATABASE_URL'] = database_url
+    os.environ['BENCHMARK_RESPONSE_CACHE'] = str(args.response_cache).lower()
+    BenchmarkConfig.SQLALCHEMY_DATABASE_URI = database_url
+    book_count = _prepare_dataset(args)
+    token = Serializer(
+        os.environ['ACCESS_TOKEN_SECRET_KEY'], expires_in=24 * 3600
+    ).dumps({'id': 1, 'username': 'benchmark'}).decode('ascii')
+    connection_counts = [int(n) for n in args.connections.split(',')]
+
+    print(
+        f'{"mode":<6}{"conns":>7}{"requests":>10}{"errors":>8}{"rps":>10}'
+        f'{"p50 ms":>10}{"p99 ms":>10}{"rss MB":>9}{"KB/conn":>9}'
+    )
+    results = {}
+    for mode in args.modes.split(','):
+        results[mode] = {}
+        with _Server(mode, args) as server:
+            loop = asyncio.get_event_loop()
+            # Warm up the workers (imports, connections, etc.), so that they
+            # are not accounted to the first number of connections.
+            loop.run_until_complete(_run_load(
+                server, args.workers, args.warmup, token, book_count,
+                random.Random(args.seed)
+            ))
+            for connections in connection_counts:
+                result = loop.run_until_complete(_run_load(
+                    server, connections, args.duration, token, book_count,
+                    random.Random(args.seed)
+                ))
+                results[mode][str(connections)] = result
+                print(
+                    f'{mode:<6}{connections:>7}{result["requests"]:>10}'
+                    f'{result["errors"]:>8}{result["rps"]:>10.1f}'
+                    f'{result["p50_ms"]:>10.2f}{result["p99_ms"]:>10.2f}'
+                    f'{result["rss_peak_mb"]:>9.1f}'
+                    f'{result["rss_per_connection_kb"]:>9.1f}'
+                )
+
+    output = args.output or os.path.join(
+        BENCHMARKS_DIR, 'results',
+        f'serving-{datetime.now().strftime("%Y%m%d-%H%M%S")}.json'
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'meta': {
+                'started_at': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'database': database_url.split(':', 1)[0],
+                'books': book_count,
+                'workers': args.workers,
+                'duration': args.duration,
+                'response_cache': args.response_cache
+            },
+            'modes': results
+        }, f, indent=2)
+    print(f'Results saved to {output}')
+
+
+class _Server:
+    """
+    Gunicorn serving bookstore_service in the given mode, as a context manager.
+    """
+
+    def __init__(self, mode: str, args: argparse.Namespace):
+        """
+        Constructor with parameters.
+        :param mode: str
+        :param args: Namespace
+        """
+        self.mode = mode
+        self.port = args.port
+        self._workers = args.workers
+        self._process = None
+
+    def __enter__(self):
+        env = dict(
+            os.environ, SERVER_MODE=self.mode,
+            PYTHONPATH=os.pathsep.join(
+                [BENCHMARKS_DIR, COMMON_DIR, os.environ.get('PYTHONPATH', '')]
+            )
+        )
+        self._process = subprocess.Popen(
+            [
+                # Gunicorn of the same Python environment
+                sys.executable, '-c',
+                'from gunicorn.app.wsgiapp import run; run()',
+                '-c', 'gunicorn.conf.py',
+                '--workers', str(self._workers),
+                '--bind', f'127.0.0.1:{self.port}',
+                '--log-level', 'warning',
+                'serving:create_benchmark_app()'
+            ],
+            cwd=SERVICE_DIR, env=env
+        )
+        self._wait_until_ready()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._process.send_signal(signal.SIGTERM)
+        try:
+            self._process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+
+    def rss(self) -> int:
+        """
+        Returns the total resident memory of the master and the worker
+        processes, in bytes (Linux only).
+        :return: int
+        """
+        pids = [self._process.pid] + _child_pids(self._process.pid)
+        return sum(_rss(pid) for pid in pids)
+
+    def _wait_until_ready(self, timeout: float=60) -> None:
+        """
+        Private helper method to wait until all the workers serve requests.
+        :param timeout: float
+        :return: None
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError(f'Gunicorn exited in {self.mode} mode')
+            try:
+                with socket.create_connection(('127.0.0.1', self.port), 1):
+                    pass
+            except OSError:
+                time.sleep(0.2)
+                continue
+            if len(_child_pids(self._process.pid)) >= self._workers:
+                time.sleep(1)  # Let the workers finish starting
+                return
+            time.sleep(0.2)
+        raise RuntimeError(f'Gunicorn not ready in {timeout} seconds')
+
+
+async def _run_load(server: _Server, connections: int, duration: float,
+                    token: str, book_count: int,
+                    rng: random.Random) -> dict:
+    """
+    Private helper function to load the given server with the given number of
+    concurrent connections, for the given duration.
+    :param server: _Server
+    :param connections: int
+    :param duration: float
+    :param token: str
+    :param book_count: int
+    :param rng: Random
+    :return: dict
+    """
+    credentials = base64.b64encode(
+        f'{token}:unused'.encode('ascii')
+    ).decode('ascii')
+    page_count = max(1, -(-book_count // PAGE_SIZE))
+
+    def make_request() -> bytes:
+        if rng.random() < 0.5:
+            path = f'/bookstore/books/{rng.randint(1, book_count)}'
+        else:
+            path = f'/bookstore/books?page={rng.randint(1, page_count)}'
+        return (
+            f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+            f'Authorization: Basic {credentials}\r\n\r\n'
+        ).encode('ascii')
+
+    rss_idle = server.rss()
+    streams = await asyncio.gather(*(
+        asyncio.open_connection('127.0.0.1', server.port)
+        for _ in range(connections)
+    ))
+    latencies = []
+    errors = 0
+    rss_peak = rss_idle
+    deadline = time.monotonic() + duration
+
+    async def drive(reader, writer) -> None:
+        nonlocal errors
+        while time.monotonic() < deadline:
+            started_at = time.perf_counter()
+            try:
+                writer.write(make_request())
+                status = await _read_response(reader)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                errors += 1
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', server.port
+                )
+                continue
+            if status == 200:
+                latencies.append(time.perf_counter() - started_at)
+            else:
+                errors += 1
+        writer.close()
+
+    async def sample_rss() -> None:
+        nonlocal rss_peak
+        while time.monotonic() < deadline:
+            rss_peak = max(rss_peak, server.rss())
+            await asyncio.sleep(0.25)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(
+        sample_rss(), *(drive(reader, writer) for reader, writer in streams)
+    )
+    elapsed = time.perf_counter() - started_at
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed,
+        'p50_ms': _percentile(latencies, 0.5) * 1e3,
+        'p99_ms': _percentile(latencies, 0.99) * 1e3,
+        'rss_idle_mb': rss_idle / 2 ** 20,
+        'rss_peak_mb': rss_peak / 2 ** 20,
+        'rss_per_connection_kb': (rss_peak - rss_idle) / connections / 2 ** 10
+    }
+
+
+async def _read_response(reader: asyncio.StreamReader) -> int:
+    """
+    Private helper function to read an HTTP response with a Content-Length
+    from the given stream, and return its status code.
+    :param reader: StreamReader
+    :return: int
+    """
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ', 2)[1])
+    content_length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name.lower() == 'content-length':
+            content_length = int(value)
+    await reader.readexactly(content_length)
+    return status
+
+
+def _prepare_dataset(args: argparse.Namespace) -> int:
+    """
+    Private helper function to migrate the database, and seed it with the
+    given numbers of authors and books unless it has them already.
+    :param args: Namespace
+    :return: int
+    """
+    from bookstore.migrations import migrate
+    from bookstore.models import Author, Book, CollectionCount
+
+    app = bookstore.create_app(BenchmarkConfig)
+    db = bookstore.db
+    with app.app_context():
+        migrate()
+        book_count = Book.query.count()
+        if book_count >= args.books:
+            return book_count
+        rng = random.Random(args.seed)
+        author_count = Author.query.count()
+        if author_count < args.authors:
+            db.session.execute(Author.__table__.insert(), [
+                {'name': f'Benchmark Author {i}', 'email': None, 'version': 1,
+                 'updated_at': datetime.utcnow()}
+                for i in range(author_count, args.authors)
+            ])
+            CollectionCount.adjust(Author, args.authors - author_count)
+        author_ids = [id_ for id_, in db.session.query(Author.id)]
+        db.session.execute(Book.__table__.insert(), [
+            {'title': f'Benchmark Book {i}',
+             'author_id': rng.choice(author_ids),
+             'description': 'Benchmark description ' * 4,
+             'date_published': date(1900, 1, 1) + timedelta(days=i % 40000),
+             'version': 1, 'updated_at': datetime.utcnow()}
+            for i in range(book_count, args.books)
+        ])
+        CollectionCount.adjust(Book, args.books - book_count)
+        db.session.commit()
+    return args.books
+
+
+def _child_pids(pid: int) -> List[int]:
+    """
+    Private helper function to get the PIDs of the child processes of the
+    given process (Linux only).
+    :param pid: int
+    :return: list[int]
+    """
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command may contain spaces, but is enclosed in parentheses.
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def _rss(pid: int) -> int:
+    """
+    Private helper function to get the resident memory of the given process,
+    in bytes (Linux only).
+    :param pid: int
+    :return: int
+    """
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _percentile(values: List[float], q: float) -> float:
+    """
+    Private helper function to get the given percentile of the given sorted
+    values (nearest rank).
+    :param values: list[float]
+    :param q: float
+    :return: float
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,29 @@
 from flask import Flask, g
 from flask_httpauth import HTTPBasicAuth
 from flask_marshmallow import Marshmallow
-from flask_sqlalchemy import SQLAlchemy
+from service_common.metrics import Metrics
+from service_common.pooling import init_pooling, pool_stats
 from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 
+from .cache import CredentialCache, ResponseCache
+from .compression import Compression
 from .config import Config
+from .http_client import ServiceClient
+from .query_budget import QueryBudget
+from .routing import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 ma = Marshmallow()
 auth = HTTPBasicAuth()
+credential_cache = CredentialCache()
+response_cache = ResponseCache()
+metrics = Metrics('bookstore')
+query_budget = QueryBudget()
+user_service = ServiceClient(
+    'USER_SERVICE', 'authentication service', metrics=metrics
+)
+compression = Compression(metrics=metrics)
 
 
 def create_app(config_class=Config) -> Flask:
@@ -21,8 +35,28 @@ def create_app(config_class=Config) -> Flask:
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    # First, so that it measures as much of each request as possible
+    metrics.init_app(app)
+    # Also early, as the "after request" functions registered first run last,
+    # so that the responses are compressed with all their headers
+    compression.init_app(app)
+    query_budget.init_app(app)
+    init_pooling(app)  # Before initializing SQLAlchemy
     db.init_app(app)
     ma.init_app(app)  # Order matters: Initialize SQLAlchemy before Marshmallow
+    credential_cache.init_app(app)
+    response_cache.init_app(app)
+    user_service.init_app(app)
+    metrics.collect('response_cache', response_cache.stats)
+    metrics.collect('credential_cache', credential_cache.stats)
+    metrics.collect('user_service', user_service.stats)
+    metrics.collect('compression', compression.stats)
+    metrics.collect('db_router', db.router.stats)
+    metrics.collect('db_pool', lambda: pool_stats(db, app))
+
+    # The app runs behind nginx, which forwards the client IP in
+    # "X-Forwarded-For".
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
 
     # In order to make sure that all the routes are prefixed with
     # APPLICATION_ROOT, we need to do some extra setup here.
@@ -40,7 +74,22 @@ def create_app(config_class=Config) -> Flask:
     from .api import api_bp
     app.register_blueprint(api_bp)
 
-    # Create and initialize the database
-    db.create_all(app=app)
+    # The database is created and upgraded by "flask migrate", once per
+    # deployment, rather than by every worker process.
+    from .migrations import migrate_command
+    app.cli.add_command(migrate_command)
 
     return app
+
+
+def create_server_app(config_class=Config):
+    """
+    Factory of the application served by Gunicorn: the WSGI application in
+    "wsgi" server mode, or the ASGI application in "asgi" server mode.
+    :param config_class:
+    :return: WSGI or ASGI application
+    """
+    if config_class.SERVER_MODE == 'asgi':
+        from .asgi import create_asgi_app
+        return create_asgi_app(config_class)
+    return create_app(config_class)
@@ -8,16 +8,37 @@ from flask import Blueprint
 from flask_restful import Api
 
 from .resources.auth import AccessToken, UserList
-from .resources.author import AuthorItem, AuthorList
-from .resources.book import BookItem, BookList
+from .resources.author import (
+    AuthorBatch, AuthorExport, AuthorItem, AuthorList, AuthorSearch
+)
+from .resources.book import (
+    BookBatch, BookExport, BookItem, BookList, BookSearch
+)
+from .serialization import output_json
 
 # Create a API-related blueprint
 api_bp = Blueprint(name='api', import_name=__name__)
 
-api = Api(api_bp)
+# The requests which cannot get a database connection within the pool timeout
+# (sqlalchemy.exc.TimeoutError) are told to retry later.
+errors = {
+    'TimeoutError': {
+        'message': 'The database is busy. Please retry later.',
+        'status': 503
+    }
+}
+
+api = Api(api_bp, errors=errors)
+api.representation('application/json')(output_json)
 api.add_resource(UserList, '/users', endpoint='add_user')
 api.add_resource(AccessToken, '/access-token', endpoint='access_token')
 api.add_resource(AuthorList, '/authors', endpoint='authors')
+api.add_resource(AuthorBatch, '/authors:batch', endpoint='authors_batch')
+api.add_resource(AuthorExport, '/authors/export', endpoint='authors_export')
+api.add_resource(AuthorSearch, '/authors/search', endpoint='authors_search')
 api.add_resource(AuthorItem, '/authors/<int:id>', endpoint='author')
 api.add_resource(BookList, '/books', endpoint='books')
+api.add_resource(BookBatch, '/books:batch', endpoint='books_batch')
+api.add_resource(BookExport, '/books/export', endpoint='books_export')
+api.add_resource(BookSearch, '/books/search', endpoint='books_search')
 api.add_resource(BookItem, '/books/<int:id>', endpoint='book')
@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+
+"""
+ASGI application module.
+"""
+
+import asyncio
+import base64
+import binascii
+import functools
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from flask import Flask
+from werkzeug.exceptions import HTTPException
+
+from . import auth, credential_cache, metrics, user_service
+from .config import Config
+from .http_client import (
+    AsyncServiceClient, ServiceResponse, ServiceUnavailable
+)
+from .serialization import encode_json
+from .utils import USER_AUTH_ENVIRON_KEY, verify_access_token_locally
+
+
+class AsgiApplication:
+    """
+    ASGI application, which serves the Flask application to an ASGI server
+    with asynchronous calls to auth_service, and the database work in a bounded
+    pool of threads.
+    The ASGI server's event loop handles the connections, the parsing of the
+    requests and the sending of the responses, so the idle and slow clients
+    only cost a coroutine.
+    The calls to auth_service are made by coroutines: the users and access
+    tokens are proxied entirely in the event loop, and the credentials of the
+    requests to the protected resources are verified before the request is
+    handed to the Flask application.
+    The rest of the request, i.e., the (synchronous) database work, runs in a
+    thread of the pool, like in a threaded WSGI server.
+    """
+
+    def __init__(self, wsgi_application: Flask, max_threads: int):
+        """
+        Constructor with parameters.
+        :param wsgi_application: Flask
+        :param max_threads: int
+        """
+        self.wsgi_application = wsgi_application
+        self.max_threads = max_threads
+        # The threads are started on demand, i.e., after forking the workers.
+        self._executor = ThreadPoolExecutor(max_workers=max_threads)
+        self._user_service = AsyncServiceClient(user_service)
+        config = wsgi_application.config
+        self._root = f"/{config['APPLICATION_ROOT']}"
+        self._secret_key = (
+            config['ACCESS_TOKEN_SECRET_KEY']
+            if config['LOCAL_TOKEN_VERIFICATION'] else None
+        )
+        self._urls = wsgi_application.url_map.bind('localhost')
+        self._protected_endpoints = frozenset(
+            endpoint
+            for endpoint, view in wsgi_application.view_functions.items()
+            if auth.login_required in getattr(
+                getattr(view, 'view_class', None), 'decorators', ()
+            )
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._handle_lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        started_at = time.perf_counter()
+        body = await _read_body(receive)
+        endpoint = self._match(scope)
+        environ = {}
+        username = None
+        if endpoint in self._protected_endpoints:
+            username, environ = await self._verify_credentials(scope)
+
+        status = None
+        if endpoint == 'api.add_user':
+            status = await self._add_user(scope, body, send)
+        elif endpoint == 'api.access_token' and username is not None:
+            status = await self._get_access_token(username, send)
+        if status is None:
+            await self._run_wsgi_application(scope, body, environ, send)
+            return
+        if metrics.enabled:
+            metrics.request_duration.observe(
+                time.perf_counter() - started_at, endpoint, scope['method']
+            )
+            metrics.requests.inc(endpoint, scope['method'], str(status))
+
+    async def _handle_lifespan(self, receive, send) -> None:
+        """
+        Private helper method to handle the startup and shutdown of the server.
+        :param receive:
+        :param send:
+        :return: None
+        """
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # Let the requests in progress finish.
+                await asyncio.get_event_loop().run_in_executor(
+                    None, functools.partial(self._executor.shutdown, wait=True)
+                )
+                await self._user_service.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _match(self, scope) -> Optional[str]:
+        """
+        Private helper method to find the endpoint of the given request.
+        :param scope:
+        :return: str or None
+        """
+        path = scope['path']
+        if not path.startswith(f'{self._root}/'):
+            return None
+        try:
+            endpoint, _ = self._urls.match(
+                path[len(self._root):], scope['method']
+            )
+        except HTTPException:  # Not found, redirected or method not allowed
+            return None
+        return endpoint
+
+    async def _verify_credentials(self, scope) -> Tuple[Optional[str], dict]:
+        """
+        Private helper method to verify the credentials of the given request
+        like verify_password_or_access_token(), except that auth_service is
+        called asynchronously.
+        Returns the username, if verified, and the WSGI environment entries
+        passing auth_service's response to the Flask application, which
+        produces the error responses.
+        :param scope:
+        :return: tuple(str or None, dict)
+        """
+        username_or_token, password = _basic_credentials(scope)
+        if self._secret_key is not None:
+            username = verify_access_token_locally(
+                username_or_token, self._secret_key
+            )
+            if username is not None:
+                return username, {}
+        username = credential_cache.get(username_or_token, password)
+        if username is not None:
+            return username, {}
+
+        try:
+            r = await self._user_service.get(
+                '/user-auth',
+                json={
+                    'username_or_token': username_or_token,
+                    'password': password
+                },
+                # For auth_service to throttle the failed attempts per IP
+                headers={'X-Forwarded-For': _remote_addr(scope)}
+            )
+        except ServiceUnavailable:
+            r = ServiceResponse(503, {}, b'')
+        if r.status_code == 200:
+            username = r.json()['data']
+            credential_cache.set(username_or_token, password, username)
+        return username, {
+            USER_AUTH_ENVIRON_KEY: (username_or_token, password, r)
+        }
+
+    async def _add_user(self, scope, body: bytes, send) -> Optional[int]:
+        """
+        Private helper method to add a new user, like UserList.post().
+        Returns None without responding to a malformed request, which is left
+        to the Flask application.
+        :param scope:
+        :param body: bytes
+        :param send:
+        :return: int or None
+        """
+        if not _is_json(scope):
+            return None
+        try:
+            user_data = json.loads(body)
+        except ValueError:
+            return None
+        try:
+            r = await self._user_service.post('/users', json=user_data)
+            payload = r.json()
+        except ServiceUnavailable as e:
+            return await _send_json(send, {'message': e.description}, 503)
+        if r.status_code == 201:
+            # Any credentials cached for a previous user with the same username
+            # are no longer valid.
+            credential_cache.invalidate_user(user_data['username'])
+        return await _send_json(send, payload, r.status_code)
+
+    async def _get_access_token(self, username: str, send) -> int:
+        """
+        Private helper method to get an access token for the given logged-in
+        user, like AccessToken.get().
+        :param username: str
+        :param send:
+        :return: int
+        """
+        try:
+            r = await self._user_service.get(
+                '/access-token', json={'username': username}
+            )
+            payload = r.json()
+        except ServiceUnavailable as e:
+            return await _send_json(send, {'message': e.description}, 503)
+        return await _send_json(send, payload, r.status_code)
+
+    async def _run_wsgi_application(self, scope, body: bytes, environ: dict,
+                                    send) -> None:
+        """
+        Private helper method to handle the given request by the Flask
+        application in a thread of the pool, with the given extra WSGI
+        environment entries.
+        The response is entirely produced in the thread, since the streamed
+        ones (e.g., exports) need the request context while being iterated,
+        and its chunks are sent through the event loop.
+        :param scope:
+        :param body: bytes
+        :param environ: dict
+        :param send:
+        :return: None
+        """
+        environ.update(_build_environ(scope, body))
+        loop = asyncio.get_event_loop()
+        response_start = []
+
+        def start_response(status: str, headers: list, exc_info=None):
+            response_start[:] = [{
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [
+                    (name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers
+                ]
+            }]
+
+        def send_from_thread(message: dict) -> None:
+            # The application may call start_response() lazily, i.e., when
+            # producing the first chunk.
+            if response_start:
+                asyncio.run_coroutine_threadsafe(
+                    send(response_start.pop()), loop
+                ).result()
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run() -> None:
+            result = self.wsgi_application(environ, start_response)
+            try:
+                for chunk in result:
+                    if chunk:
+                        send_from_thread({
+                            'type': 'http.response.body',
+                            'body': chunk,
+                            'more_body': True
+                        })
+                send_from_thread({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+
+        await loop.run_in_executor(self._executor, run)
+
+
+async def _read_body(receive) -> bytes:
+    """
+    Private helper function to read the whole body of a request.
+    :param receive:
+    :return: bytes
+    """
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':  # Client disconnected
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            break
+    return bytes(body)
+
+
+async def _send_json(send, data, status: int) -> int:
+    """
+    Private helper function to send a JSON response, encoded like the ones of
+    the Flask application.
+    :param send:
+    :param data:
+    :param status: int
+    :return: int
+    """
+    body = encode_json(data) + b'\n'
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('latin-1'))
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+    return status
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    """
+    Private helper function to get the value of the given (lower-case) header
+    of a request.
+    :param scope:
+    :param name: bytes
+    :return: str or None
+    """
+    for header_name, value in scope['headers']:
+        if header_name == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _is_json(scope) -> bool:
+    """
+    Private helper function to check whether the body of a request is JSON,
+    like Flask's Request.is_json.
+    :param scope:
+    :return: bool
+    """
+    mimetype = (_header(scope, b'content-type') or '').split(';')[0].strip()
+    return mimetype == 'application/json' or (
+        mimetype.startswith('application/') and mimetype.endswith('+json')
+    )
+
+
+def _basic_credentials(scope) -> Tuple[str, str]:
+    """
+    Private helper function to get the credentials of the basic authorization
+    header of a request, which are empty without any, like for auth.
+    :param scope:
+    :return: tuple(str, str)
+    """
+    authorization = _header(scope, b'authorization')
+    if authorization is None:
+        return '', ''
+    try:
+        auth_type, auth_info = authorization.split(None, 1)
+        if auth_type.lower() != 'basic':
+            return '', ''
+        username, password = base64.b64decode(auth_info).split(b':', 1)
+        return username.decode('utf-8'), password.decode('utf-8')
+    except (ValueError, binascii.Error):
+        return '', ''
+
+
+def _remote_addr(scope) -> str:
+    """
+    Private helper function to get the address of the client of a request,
+    trusting the last proxy like the Flask application (ProxyFix).
+    :param scope:
+    :return: str
+    """
+    forwarded_for = _header(scope, b'x-forwarded-for')
+    if forwarded_for:
+        return forwarded_for.split(',')[-1].strip()
+    client = scope.get('client')
+    return client[0] if client else ''
+
+
+def _build_environ(scope, body: bytes) -> dict:
+    """
+    Private helper function to build the WSGI environment of a request.
+    :param scope:
+    :param body: bytes
+    :return: dict
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client')
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode(
+            'latin-1'
+        ),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client[0] if client else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stdout,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+            name = f'HTTP_{name}'
+        if name in environ:
+            value = f'{environ[name]},{value}'
+        environ[name] = value
+    return environ
+
+
+def create_asgi_app(config_class=Config) -> AsgiApplication:
+    """
+    ASGI application factory, which serves the same application as the WSGI
+    factory under an ASGI server (e.g., uvicorn).
+    :param config_class:
+    :return: AsgiApplication
+    """
+    from . import create_app
+
+    app = create_app(config_class)
+    return AsgiApplication(app, app.config['ASGI_THREADS'])
@@ -0,0 +1,577 @@
+# -*- coding: utf-8 -*-
+
+"""
+Caching-related module.
+"""
+
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Iterable, List, Optional
+
+from flask import Flask
+
+
+class TTLCache:
+    """
+    Bounded, thread-safe LRU cache, whose entries expire after a TTL.
+    """
+
+    def __init__(self, maxsize: int=1024, ttl: float=60):
+        """
+        Constructor with parameters.
+        :param maxsize: int
+        :param ttl: float
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Any, default: Any=None) -> Any:
+        """
+        Gets the value cached under the given key.
+        :param key: Any
+        :param default: Any
+        :return: Any
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:  # Expired
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Any, value: Any, ttl: Optional[float]=None) -> None:
+        """
+        Caches the given value under the given key, evicting the least recently
+        used entry if the cache is full.
+        :param key: Any
+        :param value: Any
+        :param ttl: float
+        :return: None
+        """
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def setdefault(self, key: Any, value: Any,
+                   ttl: Optional[float]=None) -> Any:
+        """
+        Caches the given value under the given key, unless a value is already
+        cached under it, and returns the cached value.
+        :param key: Any
+        :param value: Any
+        :param ttl: float
+        :return: Any
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[1]
+        self.set(key, value, ttl=ttl)
+        return value
+
+    def delete(self, key: Any) -> None:
+        """
+        Removes the given key from the cache, if present.
+        :param key: Any
+        :return: None
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_where(self, predicate: Callable[[Any], bool]) -> int:
+        """
+        Removes all the entries whose value satisfies the given predicate.
+        :param predicate: Callable
+        :return: int
+        """
+        with self._lock:
+            keys = [
+                key for key, (_, value) in self._entries.items()
+                if predicate(value)
+            ]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self) -> None:
+        """
+        Removes all the entries.
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss counters and the current size of the cache.
+        :return: dict
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize
+        }
+
+
+class CredentialCache:
+    """
+    Cache of verified credentials, which maps a keyed hash of the credentials to
+    the resolved username.
+    The plaintext credentials are never stored.
+    """
+
+    def __init__(self, app: Optional[Flask]=None):
+        """
+        Constructor with parameters.
+        :param app: Flask
+        """
+        self._secret = b''
+        self._cache = TTLCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """
+        Initializes the cache with the given application's configurations.
+        :param app: Flask
+        :return: None
+        """
+        self._secret = app.config['SECRET_KEY'].encode('utf-8')
+        self._cache = TTLCache(
+            maxsize=app.config['AUTH_CACHE_SIZE'],
+            ttl=app.config['AUTH_CACHE_TTL']
+        )
+
+    def _key(self, username_or_token: str, password: str) -> bytes:
+        """
+        Private helper method to compute the cache key of the given credentials.
+        :param username_or_token: str
+        :param password: str
+        :return: bytes
+        """
+        credentials = f'{username_or_token}\x00{password}'.encode('utf-8')
+        return hmac.new(self._secret, credentials, hashlib.sha256).digest()
+
+    def get(self, username_or_token: str, password: str) -> Optional[str]:
+        """
+        Gets the username resolved from the given credentials, if they have been
+        verified recently.
+        :param username_or_token: str
+        :param password: str
+        :return: str or None
+        """
+        return self._cache.get(self._key(username_or_token, password))
+
+    def set(self, username_or_token: str, password: str,
+            username: str) -> None:
+        """
+        Caches the username resolved from the given verified credentials.
+        :param username_or_token: str
+        :param password: str
+        :param username: str
+        :return: None
+        """
+        self._cache.set(self._key(username_or_token, password), username)
+
+    def invalidate_user(self, username: str) -> int:
+        """
+        Removes all the cached credentials resolving to the given user.
+        This should be called whenever the user is changed or deleted.
+        :param username: str
+        :return: int
+        """
+        return self._cache.delete_where(lambda cached: cached == username)
+
+    def clear(self) -> None:
+        """
+        Removes all the cached credentials.
+        :return: None
+        """
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the cache.
+        :return: dict
+        """
+        return self._cache.stats()
+
+
+class LocalCacheBackend:
+    """
+    In-process backend of the response cache.
+    Note that each worker process has its own cache, so the invalidations only
+    apply to the worker handling the write, and the other workers may serve
+    stale responses until they expire.
+    """
+
+    def __init__(self, maxsize: int=1024):
+        """
+        Constructor with parameters.
+        :param maxsize: int
+        """
+        self._cache = TTLCache(maxsize=maxsize)
+        self.errors = ()  # Never fails
+
+    def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        """
+        Gets the values cached under the given keys.
+        :param keys: list[str]
+        :return: list[str or None]
+        """
+        return [self._cache.get(key) for key in keys]
+
+    def set(self, key: str, value: str, ttl: Optional[float]=None) -> None:
+        """
+        Caches the given value under the given key, with the given TTL, or
+        without expiration if no TTL is given.
+        :param key: str
+        :param value: str
+        :param ttl: float
+        :return: None
+        """
+        self._cache.set(key, value, ttl=ttl or float('inf'))
+
+    def add(self, key: str, value: str) -> str:
+        """
+        Caches the given value under the given key without expiration, unless a
+        value is already cached under it, and returns the cached value.
+        :param key: str
+        :param value: str
+        :return: str
+        """
+        return self._cache.setdefault(key, value, ttl=float('inf'))
+
+    def delete(self, keys: List[str]) -> None:
+        """
+        Removes the given keys from the cache.
+        :param keys: list[str]
+        :return: None
+        """
+        for key in keys:
+            self._cache.delete(key)
+
+
+class RedisCacheBackend:
+    """
+    Redis backend of the response cache, which is shared by all the worker
+    processes.
+    """
+
+    def __init__(self, url: str):
+        """
+        Constructor with parameters.
+        :param url: str
+        """
+        import redis  # Only needed with this backend
+
+        self._redis = redis.StrictRedis.from_url(url, decode_responses=True)
+        self.errors = (redis.RedisError,)
+
+    def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        """
+        Gets the values cached under the given keys, in a single round trip.
+        :param keys: list[str]
+        :return: list[str or None]
+        """
+        return self._redis.mget(keys)
+
+    def set(self, key: str, value: str, ttl: Optional[float]=None) -> None:
+        """
+        Caches the given value under the given key, with the given TTL, or
+        without expiration if no TTL is given.
+        :param key: str
+        :param value: str
+        :param ttl: float
+        :return: None
+        """
+        self._redis.set(key, value, px=int(ttl * 1000) if ttl else None)
+
+    def add(self, key: str, value: str) -> str:
+        """
+        Caches the given value under the given key without expiration, unless a
+        value is already cached under it, and returns the cached value.
+        :param key: str
+        :param value: str
+        :return: str
+        """
+        if self._redis.set(key, value, nx=True):
+            return value
+        return self._redis.get(key) or value
+
+    def delete(self, keys: List[str]) -> None:
+        """
+        Removes the given keys from the cache.
+        :param keys: list[str]
+        :return: None
+        """
+        if keys:
+            self._redis.delete(*keys)
+
+
+class ResponseCache:
+    """
+    Read-through cache of the serialized responses of the resources.
+    * Items are cached under their resource name and ID, and are invalidated by
+      deleting their keys.
+    * Pages of collections are cached under their URL, within versioned
+      namespaces (one per table that the pages depend on). A namespace is
+      invalidated as a whole by changing its version, so that the stale pages
+      are never read again, and simply expire.
+    Failures of the backend are treated as cache misses, so that the responses
+    are served from the database instead.
+    """
+
+    ITEM = 'item'
+    LIST = 'list'
+
+    def __init__(self, app: Optional[Flask]=None):
+        """
+        Constructor with parameters.
+        :param app: Flask
+        """
+        self._backend = None
+        self._prefix = ''
+        self._reinvalidate_delay = 0
+        self._ttls = {}
+        self._counters = {
+            kind: {'hits': 0, 'misses': 0} for kind in (self.ITEM, self.LIST)
+        }
+        self._counters['errors'] = 0
+        self._counters['invalidations'] = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """
+        Initializes the cache with the given application's configurations.
+        :param app: Flask
+        :return: None
+        """
+        backend = app.config['RESPONSE_CACHE_BACKEND']
+        if backend == 'redis':
+            self._backend = RedisCacheBackend(
+                app.config['RESPONSE_CACHE_REDIS_URL']
+            )
+        elif backend == 'local':
+            self._backend = LocalCacheBackend(
+                maxsize=app.config['RESPONSE_CACHE_SIZE']
+            )
+        else:  # Disabled
+            self._backend = None
+        self._prefix = app.config['RESPONSE_CACHE_KEY_PREFIX']
+        self._reinvalidate_delay = app.config[
+            'RESPONSE_CACHE_REINVALIDATE_DELAY'
+        ]
+        self._ttls = {
+            self.ITEM: app.config['RESPONSE_CACHE_ITEM_TTL'],
+            self.LIST: app.config['RESPONSE_CACHE_LIST_TTL']
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self._backend is not None
+
+    def item_key(self, resource: str, id: int) -> str:
+        """
+        Makes the cache key of the given item.
+        :param resource: str
+        :param id: int
+        :return: str
+        """
+        return f'{self._prefix}:{self.ITEM}:{resource}:{id}'
+
+    def list_key(self, namespaces: Iterable[str], url: str) -> Optional[str]:
+        """
+        Makes the cache key of the collection page with the given URL, within
+        the current versions of the given namespaces.
+        Returns None if the versions cannot be read from the backend.
+        :param namespaces: iterable[str]
+        :param url: str
+        :return: str or None
+        """
+        if not self.enabled:
+            return None
+        namespaces = sorted(set(namespaces))
+        version_keys = [self._version_key(ns) for ns in namespaces]
+        try:
+            versions = self._backend.get_many(version_keys)
+            for i, version in enumerate(versions):
+                if version is None:  # Not versioned yet, or evicted
+                    versions[i] = self._backend.add(
+                        version_keys[i], uuid.uuid4().hex
+                    )
+        except self._backend.errors:
+            self._count_error()
+            return None
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return f'{self._prefix}:{self.LIST}:{".".join(versions)}:{digest}'
+
+    def get(self, key: Optional[str]) -> Optional[dict]:
+        """
+        Gets the entry cached under the given key.
+        :param key: str
+        :return: dict or None
+        """
+        if not self.enabled or key is None:
+            return None
+        try:
+            value = self._backend.get_many([key])[0]
+        except self._backend.errors:
+            self._count_error()
+            return None
+        kind = self._kind(key)
+        with self._lock:
+            self._counters[kind]['misses' if value is None else 'hits'] += 1
+        return None if value is None else json.loads(value)
+
+    def set(self, key: Optional[str], entry: dict) -> None:
+        """
+        Caches the given entry under the given key.
+        :param key: str
+        :param entry: dict
+        :return: None
+        """
+        if not self.enabled or key is None:
+            return
+        try:
+            self._backend.set(
+                key, json.dumps(entry, separators=(',', ':')),
+                ttl=self._ttls[self._kind(key)]
+            )
+        except self._backend.errors:
+            self._count_error()
+
+    def invalidate_items(self, resource: str, ids: Iterable[int]) -> None:
+        """
+        Invalidates the cached items of the given resource with the given IDs.
+        :param resource: str
+        :param ids: iterable[int]
+        :return: None
+        """
+        if not self.enabled:
+            return
+        keys = [self.item_key(resource, id) for id in set(ids)]
+        self._delete(keys)
+        self._repeat_later(self._delete, keys)
+        with self._lock:
+            self._counters['invalidations'] += len(keys)
+
+    def invalidate_lists(self, *namespaces: str) -> None:
+        """
+        Invalidates all the cached collection pages within the given
+        namespaces.
+        :param namespaces: str
+        :return: None
+        """
+        if not self.enabled:
+            return
+        self._bump_versions(namespaces)
+        self._repeat_later(self._bump_versions, namespaces)
+        with self._lock:
+            self._counters['invalidations'] += len(namespaces)
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss counters and the hit ratios of the cache.
+        :return: dict
+        """
+        stats = {'enabled': self.enabled}
+        with self._lock:
+            for kind in (self.ITEM, self.LIST):
+                counters = dict(self._counters[kind])
+                lookups = counters['hits'] + counters['misses']
+                counters['hit_ratio'] = (
+                    counters['hits'] / lookups if lookups else 0.0
+                )
+                stats[kind] = counters
+            stats['errors'] = self._counters['errors']
+            stats['invalidations'] = self._counters['invalidations']
+        return stats
+
+    def _delete(self, keys: List[str]) -> None:
+        """
+        Private helper method to delete the given keys from the backend.
+        :param keys: list[str]
+        :return: None
+        """
+        try:
+            self._backend.delete(keys)
+        except self._backend.errors:
+            self._count_error()
+
+    def _bump_versions(self, namespaces: Iterable[str]) -> None:
+        """
+        Private helper method to change the versions of the given namespaces.
+        :param namespaces: iterable[str]
+        :return: None
+        """
+        for namespace in namespaces:
+            try:
+                self._backend.set(
+                    self._version_key(namespace), uuid.uuid4().hex
+                )
+            except self._backend.errors:
+                self._count_error()
+
+    def _repeat_later(self, func: Callable, *args) -> None:
+        """
+        Private helper method to repeat the given invalidation after the
+        configured delay, if any.
+        With read replicas, stale data may be read from a lagging replica and
+        cached again right after an invalidation, so the invalidation is
+        repeated once the replicas have caught up.
+        :param func: Callable
+        :param args:
+        :return: None
+        """
+        if self._reinvalidate_delay:
+            timer = threading.Timer(self._reinvalidate_delay, func, args)
+            timer.daemon = True
+            timer.start()
+
+    def _version_key(self, namespace: str) -> str:
+        """
+        Private helper method to make the key of the version of the given
+        namespace.
+        :param namespace: str
+        :return: str
+        """
+        return f'{self._prefix}:version:{namespace}'
+
+    def _kind(self, key: str) -> str:
+        """
+        Private helper method to get the kind of entries of the given key.
+        :param key: str
+        :return: str
+        """
+        return key[len(self._prefix) + 1:].split(':', 1)[0]
+
+    def _count_error(self) -> None:
+        """
+        Private helper method to count a failure of the backend.
+        :return: None
+        """
+        with self._lock:
+            self._counters['errors'] += 1
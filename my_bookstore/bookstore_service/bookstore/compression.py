@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+"""
+Response compression module.
+"""
+
+import abc
+import threading
+import time
+import zlib
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+from flask import Flask, request
+from service_common.metrics import Metrics
+from werkzeug.http import quote_etag
+
+from .cache import TTLCache
+
+try:
+    import brotli
+except ImportError:  # Optional
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # Optional
+    zstandard = None
+
+# Content codings whose compressed variants of the representations get their
+# own entity tags
+CONTENT_CODINGS = ('gzip', 'br', 'zstd')
+
+
+class _Codec(abc.ABC):
+    """
+    Content coding, which compresses whole bodies, or streams incrementally.
+    """
+
+    def __init__(self, name: str, level: int):
+        """
+        Constructor with parameters.
+        :param name: str
+        :param level: int
+        """
+        self.name = name
+        self.level = level
+
+    @abc.abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        """
+        Compresses the given data as a whole.
+        :param data: bytes
+        :return: bytes
+        """
+        pass
+
+    @abc.abstractmethod
+    def stream_compressor(self) -> Tuple[Callable[[bytes], bytes],
+                                         Callable[[], bytes]]:
+        """
+        Returns the functions to compress a stream: one compresses a chunk,
+        and flushes it so that the client receives it without waiting for the
+        next ones, and the other ends the stream.
+        :return: tuple(Callable, Callable)
+        """
+        pass
+
+
+class _GzipCodec(_Codec):
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def stream_compressor(self) -> Tuple[Callable[[bytes], bytes],
+                                         Callable[[], bytes]]:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+        def process(chunk: bytes) -> bytes:
+            return compressor.compress(chunk) + compressor.flush(
+                zlib.Z_SYNC_FLUSH
+            )
+        return process, compressor.flush
+
+
+class _BrotliCodec(_Codec):
+
+    def compress(self, data: bytes) -> bytes:
+        return brotli.compress(
+            data, mode=brotli.MODE_TEXT, quality=self.level
+        )
+
+    def stream_compressor(self) -> Tuple[Callable[[bytes], bytes],
+                                         Callable[[], bytes]]:
+        compressor = brotli.Compressor(
+            mode=brotli.MODE_TEXT, quality=self.level
+        )
+
+        def process(chunk: bytes) -> bytes:
+            return compressor.process(chunk) + compressor.flush()
+        return process, compressor.finish
+
+
+class _ZstdCodec(_Codec):
+
+    def compress(self, data: bytes) -> bytes:
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def stream_compressor(self) -> Tuple[Callable[[bytes], bytes],
+                                         Callable[[], bytes]]:
+        compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+
+        def process(chunk: bytes) -> bytes:
+            return compressor.compress(chunk) + compressor.flush(
+                zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            )
+        return process, compressor.flush
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """
+    Makes the entity tag of the variant of a representation compressed with
+    the given content coding.
+    :param etag: str
+    :param encoding: str
+    :return: str
+    """
+    return f'{etag}-{encoding}'
+
+
+_CODECS = {'gzip': _GzipCodec}
+if brotli is not None:
+    _CODECS['br'] = _BrotliCodec
+if zstandard is not None:
+    _CODECS['zstd'] = _ZstdCodec
+
+
+class Compression:
+    """
+    Compression of the responses, negotiated with "Accept-Encoding".
+    * The responses of the compressible types are compressed with the
+      preferred content coding that the client accepts, among gzip, and brotli
+      and zstd if their packages are installed. The bodies smaller than the
+      min size are left uncompressed, and the streamed responses are
+      compressed incrementally.
+    * The compressed variants of the responses with an ETag are cached in each
+      worker, so that the same representation (including the ones served from
+      the response cache) isn't compressed again on every request. The ETags of
+      the variants get the content coding as a suffix, which the conditional
+      requests accept as well.
+    """
+
+    def __init__(self, app: Optional[Flask]=None,
+                 metrics: Optional[Metrics]=None):
+        """
+        Constructor with parameters.
+        :param app: Flask
+        :param metrics: Metrics
+        """
+        self.enabled = False
+        self._codecs = {}
+        self._preferences = []
+        self._min_size = 1024
+        self._mimetypes = frozenset()
+        self._cache = TTLCache(maxsize=0)
+        self._bytes = self._cpu_seconds = None
+        if metrics is not None:
+            self._bytes = metrics.counter(
+                'compression_bytes_total',
+                'Bytes of the compressed responses, before ("in") and after '
+                '("out") compression',
+                ['encoding', 'direction']
+            )
+            self._cpu_seconds = metrics.counter(
+                'compression_cpu_seconds_total',
+                'CPU time spent compressing the responses',
+                ['encoding']
+            )
+        self._counters = {
+            'compressions': 0,
+            'streamed': 0,
+            'cache_hits': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'cpu_seconds': 0.0
+        }
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """
+        Initializes the compression with the given application's
+        configurations.
+        :param app: Flask
+        :return: None
+        """
+        self.enabled = app.config['COMPRESSION_ENABLED']
+        if not self.enabled:
+            return
+        levels = app.config['COMPRESSION_LEVELS']
+        self._codecs = {
+            name: _CODECS[name](name, levels[name])
+            for name in app.config['COMPRESSION_ENCODINGS'] if name in _CODECS
+        }
+        self._preferences = list(self._codecs)
+        self._min_size = app.config['COMPRESSION_MIN_SIZE']
+        self._mimetypes = frozenset(app.config['COMPRESSION_MIMETYPES'])
+        self._cache = TTLCache(
+            maxsize=app.config['COMPRESSION_CACHE_SIZE'],
+            ttl=app.config['COMPRESSION_CACHE_TTL']
+        )
+        app.after_request(self._compress_response)
+
+    def stats(self) -> dict:
+        """
+        Returns the numbers of compressions (including the streamed ones), the
+        bytes before and after them, the CPU time spent, and the hits of the
+        cache of compressed variants.
+        :return: dict
+        """
+        with self._lock:
+            stats = dict(self._counters)
+        stats['bytes_saved'] = stats['bytes_in'] - stats['bytes_out']
+        stats['cache'] = self._cache.stats()
+        return stats
+
+    def _compress_response(self, response):
+        """
+        Private helper method to compress the given response, if it's
+        compressible and the client accepts one of the content codings.
+        :param response:
+        :return:
+        """
+        if response.mimetype not in self._mimetypes:
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code == 304:
+            _use_matched_etag(response)
+            return response
+        if (response.status_code != 200 or response.direct_passthrough or
+                'Content-Encoding' in response.headers):
+            return response
+        encoding = request.accept_encodings.best_match(self._preferences)
+        if encoding is None:
+            return response
+        codec = self._codecs[encoding]
+
+        if response.is_streamed:
+            response.response = self._compress_stream(
+                codec, response.iter_encoded()
+            )
+            response.headers.pop('Content-Length', None)
+            with self._lock:
+                self._counters['streamed'] += 1
+        else:
+            data = response.get_data()
+            if len(data) < self._min_size:
+                return response
+            etag, weak = response.get_etag()
+            compressed = self._compress(codec, data, etag)
+            response.set_data(compressed)
+            if etag is not None:
+                response.headers['ETag'] = quote_etag(
+                    encoded_etag(etag, encoding), weak=weak
+                )
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def _compress(self, codec: _Codec, data: bytes,
+                  etag: Optional[str]) -> bytes:
+        """
+        Private helper method to compress the given body with the given codec,
+        or get its compressed variant from the cache if it has an ETag.
+        The cache key also contains a checksum of the body, as the ETags of the
+        representations don't cover everything in them (e.g., the host of the
+        links).
+        :param codec: _Codec
+        :param data: bytes
+        :param etag: str
+        :return: bytes
+        """
+        key = None
+        if etag is not None:
+            key = (codec.name, etag, len(data), zlib.crc32(data))
+            compressed = self._cache.get(key)
+            if compressed is not None:
+                with self._lock:
+                    self._counters['cache_hits'] += 1
+                return compressed
+        started_at = time.thread_time()
+        compressed = codec.compress(data)
+        self._record(
+            codec.name, len(data), len(compressed),
+            time.thread_time() - started_at
+        )
+        if key is not None:
+            self._cache.set(key, compressed)
+        return compressed
+
+    def _compress_stream(self, codec: _Codec,
+                         chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Private helper method to compress the given chunks of a streamed
+        response incrementally, and record the bytes and CPU time at the end.
+        :param codec: _Codec
+        :param chunks: iterable[bytes]
+        :return: iterator[bytes]
+        """
+        process, finish = codec.stream_compressor()
+        size_in = size_out = 0
+        cpu_seconds = 0.0
+        # Only the compression is timed, not the production of the chunks.
+        for chunk in chunks:
+            size_in += len(chunk)
+            started_at = time.thread_time()
+            compressed = process(chunk)
+            cpu_seconds += time.thread_time() - started_at
+            if compressed:
+                size_out += len(compressed)
+                yield compressed
+        started_at = time.thread_time()
+        compressed = finish()
+        cpu_seconds += time.thread_time() - started_at
+        size_out += len(compressed)
+        yield compressed
+        self._record(codec.name, size_in, size_out, cpu_seconds)
+
+    def _record(self, encoding: str, size_in: int, size_out: int,
+                cpu_seconds: float) -> None:
+        """
+        Private helper method to record a compression.
+        :param encoding: str
+        :param size_in: int
+        :param size_out: int
+        :param cpu_seconds: float
+        :return: None
+        """
+        with self._lock:
+            counters = self._counters
+            counters['compressions'] += 1
+            counters['bytes_in'] += size_in
+            counters['bytes_out'] += size_out
+            counters['cpu_seconds'] += cpu_seconds
+        if self._bytes is not None:
+            self._bytes.inc(encoding, 'in', amount=size_in)
+            self._bytes.inc(encoding, 'out', amount=size_out)
+            self._cpu_seconds.inc(encoding, amount=cpu_seconds)
+
+
+def _use_matched_etag(response) -> None:
+    """
+    Private helper function to answer a 304 response with the ETag of the
+    compressed variant that the client has, if any.
+    :param response:
+    :return: None
+    """
+    etag, weak = response.get_etag()
+    if etag is None or request.if_none_match.contains_weak(etag):
+        return
+    for encoding in CONTENT_CODINGS:
+        variant = encoded_etag(etag, encoding)
+        if request.if_none_match.contains_weak(variant):
+            response.headers['ETag'] = quote_etag(variant, weak=weak)
+            return
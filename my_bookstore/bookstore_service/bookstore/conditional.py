@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+Conditional requests-related module.
+"""
+
+import calendar
+import hashlib
+from datetime import datetime
+from typing import Optional
+
+from flask import abort, request
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.http import http_date, quote_etag
+
+from . import db
+from .compression import CONTENT_CODINGS, encoded_etag
+
+
+def make_etag(*parts) -> str:
+    """
+    Makes an entity tag from the given parts, which identify a version of a
+    representation.
+    :param parts:
+    :return: str
+    """
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def validator_headers(etag: str, last_modified: Optional[datetime]=None,
+                      weak: bool=False) -> dict:
+    """
+    Makes the response headers for the given validators.
+    :param etag: str
+    :param last_modified: datetime
+    :param weak: bool
+    :return: dict
+    """
+    headers = {'ETag': quote_etag(etag, weak=weak)}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
+
+
+def is_not_modified(etag: str,
+                    last_modified: Optional[datetime]=None) -> bool:
+    """
+    Checks whether the current request's "If-None-Match" or
+    "If-Modified-Since" header shows that the client already has the
+    representation with the given validators.
+    :param etag: str
+    :param last_modified: datetime
+    :return: bool
+    """
+    if request.if_none_match:
+        # "If-Modified-Since" is ignored when "If-None-Match" is given.
+        return any(
+            request.if_none_match.contains_weak(variant)
+            for variant in _etag_variants(etag)
+        )
+    if last_modified is not None and request.if_modified_since is not None:
+        # HTTP dates only have a precision of seconds.
+        return (calendar.timegm(last_modified.utctimetuple()) <=
+                calendar.timegm(request.if_modified_since.utctimetuple()))
+    return False
+
+
+def check_if_match(etag: str) -> None:
+    """
+    Checks the current request's "If-Match" header against the given entity
+    tag, and aborts with 412 if it doesn't match.
+    :param etag: str
+    :return: None
+    """
+    if request.if_match and not any(
+            request.if_match.contains(variant)
+            for variant in _etag_variants(etag)):
+        abort(412, description='Resource has been modified')
+
+
+def commit_if_unmodified() -> None:
+    """
+    Commits the current transaction, and aborts with 412 if any updated or
+    deleted row has been concurrently modified (optimistic concurrency control
+    with the version columns).
+    :return: None
+    """
+    try:
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        abort(412, description='Resource has been modified')
+
+
+def _etag_variants(etag: str) -> list:
+    """
+    Private helper function to get the given entity tag, and those of the
+    compressed variants of the same representation.
+    :param etag: str
+    :return: list[str]
+    """
+    return [etag] + [
+        encoded_etag(etag, encoding) for encoding in CONTENT_CODINGS
+    ]
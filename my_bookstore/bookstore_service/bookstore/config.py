@@ -15,12 +15,165 @@ class Config:
     # Generate the secret key using secrets.token_hex(16)
     SECRET_KEY = os.environ['FLASK_SECRET_KEY']
 
+    # Key shared with auth_service to verify the access tokens locally, without
+    # calling auth_service.
+    # If not set, all the credentials are verified by auth_service.
+    ACCESS_TOKEN_SECRET_KEY = os.environ.get('ACCESS_TOKEN_SECRET_KEY')
+    LOCAL_TOKEN_VERIFICATION = ACCESS_TOKEN_SECRET_KEY is not None
+
     APPLICATION_ROOT = 'bookstore'  # Make sure that the routes are prefixed with "/bookstore"
 
     # Configure the SQLAlchemy-related options
     postgres_user = os.environ['POSTGRES_USER']
     postgres_password = os.environ['POSTGRES_PASSWORD']
-    postgres_hostname = 'db'
+    postgres_hostname = os.environ.get('POSTGRES_HOSTNAME', 'db')
     postgres_db = 'bookstore'
     SQLALCHEMY_DATABASE_URI = f'postgres://{postgres_user}:{postgres_password}@{postgres_hostname}/{postgres_db}'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Configure the connection pool of each worker. With gevent workers, many
+    # more requests than connections are in flight, and the ones that don't
+    # get a connection within the pool timeout fail with 503.
+    # Mind that the pools of all the workers (of both services) must fit in
+    # the max connections of the database.
+    # In gevent mode, psycopg2 waits for the database cooperatively.
+    DB_GEVENT_MODE = True
+    DB_POOL_SIZE = 10
+    DB_MAX_OVERFLOW = 5
+    DB_POOL_TIMEOUT = 5  # In seconds
+    DB_POOL_PRE_PING = True  # Detect the connections closed by the server
+    DB_POOL_RECYCLE = 1800  # Close the connections older than this (seconds)
+    # When connecting to PgBouncer in transaction pooling mode (with
+    # POSTGRES_HOSTNAME pointing to it), let PgBouncer do the pooling.
+    DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', '').lower() == 'true'
+
+    # How the application is served by Gunicorn: "wsgi" with gevent workers,
+    # or "asgi" with uvicorn workers, whose event loop handles the connections
+    # and the calls to auth_service, while the database work is done in a
+    # pool of threads per worker. As each thread holds at most one
+    # connection, the threads fit in the pool, and the requests beyond them
+    # wait in the event loop rather than for a connection.
+    SERVER_MODE = os.environ.get('SERVER_MODE', 'wsgi')
+    ASGI_THREADS = DB_POOL_SIZE + DB_MAX_OVERFLOW
+
+    # Configure the read replicas, as binds named "replica_<n>", from a
+    # comma-separated list of URIs.
+    # The reads of safe requests are routed to a replica in rotation, chosen
+    # with the "round_robin" or "least_connections" strategy. The replicas are
+    # checked every check interval, and the ones that are down or lagging more
+    # than the max lag (in seconds) are taken out of rotation.
+    replica_uris = os.environ.get('SQLALCHEMY_REPLICA_URIS', '').split(',')
+    SQLALCHEMY_BINDS = {
+        f'replica_{i}': uri for i, uri in enumerate(replica_uris, 1) if uri
+    }
+    SQLALCHEMY_REPLICA_BINDS = list(SQLALCHEMY_BINDS)
+    SQLALCHEMY_REPLICA_STRATEGY = 'round_robin'
+    SQLALCHEMY_REPLICA_MAX_LAG = 5
+    SQLALCHEMY_REPLICA_CHECK_INTERVAL = 2
+    # After a write request, the client reads from the primary for the given
+    # number of seconds (with a cookie), so that it reads its own writes.
+    # Clients can also ask for the primary with the header set to "true".
+    READ_YOUR_WRITES_HEADER = 'X-Read-Your-Writes'
+    READ_YOUR_WRITES_COOKIE = 'read_your_writes'
+    READ_YOUR_WRITES_SECONDS = 10
+
+    # Configure the cache of verified credentials, so that repeated requests
+    # with the same credentials don't need to call auth_service
+    AUTH_CACHE_SIZE = 10000
+    AUTH_CACHE_TTL = 60  # In seconds
+
+    # Configure the read-through cache of the item and collection responses:
+    # "redis" shares the cache among all the workers, and None disables the
+    # cache. "local" keeps a cache in each worker, invalidated only in the
+    # worker handling the write, so the other workers serve stale responses
+    # until they expire: it's only used when explicitly chosen (e.g.,
+    # RESPONSE_CACHE_BACKEND=local), for a single worker or development.
+    RESPONSE_CACHE_REDIS_URL = os.environ.get('RESPONSE_CACHE_REDIS_URL')
+    RESPONSE_CACHE_BACKEND = os.environ.get(
+        'RESPONSE_CACHE_BACKEND',
+        'redis' if RESPONSE_CACHE_REDIS_URL else None
+    )
+    RESPONSE_CACHE_KEY_PREFIX = 'bookstore'
+    RESPONSE_CACHE_SIZE = 10000  # Max entries of the "local" backend
+    RESPONSE_CACHE_ITEM_TTL = 300  # In seconds
+    RESPONSE_CACHE_LIST_TTL = 60
+    # With read replicas, the invalidations are repeated after the max lag, in
+    # case stale data was cached from a lagging replica in the meantime.
+    RESPONSE_CACHE_REINVALIDATE_DELAY = (
+        SQLALCHEMY_REPLICA_MAX_LAG if SQLALCHEMY_REPLICA_BINDS else 0
+    )
+
+    # Configure the HTTP client for the calls to auth_service
+    USER_SERVICE_URL = 'http://auth_service:8000'
+    USER_SERVICE_POOL_SIZE = 100  # Max concurrent connections per worker
+    USER_SERVICE_POOL_TIMEOUT = 1  # Max time to wait for a free connection
+    USER_SERVICE_CONNECT_TIMEOUT = 0.5
+    USER_SERVICE_READ_TIMEOUT = 3
+    USER_SERVICE_MAX_RETRIES = 2  # Only for idempotent requests
+    USER_SERVICE_RETRY_BACKOFF = 0.05
+    USER_SERVICE_BREAKER_THRESHOLD = 5  # Consecutive failures to open circuit
+    USER_SERVICE_BREAKER_RESET_TIMEOUT = 10
+
+    # How to count the totals of filtered collections for pagination: "exact"
+    # runs a COUNT(*), while "estimate" uses the query planner's estimate and
+    # flags the total as approximate (PostgreSQL only).
+    # Unfiltered collections are always served from the maintained counts.
+    PAGINATION_FILTERED_TOTAL = 'exact'
+
+    # Max number of items in a single batch request
+    BATCH_MAX_ITEMS = 1000
+
+    # Number of rows fetched at a time from the server-side cursor when
+    # streaming an export of a collection
+    EXPORT_BATCH_SIZE = 1000
+
+    # Configure the compression of the responses of the given types, with the
+    # preferred content coding (in the given order) that the client accepts.
+    # "br" and "zstd" are only available with the "brotli" and "zstandard"
+    # packages installed. The bodies smaller than the min size (in bytes) are
+    # left uncompressed, as the savings wouldn't be worth the CPU time. The
+    # compressed variants of the responses with an ETag are cached in each
+    # worker.
+    COMPRESSION_ENABLED = True
+    COMPRESSION_ENCODINGS = ['br', 'zstd', 'gzip']
+    COMPRESSION_LEVELS = {'br': 4, 'zstd': 3, 'gzip': 6}
+    COMPRESSION_MIN_SIZE = 1024
+    COMPRESSION_MIMETYPES = [
+        'application/json', 'application/x-ndjson', 'text/csv', 'text/plain'
+    ]
+    COMPRESSION_CACHE_SIZE = 1000
+    COMPRESSION_CACHE_TTL = 300  # In seconds
+
+    # Configure the metrics, which are served in Prometheus text format at
+    # "/metrics" (not exposed through nginx). Each worker process flushes its
+    # metrics to a file in the metrics directory every flush interval, and the
+    # files of all the workers are aggregated when serving them.
+    METRICS_ENABLED = True
+    METRICS_DIR = os.environ.get('METRICS_DIR')  # A temporary one if not set
+    METRICS_FLUSH_INTERVAL = 5  # In seconds
+
+    # Configure the query budget, which counts and times the SQL statements of
+    # each request (development and tests only, as it walks the stack for each
+    # statement). A request is flagged when it runs more statements than the
+    # budget of "<method> <endpoint>" or "<endpoint>" (or the default budget,
+    # if not None), or when it repeats the same statement (apart from the
+    # parameters) at least the repeat threshold times, like an N+1 pattern.
+    # The statements slower than the given time are logged with their origin
+    # in the code. Flagged requests are logged, or fail with
+    # QueryBudgetExceeded if raise is set (e.g., in tests).
+    # The statements of streamed responses run after the check, and are not
+    # counted.
+    SQL_BUDGET_ENABLED = os.environ.get('SQL_BUDGET_ENABLED', '').lower() == 'true'
+    SQL_BUDGETS = {
+        # The total count and the page, plus the count of the filtered total
+        'GET api.books': 3,
+        'GET api.book': 1,
+        'GET api.books_search': 3,  # Plus the count of the filtered total
+        'GET api.authors': 3,
+        'GET api.author': 2,
+        'GET api.authors_search': 3
+    }
+    SQL_BUDGET_DEFAULT = None
+    SQL_BUDGET_REPEAT_THRESHOLD = 3
+    SQL_BUDGET_SLOW_SECONDS = 0.1
+    SQL_BUDGET_RAISE = False
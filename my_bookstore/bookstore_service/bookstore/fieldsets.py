@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sparse fieldsets module.
+
+With the "fields" query parameter (e.g., "?fields=title,author.name"), the
+clients choose the fields of the representations. The schemas are restricted
+to those fields, and the queries only load the columns and the relationships
+that the schemas dump.
+"""
+
+import functools
+from typing import Iterable, Optional, Tuple
+
+from flask import abort, request
+from flask_marshmallow import Schema
+from flask_marshmallow.fields import URLFor
+from flask_sqlalchemy import BaseQuery
+from marshmallow import fields
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, load_only, selectinload
+from sqlalchemy.orm.interfaces import MANYTOONE
+
+from .serialization import URL_PARAM_PATTERN
+
+# Max number of cached restricted schemas, i.e., of distinct field sets
+_SCHEMA_CACHE_SIZE = 256
+
+
+def requested_fields(schema: Schema) -> Optional[Tuple[str, ...]]:
+    """
+    Gets the fields of the given schema requested with the current request's
+    "fields" query parameter, as a comma-separated list of field names, and
+    "<field>.<nested field>" for the fields of nested objects.
+    Returns None if the parameter is not given, and aborts with 400 if it
+    contains unknown fields.
+    :param schema: Schema
+    :return: tuple(str) or None
+    """
+    param = request.args.get('fields')
+    if param is None:
+        return None
+    names = {name.strip() for name in param.split(',') if name.strip()}
+    if not names:
+        abort(400, description='"fields" must not be empty')
+
+    available = _full_schema(type(schema)).dump_fields
+    unknown = []
+    for name in names:
+        field_name, _, nested_name = name.partition('.')
+        field = available.get(field_name)
+        if field is None:
+            unknown.append(name)
+        elif nested_name and not (
+                isinstance(field, fields.Nested) and
+                nested_name in field.schema.dump_fields):
+            unknown.append(name)
+    if unknown:
+        abort(
+            400,
+            description=f'Unknown fields: {", ".join(sorted(unknown))}'
+        )
+    # A whole nested object covers the selection of any of its fields.
+    return tuple(sorted(
+        name for name in names if name.partition('.')[0] == name or
+        name.partition('.')[0] not in names
+    ))
+
+
+def sparse_schema(schema: Schema,
+                  field_names: Optional[Tuple[str, ...]]) -> Schema:
+    """
+    Gets the schema of the same class (and "many" option) as the given schema,
+    restricted to the given fields, or the given schema if no fields are
+    given.
+    The restricted schemas are cached per field set, so that their compiled
+    dumpers are reused.
+    :param schema: Schema
+    :param field_names: tuple(str) or None
+    :return: Schema
+    """
+    if field_names is None:
+        return schema
+    return _restricted_schema(type(schema), schema.many, field_names)
+
+
+def project(query: BaseQuery, schema: Schema,
+            extra_columns: Iterable[str]=()) -> BaseQuery:
+    """
+    Restricts the given query to load the columns that the given schema
+    dumps, plus the given extra columns (with "<relationship>.<column>" for the
+    columns of the dumped relationships), and to load the relationships that
+    it dumps in the same or an additional query: many-to-one relationships are
+    joined, and the other ones are loaded with a single "SELECT ... IN" query.
+    The relationships that are not dumped are not loaded at all.
+    :param query: BaseQuery
+    :param schema: Schema
+    :param extra_columns: iterable[str]
+    :return: BaseQuery
+    """
+    extras = {}
+    for name in extra_columns:
+        relationship_name, _, column = name.rpartition('.')
+        extras.setdefault(relationship_name, []).append(column)
+
+    mapper = inspect(query.column_descriptions[0]['entity'])
+    columns, relationships = _dumped_attributes(mapper, schema)
+    options = []
+    if columns is not None:
+        options.append(load_only(*columns, *extras.get('', ())))
+    for name, nested_schema in relationships.items():
+        relationship = mapper.relationships[name]
+        attribute = getattr(mapper.class_, name)
+        if relationship.direction is MANYTOONE:
+            # Inner join if the foreign key can't be null
+            loader = joinedload(attribute, innerjoin=not any(
+                column.nullable for column in relationship.local_columns
+            ))
+        else:
+            loader = selectinload(attribute)
+        nested_columns, _ = _dumped_attributes(
+            relationship.mapper, nested_schema
+        )
+        if nested_columns is not None:
+            loader = loader.load_only(*nested_columns, *extras.get(name, ()))
+        options.append(loader)
+    return query.options(*options)
+
+
+def dumped_models(model, schema: Schema) -> list:
+    """
+    Gets the models of the relationships of the given model that the given
+    schema dumps as nested objects, which its representations depend on.
+    :param model: db.Model
+    :param schema: Schema
+    :return: list[db.Model]
+    """
+    mapper = inspect(model)
+    _, relationships = _dumped_attributes(mapper, schema)
+    return [
+        mapper.relationships[name].mapper.class_ for name in relationships
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def _full_schema(schema_class: type) -> Schema:
+    """
+    Private helper function to get the schema of the given class with all its
+    fields.
+    :param schema_class: type
+    :return: Schema
+    """
+    return schema_class()
+
+
+@functools.lru_cache(maxsize=_SCHEMA_CACHE_SIZE)
+def _restricted_schema(schema_class: type, many: bool,
+                       field_names: Tuple[str, ...]) -> Schema:
+    """
+    Private helper function to make the schema of the given class, restricted
+    to the given fields.
+    :param schema_class: type
+    :param many: bool
+    :param field_names: tuple(str)
+    :return: Schema
+    """
+    return schema_class(many=many, only=field_names)
+
+
+def _dumped_attributes(mapper, schema: Schema) -> tuple:
+    """
+    Private helper function to get the column attributes of the given mapper
+    that the given schema dumps (or None if some of its fields are not plain
+    columns, so all the columns need to be loaded), and the relationships that
+    it dumps, with the schemas of their nested objects.
+    :param mapper: Mapper
+    :param schema: Schema
+    :return: tuple(list[str] or None, dict)
+    """
+    columns = set()
+    all_columns = False
+    relationships = {}
+    for name, field in schema.dump_fields.items():
+        if isinstance(field, URLFor):
+            # The URLs are built from the attributes in their parameters.
+            attributes = []
+            for value in field.params.values():
+                match = URL_PARAM_PATTERN.match(str(value))
+                if match:
+                    attributes.append(match.group(1))
+        else:
+            attributes = [field.attribute or name]
+        for attribute in attributes:
+            if attribute in mapper.column_attrs:
+                columns.add(attribute)
+            elif (attribute in mapper.relationships and
+                  isinstance(field, fields.Nested)):
+                relationships[attribute] = field.schema
+            else:
+                all_columns = True
+    return (None if all_columns else sorted(columns)), relationships
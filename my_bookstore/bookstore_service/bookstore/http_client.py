@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+
+"""
+HTTP client module for the calls to other services.
+"""
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from typing import Mapping, NamedTuple, Optional
+
+import aiohttp
+import requests
+from flask import Flask, abort
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from service_common.metrics import Metrics
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker, which opens after a number of consecutive failures, so that
+    the calls fail fast instead of piling up on an unhealthy service.
+    After the reset timeout, a single trial call is let through ("half-open"),
+    and its result decides whether to close or re-open the circuit.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int=5, reset_timeout: float=10):
+        """
+        Constructor with parameters.
+        :param failure_threshold: int
+        :param reset_timeout: float
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if (self._state == self.OPEN and
+                    time.monotonic() - self._opened_at >= self.reset_timeout):
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        """
+        Checks whether a call is allowed to go through.
+        :return: bool
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and (
+                    time.monotonic() - self._opened_at >= self.reset_timeout):
+                # Let a single trial call go through
+                self._state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self) -> None:
+        """
+        Records a successful call.
+        :return: None
+        """
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        """
+        Records a failed call.
+        :return: None
+        """
+        with self._lock:
+            self._failures += 1
+            if (self._state == self.HALF_OPEN or
+                    self._failures >= self.failure_threshold):
+                if self._state != self.OPEN:
+                    self.times_opened += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the circuit breaker.
+        :return: dict
+        """
+        return {
+            'state': self.state,
+            'consecutive_failures': self._failures,
+            'times_opened': self.times_opened
+        }
+
+
+class ServiceClient:
+    """
+    HTTP client for the calls to another service, with per-process connection
+    pooling and keep-alive, connect/read timeouts, bounded retries for
+    idempotent requests, and a circuit breaker.
+    Since the standard library is monkey-patched by the gevent workers, waiting
+    on the connections and on the pool only blocks the current greenlet.
+    """
+
+    RETRY_STATUS_CODES = frozenset([502, 503, 504])
+
+    def __init__(self, config_prefix: str, name: str,
+                 app: Optional[Flask]=None, metrics: Optional[Metrics]=None):
+        """
+        Constructor with parameters.
+        The configurations of the client are prefixed with the given prefix,
+        and the service is called by the given name in the error messages.
+        :param config_prefix: str
+        :param name: str
+        :param app: Flask
+        :param metrics: Metrics
+        """
+        self._prefix = config_prefix
+        self.name = name
+        self._service = config_prefix.lower()
+        self._call_duration = self._calls = None
+        if metrics is not None:
+            self._call_duration = metrics.histogram(
+                'service_call_duration_seconds',
+                'Latency of the calls to other services',
+                ['service', 'method', 'path']
+            )
+            self._calls = metrics.counter(
+                'service_calls_total',
+                'Calls to other services by outcome (status code, "error" or '
+                '"breaker_open")',
+                ['service', 'method', 'path', 'outcome']
+            )
+        self.base_url = ''
+        self._pool_size = 10
+        self._pool_timeout = 1.0
+        self._timeout = (1.0, 5.0)
+        self._max_retries = 0
+        self._retry_backoff = 0.05
+        self.breaker = CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(self._pool_size)
+        self._session = None
+        self._session_pid = None
+        self._in_flight = 0
+        self._pool_waits = 0
+        self._pool_rejections = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """
+        Initializes the client with the given application's configurations.
+        :param app: Flask
+        :return: None
+        """
+        def config(name: str):
+            return app.config[f'{self._prefix}_{name}']
+
+        self.base_url = config('URL').rstrip('/')
+        self._pool_size = config('POOL_SIZE')
+        self._pool_timeout = config('POOL_TIMEOUT')
+        self._timeout = (config('CONNECT_TIMEOUT'), config('READ_TIMEOUT'))
+        self._max_retries = config('MAX_RETRIES')
+        self._retry_backoff = config('RETRY_BACKOFF')
+        self.breaker = CircuitBreaker(
+            failure_threshold=config('BREAKER_THRESHOLD'),
+            reset_timeout=config('BREAKER_RESET_TIMEOUT')
+        )
+        self._slots = threading.BoundedSemaphore(self._pool_size)
+        self._session = None
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        The HTTP session of the current process.
+        Connections must not be shared across forked worker processes, so the
+        session is lazily created in each process.
+        :return: requests.Session
+        """
+        pid = os.getpid()
+        if self._session is None or self._session_pid != pid:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=self._pool_size
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+            self._session_pid = pid
+        return self._session
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        """
+        Sends a GET request to the given path.
+        :param path: str
+        :param kwargs:
+        :return: requests.Response
+        """
+        return self.request('GET', path, retry=True, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        """
+        Sends a POST request to the given path.
+        Since POST requests are not idempotent, they are never retried.
+        :param path: str
+        :param kwargs:
+        :return: requests.Response
+        """
+        return self.request('POST', path, retry=False, **kwargs)
+
+    def request(self, method: str, path: str, retry: bool=False,
+                **kwargs) -> requests.Response:
+        """
+        Sends a request to the given path.
+        Aborts with 503 if the service is unhealthy, or if the request cannot be
+        completed in time.
+        :param method: str
+        :param path: str
+        :param retry: bool
+        :param kwargs:
+        :return: requests.Response
+        """
+        kwargs.setdefault('timeout', self._timeout)
+        attempts = 1 + (self._max_retries if retry else 0)
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                self._record(method, path, 'breaker_open')
+                self._abort_unavailable()
+            started_at = time.perf_counter()
+            try:
+                r = self._send(method, f'{self.base_url}{path}', **kwargs)
+            except requests.RequestException:
+                r = None
+            self._record(
+                method, path, 'error' if r is None else str(r.status_code),
+                time.perf_counter() - started_at
+            )
+            if r is not None and r.status_code not in self.RETRY_STATUS_CODES:
+                self.breaker.record_success()
+                return r
+            self.breaker.record_failure()
+            if attempt < attempts - 1:
+                # Exponential backoff with full jitter
+                time.sleep(random.uniform(0, self._retry_backoff * 2 ** attempt))
+        if r is not None:
+            return r
+        self._abort_unavailable()
+
+    def _abort_unavailable(self) -> None:
+        """
+        Private helper method to abort with 503, as the service is unavailable.
+        :return: None
+        """
+        abort(503, description=f'{self.name.capitalize()} unavailable')
+
+    def _record(self, method: str, path: str, outcome: str,
+                duration: Optional[float]=None) -> None:
+        """
+        Private helper method to record the metrics of a call attempt.
+        :param method: str
+        :param path: str
+        :param outcome: str
+        :param duration: float
+        :return: None
+        """
+        if self._calls is None:
+            return
+        self._calls.inc(self._service, method, path, outcome)
+        if duration is not None:
+            self._call_duration.observe(duration, self._service, method, path)
+
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Private helper method to send a request, waiting at most the pool
+        timeout for a free connection.
+        :param method: str
+        :param url: str
+        :param kwargs:
+        :return: requests.Response
+        """
+        if not self._slots.acquire(blocking=False):
+            self._pool_waits += 1
+            if not self._slots.acquire(timeout=self._pool_timeout):
+                self._pool_rejections += 1
+                abort(
+                    503,
+                    description=f'Too many pending calls to the {self.name}'
+                )
+        self._in_flight += 1
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            self._in_flight -= 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the connection pool and the circuit breaker.
+        :return: dict
+        """
+        return {
+            'pool': {
+                'size': self._pool_size,
+                'in_use': self._in_flight,
+                'waits': self._pool_waits,
+                'rejections': self._pool_rejections
+            },
+            'breaker': self.breaker.stats()
+        }
+
+
+class ServiceResponse(NamedTuple):
+    """
+    Response of a call made by an AsyncServiceClient, read in full.
+    """
+    status_code: int
+    headers: Mapping[str, str]
+    content: bytes
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ServiceUnavailable(Exception):
+    """
+    Exception raised by an AsyncServiceClient when the service is unavailable.
+    """
+
+    def __init__(self, description: str):
+        """
+        Constructor with parameter.
+        :param description: str
+        """
+        super().__init__(description)
+        self.description = description
+
+
+class AsyncServiceClient:
+    """
+    Asynchronous counterpart of a ServiceClient, for the coroutines of the ASGI
+    application.
+    It shares the configurations, the circuit breaker and the metrics of the
+    given client, so the service's health is judged by all the calls of the
+    process, and it waits on the connections and on the pool in the event loop.
+    """
+
+    def __init__(self, client: ServiceClient):
+        """
+        Constructor with parameter.
+        :param client: ServiceClient
+        """
+        self._client = client
+        self._session = None
+        self._slots = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        The HTTP session of the current event loop.
+        The session is lazily created in the running event loop, i.e., after
+        forking the workers.
+        :return: aiohttp.ClientSession
+        """
+        if self._session is None or self._session.closed:
+            client = self._client
+            connect_timeout, read_timeout = client._timeout
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=client._pool_size),
+                timeout=aiohttp.ClientTimeout(
+                    connect=connect_timeout, sock_read=read_timeout
+                )
+            )
+            self._slots = asyncio.Semaphore(client._pool_size)
+        return self._session
+
+    async def close(self) -> None:
+        """
+        Closes the HTTP session, if any.
+        :return: None
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get(self, path: str, **kwargs) -> ServiceResponse:
+        """
+        Sends a GET request to the given path.
+        :param path: str
+        :param kwargs:
+        :return: ServiceResponse
+        """
+        return await self.request('GET', path, retry=True, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> ServiceResponse:
+        """
+        Sends a POST request to the given path.
+        Since POST requests are not idempotent, they are never retried.
+        :param path: str
+        :param kwargs:
+        :return: ServiceResponse
+        """
+        return await self.request('POST', path, retry=False, **kwargs)
+
+    async def request(self, method: str, path: str, retry: bool=False,
+                      **kwargs) -> ServiceResponse:
+        """
+        Sends a request to the given path.
+        Raises ServiceUnavailable if the service is unhealthy, or if the
+        request cannot be completed in time.
+        :param method: str
+        :param path: str
+        :param retry: bool
+        :param kwargs:
+        :return: ServiceResponse
+        """
+        client = self._client
+        unavailable = ServiceUnavailable(
+            f'{client.name.capitalize()} unavailable'
+        )
+        attempts = 1 + (client._max_retries if retry else 0)
+        for attempt in range(attempts):
+            if not client.breaker.allow():
+                client._record(method, path, 'breaker_open')
+                raise unavailable
+            started_at = time.perf_counter()
+            try:
+                r = await self._send(
+                    method, f'{client.base_url}{path}', **kwargs
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                r = None
+            client._record(
+                method, path, 'error' if r is None else str(r.status_code),
+                time.perf_counter() - started_at
+            )
+            if (r is not None and
+                    r.status_code not in client.RETRY_STATUS_CODES):
+                client.breaker.record_success()
+                return r
+            client.breaker.record_failure()
+            if attempt < attempts - 1:
+                # Exponential backoff with full jitter
+                await asyncio.sleep(
+                    random.uniform(0, client._retry_backoff * 2 ** attempt)
+                )
+        if r is not None:
+            return r
+        raise unavailable
+
+    async def _send(self, method: str, url: str, **kwargs) -> ServiceResponse:
+        """
+        Private helper method to send a request, waiting at most the pool
+        timeout for a free connection.
+        :param method: str
+        :param url: str
+        :param kwargs:
+        :return: ServiceResponse
+        """
+        client = self._client
+        session = self.session
+        if self._slots.locked():
+            client._pool_waits += 1
+            try:
+                await asyncio.wait_for(
+                    self._slots.acquire(), client._pool_timeout
+                )
+            except asyncio.TimeoutError:
+                client._pool_rejections += 1
+                raise ServiceUnavailable(
+                    f'Too many pending calls to the {client.name}'
+                )
+        else:
+            await self._slots.acquire()
+        client._in_flight += 1
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                return ServiceResponse(
+                    response.status, CaseInsensitiveDict(response.headers),
+                    await response.read()
+                )
+        finally:
+            client._in_flight -= 1
+            self._slots.release()
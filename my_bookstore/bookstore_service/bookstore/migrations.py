@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+"""
+Database migrations module.
+
+The schema is managed by versioned migrations, which are applied once per
+deployment with "flask migrate", rather than by every worker process at
+startup. New migrations are appended with the next version number, and
+applied migrations are never modified.
+"""
+
+from datetime import datetime
+from typing import Callable, List, NamedTuple
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import (
+    DDL, BigInteger, Column, Date, DateTime, ForeignKey, Integer, MetaData,
+    String, Table, Text, func, inspect, select, text
+)
+from sqlalchemy.engine import Connection
+
+from . import db
+
+# Key of the advisory lock, which makes concurrent runs of the migrations wait
+# for each other (PostgreSQL only)
+_LOCK_KEY = 727401
+
+# Versions of the applied migrations, kept out of the models' metadata
+_versions = Table(
+    'bookstore_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False, default=datetime.utcnow)
+)
+
+# Tables as the migrations that create them left them, rather than the current
+# models, so that the effect of the applied migrations never changes.
+# The later changes are made with explicit DDL by the later migrations.
+_tables = MetaData()
+_authors = Table(
+    'authors', _tables,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(100), nullable=False, unique=True, index=True),
+    Column('email', String(120))
+)
+_books = Table(
+    'books', _tables,
+    Column('id', Integer, primary_key=True),
+    Column('title', String(200), nullable=False),
+    Column(
+        'author_id', Integer,
+        ForeignKey('authors.id', onupdate='CASCADE', ondelete='CASCADE'),
+        nullable=False
+    ),
+    Column('description', Text),
+    Column('date_published', Date, nullable=False)
+)
+_collection_counts = Table(
+    'collection_counts', _tables,
+    Column('name', String(50), primary_key=True),
+    Column('total', BigInteger, nullable=False)
+)
+
+
+class Migration(NamedTuple):
+    """
+    Versioned migration of the schema (and the data).
+    """
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+
+MIGRATIONS = []
+
+
+def migration(version: int, description: str) -> Callable:
+    """
+    Decorator to register the decorated function as the migration with the
+    given version.
+    :param version: int
+    :param description: str
+    :return: Callable
+    """
+    def decorator(upgrade: Callable[[Connection], None]) -> Callable:
+        assert version == len(MIGRATIONS) + 1, 'Versions must be consecutive'
+        MIGRATIONS.append(Migration(version, description, upgrade))
+        return upgrade
+
+    return decorator
+
+
+# All the migrations are idempotent, as the databases created before the
+# migrations (by "db.create_all()") already have some of their changes.
+# Only on the primary, since the replicas replicate them.
+
+
+@migration(1, 'Create the authors and books tables')
+def _create_tables(connection: Connection) -> None:
+    _authors.create(bind=connection, checkfirst=True)
+    _books.create(bind=connection, checkfirst=True)
+
+
+@migration(2, 'Seed the total counts of the authors and books')
+def _seed_collection_counts(connection: Connection) -> None:
+    _collection_counts.create(bind=connection, checkfirst=True)
+    for table in (_authors, _books):
+        seeded = connection.execute(
+            select([_collection_counts.c.name])
+            .where(_collection_counts.c.name == table.name)
+        ).first()
+        if seeded is None:
+            total = connection.execute(
+                select([func.count()]).select_from(table)
+            ).scalar()
+            connection.execute(_collection_counts.insert().values(
+                name=table.name, total=total
+            ))
+
+
+@migration(3, 'Sort the titles and names in byte order, and index the books '
+              'for filtering and sorting')
+def _add_sort_indexes(connection: Connection) -> None:
+    if connection.dialect.name == 'postgresql':
+        # Also rebuilds the indexes on the columns
+        connection.execute(text(
+            'ALTER TABLE books ALTER COLUMN title '
+            'TYPE VARCHAR(200) COLLATE "C"'
+        ))
+        connection.execute(text(
+            'ALTER TABLE authors ALTER COLUMN name '
+            'TYPE VARCHAR(100) COLLATE "C"'
+        ))
+    _create_index(connection, 'ix_books_author_id_id', 'books (author_id, id)')
+    _create_index(
+        connection, 'ix_books_author_id_date_published_id',
+        'books (author_id, date_published, id)'
+    )
+    _create_index(
+        connection, 'ix_books_author_id_title_id',
+        'books (author_id, title, id)'
+    )
+    _create_index(
+        connection, 'ix_books_date_published_id', 'books (date_published, id)'
+    )
+    _create_index(connection, 'ix_books_title_id', 'books (title, id)')
+
+
+@migration(4, 'Add the row versions and the modification times of the authors '
+              'and books')
+def _add_row_versions(connection: Connection) -> None:
+    timestamp_type = DateTime().compile(dialect=connection.dialect)
+    # The existing rows are stamped with the time of the migration.
+    now = datetime.utcnow().isoformat(' ')
+    for table in ('authors', 'books'):
+        _add_column(
+            connection, table, 'version', 'INTEGER NOT NULL DEFAULT 1'
+        )
+        added = _add_column(
+            connection, table, 'updated_at',
+            f"{timestamp_type} NOT NULL DEFAULT '{now}'"
+        )
+        if added and connection.dialect.name == 'postgresql':
+            # The modification times of the new rows are set by the models.
+            connection.execute(text(
+                f'ALTER TABLE {table} ALTER COLUMN updated_at DROP DEFAULT'
+            ))
+        _create_index(
+            connection, f'ix_{table}_updated_at', f'{table} (updated_at)'
+        )
+
+
+@migration(5, 'Add the full-text search over the books, and the fuzzy search '
+              'over the author names')
+def _add_search(connection: Connection) -> None:
+    if connection.dialect.name != 'postgresql':
+        # Without text search support, the searches fall back to substring
+        # matching, but the search documents are kept as in the models.
+        _add_column(connection, 'books', 'search_vector', 'TEXT')
+        _create_index(
+            connection, 'ix_books_search_vector', 'books (search_vector)'
+        )
+        _create_index(connection, 'ix_authors_name_trgm', 'authors (name)')
+        return
+
+    # The trigram operator classes come from the "pg_trgm" extension.
+    connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    # The title is weighted over the description when ranking search results.
+    document = """
+        setweight(to_tsvector('pg_catalog.english', coalesce({row}title, '')), 'A') ||
+        setweight(to_tsvector('pg_catalog.english', coalesce({row}description, '')), 'B')"""
+    _add_column(connection, 'books', 'search_vector', 'TSVECTOR')
+    connection.execute(text(f"""
+CREATE OR REPLACE FUNCTION books_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := {document.format(row='NEW.')};
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""))
+    # The search documents are maintained by the trigger on every write path.
+    connection.execute(text(
+        'DROP TRIGGER IF EXISTS books_search_vector_update ON books'
+    ))
+    connection.execute(text("""
+CREATE TRIGGER books_search_vector_update
+BEFORE INSERT OR UPDATE OF title, description ON books
+FOR EACH ROW EXECUTE PROCEDURE books_search_vector_update()
+"""))
+    connection.execute(text(
+        f'UPDATE books SET search_vector = {document.format(row="")} '
+        f'WHERE search_vector IS NULL'
+    ))
+    _create_index(
+        connection, 'ix_books_search_vector',
+        'books USING gin (search_vector)'
+    )
+    # Trigram index for fuzzy and prefix matching on names
+    _create_index(
+        connection, 'ix_authors_name_trgm',
+        'authors USING gin (name gin_trgm_ops)'
+    )
+
+
+def _add_column(connection: Connection, table: str, column: str,
+                definition: str) -> bool:
+    """
+    Private helper function to add the column with the given name and
+    definition to the given table, unless it already has it.
+    :param connection: Connection
+    :param table: str
+    :param column: str
+    :param definition: str
+    :return: bool
+    """
+    existing = {c['name'] for c in inspect(connection).get_columns(table)}
+    if column in existing:
+        return False
+    # As DDL, whose literals (e.g., default times) aren't parsed for binds
+    connection.execute(DDL(
+        f'ALTER TABLE {table} ADD COLUMN {column} {definition}'
+    ))
+    return True
+
+
+def _create_index(connection: Connection, name: str, definition: str) -> None:
+    """
+    Private helper function to create the index with the given name and
+    definition, unless it already exists.
+    :param connection: Connection
+    :param name: str
+    :param definition: str
+    :return: None
+    """
+    connection.execute(DDL(
+        f'CREATE INDEX IF NOT EXISTS {name} ON {definition}'
+    ))
+
+
+def migrate() -> List[Migration]:
+    """
+    Applies the pending migrations in order, each in its own transaction.
+    :return: list[Migration]
+    """
+    applied = []
+    with db.get_engine().connect() as connection:
+        postgresql = connection.dialect.name == 'postgresql'
+        if postgresql:
+            connection.execute(
+                text('SELECT pg_advisory_lock(:key)'), key=_LOCK_KEY
+            )
+        try:
+            _versions.create(bind=connection, checkfirst=True)
+            current = connection.execute(
+                select([func.max(_versions.c.version)])
+            ).scalar() or 0
+            for pending in MIGRATIONS[current:]:
+                with connection.begin():
+                    pending.upgrade(connection)
+                    connection.execute(_versions.insert().values(
+                        version=pending.version,
+                        description=pending.description
+                    ))
+                applied.append(pending)
+        finally:
+            if postgresql:
+                connection.execute(
+                    text('SELECT pg_advisory_unlock(:key)'), key=_LOCK_KEY
+                )
+    return applied
+
+
+@click.command('migrate')
+@with_appcontext
+def migrate_command() -> None:
+    """
+    Applies the pending database migrations.
+    """
+    applied = migrate()
+    for pending in applied:
+        click.echo(f'Applied migration {pending.version}: {pending.description}')
+    if not applied:
+        click.echo('The database is up to date.')
@@ -5,8 +5,11 @@ Bookstore-related models module.
 """
 
 from datetime import datetime
+from typing import Dict, Iterable, List, Set, Tuple
 
 from marshmallow import EXCLUDE, fields, post_load, validate
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import TSVECTOR
 
 from . import db, ma
 
@@ -24,16 +27,99 @@ class Author(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(
-        db.String(NAME_MAX_LEN), nullable=False, unique=True, index=True
+        db.String(NAME_MAX_LEN).with_variant(
+            db.String(NAME_MAX_LEN, collation='C'), 'postgresql'
+        ),
+        nullable=False, unique=True, index=True
     )  # Since we'll frequently query names, we create an index on it.
+    # In byte order ("C" collation), so that the index also serves the prefix
+    # matching and the sorting by name.
     email = db.Column(db.String(EMAIL_MAX_LEN))
+    # Row version and modification time, to validate cached representations
+    # and to detect concurrent modifications
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow,
+        onupdate=datetime.utcnow, index=True
+    )  # Indexed, so that the latest modification time is cheap to query.
 
     books = db.relationship(
         'Book',
-        lazy=False,
         cascade='all, delete-orphan',
-        backref=db.backref('author', lazy=False)
-    )  # Author.books and Book.author are both eager-loading.
+        backref='author'
+    )  # Author.books and Book.author are both lazy-loading, and each query
+    # chooses its own loading strategy, depending on what it needs to dump.
+
+    __table_args__ = (
+        # Trigram index for fuzzy and prefix matching on names
+        db.Index(
+            'ix_authors_name_trgm', name,
+            postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}
+        ),
+    )
+    __mapper_args__ = {'version_id_col': version}
+
+    @classmethod
+    def ensure_names(cls, names: Iterable[str]) -> Tuple[dict, Set[str]]:
+        """
+        Gets the IDs of the authors with the given names, and creates the
+        missing authors in bulk, within the current transaction.
+        :param names: iterable[str]
+        :return: tuple(dict, set[str])
+        """
+        names = set(names)
+        if not names:
+            return {}, set()
+        ids_by_name = dict(
+            db.session.query(cls.name, cls.id).filter(cls.name.in_(names))
+        )
+        missing_names = names - ids_by_name.keys()
+        if not missing_names:
+            return ids_by_name, set()
+        new_ids = cls.insert_new(
+            [{'name': name} for name in sorted(missing_names)]
+        )
+        ids_by_name.update(new_ids)
+        concurrent_names = missing_names - new_ids.keys()
+        if concurrent_names:  # Created by concurrent transactions meanwhile
+            ids_by_name.update(
+                db.session.query(cls.name, cls.id)
+                .filter(cls.name.in_(concurrent_names))
+            )
+        return ids_by_name, set(new_ids)
+
+    @classmethod
+    def insert_new(cls, rows: List[dict]) -> Dict[str, int]:
+        """
+        Inserts the authors of the given rows in bulk, within the current
+        transaction, skipping the names which already exist (e.g., created by
+        concurrent transactions), so that the unique constraint on the names
+        never fails.
+        Returns the IDs of the inserted authors by their names, and maintains
+        their total count.
+        :param rows: list[dict]
+        :return: dict{str: int}
+        """
+        table = cls.__table__
+        new_ids = {}
+        if rows and db.session.get_bind().dialect.name == 'postgresql':
+            statement = (
+                postgresql.insert(table).values(rows)
+                .on_conflict_do_nothing(index_elements=[table.c.name])
+                .returning(table.c.name, table.c.id)
+            )
+            new_ids.update(db.session.execute(statement))
+        else:
+            # Without multi-row RETURNING support, insert the rows one by one.
+            statement = table.insert().prefix_with(
+                'OR IGNORE', dialect='sqlite'
+            )
+            for row in rows:
+                result = db.session.execute(statement.values(row))
+                if result.rowcount:
+                    new_ids[row['name']] = result.inserted_primary_key[0]
+        CollectionCount.adjust(cls, len(new_ids))
+        return new_ids
 
 
 class Book(db.Model):
@@ -43,9 +129,16 @@ class Book(db.Model):
     __tablename__ = 'books'
 
     TITLE_MAX_LEN = 200
+    # Text search configuration of the search documents and queries
+    SEARCH_CONFIG = 'pg_catalog.english'
 
     id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String(TITLE_MAX_LEN), nullable=False)
+    title = db.Column(
+        db.String(TITLE_MAX_LEN).with_variant(
+            db.String(TITLE_MAX_LEN, collation='C'), 'postgresql'
+        ),
+        nullable=False
+    )  # In byte order ("C" collation), like the authors' names.
     author_id = db.Column(
         db.Integer,
         db.ForeignKey('authors.id', onupdate='CASCADE', ondelete='CASCADE'),
@@ -53,6 +146,77 @@ class Book(db.Model):
     )  # When the author is updated or deleted, all of his/her books are updated or deleted as well.
     description = db.Column(db.Text)
     date_published = db.Column(db.Date, nullable=False, default=datetime.today)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow,
+        onupdate=datetime.utcnow, index=True
+    )
+    # Full-text search document over the title and the description, which is
+    # maintained by a trigger (created by the migrations) on every write path.
+    # Deferred, since it's only needed by the search queries.
+    search_vector = db.deferred(
+        db.Column(db.Text().with_variant(TSVECTOR(), 'postgresql'))
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_books_search_vector', search_vector, postgresql_using='gin'
+        ),
+        # Composite indexes for the filters and the sorts of the collection,
+        # with the ID as the tie-breaker of the sorts.
+        # Each sort has an index in its order, and with the author's books
+        # first as well, so that the pages are read from an index scan,
+        # rather than by sorting the (filtered) table.
+        db.Index('ix_books_author_id_id', author_id, id),
+        db.Index(
+            'ix_books_author_id_date_published_id',
+            author_id, date_published, id
+        ),
+        db.Index('ix_books_author_id_title_id', author_id, title, id),
+        db.Index('ix_books_date_published_id', date_published, id),
+        db.Index('ix_books_title_id', title, id),
+    )
+    __mapper_args__ = {'version_id_col': version}
+
+
+class CollectionCount(db.Model):
+    """
+    Table of the total counts of the collections, which are maintained by the
+    write paths within the same transactions, so that the totals can be served
+    without scanning the collection tables.
+    """
+    __tablename__ = 'collection_counts'
+
+    name = db.Column(db.String(50), primary_key=True)
+    total = db.Column(db.BigInteger, nullable=False)
+
+    @classmethod
+    def adjust(cls, model: db.Model, delta: int) -> None:
+        """
+        Adjusts the total count of the given model's collection by the given
+        delta, within the current transaction.
+        :param model: db.Model
+        :param delta: int
+        :return: None
+        """
+        if delta:
+            cls.query.filter_by(name=model.__tablename__).update(
+                {cls.total: cls.total + delta}, synchronize_session=False
+            )
+
+    @classmethod
+    def get_total(cls, model: db.Model) -> int:
+        """
+        Gets the total count of the given model's collection.
+        :param model: db.Model
+        :return: int
+        """
+        total = db.session.query(cls.total).filter_by(
+            name=model.__tablename__
+        ).scalar()
+        if total is None:  # Not seeded yet
+            total = model.query.count()
+        return total
 
 
 ##### SCHEMAS #####
@@ -80,6 +244,8 @@ class AuthorSchema(ma.Schema):
 
     class Meta:
         unknown = EXCLUDE
+        # Keep the declaration order of the fields, e.g., for the CSV columns
+        ordered = True
 
     @post_load
     def post_load_process_name(self, data: dict, **kwargs) -> dict:
@@ -95,6 +261,8 @@ class AuthorSchema(ma.Schema):
 
 author_schema = AuthorSchema()
 authors_schema = AuthorSchema(many=True, only=('name', 'url_self'))
+# Exports stream the authors one row at a time, without their books.
+author_export_schema = AuthorSchema(exclude=('books',))
 
 
 class BookSchema(ma.Schema):
@@ -122,6 +290,8 @@ class BookSchema(ma.Schema):
 
     class Meta:
         unknown = EXCLUDE
+        # Keep the declaration order of the fields, e.g., for the CSV columns
+        ordered = True
 
     @post_load
     def post_load_process_title(self, data: dict, **kwargs) -> dict:
@@ -131,7 +301,8 @@ class BookSchema(ma.Schema):
         :param kwargs:
         :return: dict
         """
-        data['title'] = data['title'].strip().title()
+        if 'title' in data:  # Not in partial updates without a title
+            data['title'] = data['title'].strip().title()
         return data
 
 
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+"""
+SQL query budget module.
+"""
+
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator, List, NamedTuple, Optional
+
+from flask import Flask, current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+_RESOURCES_DIR = os.path.join(_PACKAGE_DIR, 'resources')
+
+# Parts of the statements which vary between the executions of the same query
+_IN_LIST_PATTERN = re.compile(
+    r'\(\s*(?:\?|%s|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%s|%\(\w+\)s|:\w+))*\s*\)'
+)
+_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+class QueryRecord(NamedTuple):
+    """
+    Record of an executed SQL statement.
+    """
+    statement: str
+    duration: float  # In seconds
+    origin: str  # Location in the application's code that ran it
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    Exception raised when a request (or a context of "assert_max_queries")
+    exceeds its budget of SQL statements, or when a request repeats a statement
+    like an N+1 pattern.
+    It's an AssertionError, so that the test runners report it as a failure.
+    """
+    pass
+
+
+class QueryBudget:
+    """
+    Development and test instrumentation of the SQL statements run by each
+    request:
+    * The statements of each request are counted, and checked against the
+      budget of its method and endpoint (e.g., "GET api.books"), or of its
+      endpoint for all the methods (e.g., "api.books").
+    * The statements repeated with the same shape (i.e., the same SQL apart
+      from the parameters) are flagged as N+1 patterns, like lazy loads in a
+      loop.
+    * The slowest statements are logged, together with their origin in the
+      application's code.
+    The violations are logged, or raised as QueryBudgetExceeded.
+    Locating the origin of each statement walks the stack, so this is meant to
+    be enabled in development and tests, rather than in production.
+    """
+
+    def __init__(self, app: Optional[Flask]=None):
+        """
+        Constructor with parameters.
+        :param app: Flask
+        """
+        self.enabled = False
+        self._budgets = {}
+        self._default_budget = None
+        self._repeat_threshold = 3
+        self._slow_seconds = 0.1
+        self._raise = False
+        self._listening = False
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """
+        Initializes the query budget with the given application's
+        configurations.
+        :param app: Flask
+        :return: None
+        """
+        self.enabled = app.config['SQL_BUDGET_ENABLED']
+        if not self.enabled:
+            return
+        self._budgets = dict(app.config['SQL_BUDGETS'])
+        self._default_budget = app.config['SQL_BUDGET_DEFAULT']
+        self._repeat_threshold = app.config['SQL_BUDGET_REPEAT_THRESHOLD']
+        self._slow_seconds = app.config['SQL_BUDGET_SLOW_SECONDS']
+        self._raise = app.config['SQL_BUDGET_RAISE']
+
+        app.extensions['query_budget'] = self
+        app.before_request(self._start_request)
+        app.after_request(self._check_request)
+        if not self._listening:
+            event.listen(
+                Engine, 'before_cursor_execute', self._before_cursor_execute
+            )
+            event.listen(
+                Engine, 'after_cursor_execute', self._after_cursor_execute
+            )
+            self._listening = True
+
+    @contextmanager
+    def capture(self) -> Iterator[List[QueryRecord]]:
+        """
+        Captures the SQL statements run in the current thread within the
+        context, e.g., by the requests of a test client.
+        :return: iterator[list[QueryRecord]]
+        """
+        records = []
+        captures = self._local.__dict__.setdefault('captures', [])
+        captures.append(records)
+        try:
+            yield records
+        finally:
+            captures.remove(records)
+
+    @contextmanager
+    def assert_max_queries(self, budget: int) -> Iterator[List[QueryRecord]]:
+        """
+        Asserts that at most the given number of SQL statements are run in the
+        current thread within the context, and raises QueryBudgetExceeded
+        otherwise.
+        e.g.,
+            with query_budget.assert_max_queries(2):
+                client.get('/bookstore/books', headers=headers)
+        :param budget: int
+        :return: iterator[list[QueryRecord]]
+        """
+        with self.capture() as records:
+            yield records
+        if len(records) > budget:
+            raise QueryBudgetExceeded(
+                f'{len(records)} SQL statements, over the budget of {budget}:'
+                f'\n{_describe(records)}'
+            )
+
+    def _start_request(self) -> None:
+        """
+        Private helper method to start recording the statements of the current
+        request.
+        :return: None
+        """
+        g._query_records = []
+
+    def _check_request(self, response):
+        """
+        Private helper method to check the statements of the current request
+        against its budget, and to look for N+1 patterns and slow statements.
+        :param response:
+        :return:
+        """
+        records = g.pop('_query_records', None)
+        if records is None:
+            return response
+        response.headers['X-SQL-Statements'] = str(len(records))
+        endpoint = request.endpoint or 'unmatched'
+        problems = []
+        budget = self._budgets.get(
+            f'{request.method} {endpoint}',
+            self._budgets.get(endpoint, self._default_budget)
+        )
+        if budget is not None and len(records) > budget:
+            problems.append(
+                f'{len(records)} SQL statements, over the budget of {budget}'
+            )
+        shapes = Counter(_shape(record.statement) for record in records)
+        for shape, count in shapes.items():
+            if count >= self._repeat_threshold:
+                origin = next(
+                    record.origin for record in records
+                    if _shape(record.statement) == shape
+                )
+                problems.append(
+                    f'Possible N+1: {count} statements from {origin} like '
+                    f'{shape[:300]}'
+                )
+
+        for record in sorted(records, key=lambda r: r.duration, reverse=True):
+            if record.duration < self._slow_seconds:
+                break
+            current_app.logger.warning(
+                'Slow SQL statement in %s %s (%.1f ms) from %s: %s',
+                request.method, endpoint, record.duration * 1e3, record.origin,
+                _WHITESPACE_PATTERN.sub(' ', record.statement)[:1000]
+            )
+        if problems:
+            message = f'{request.method} {endpoint}: ' + '; '.join(problems)
+            if self._raise:
+                raise QueryBudgetExceeded(message)
+            current_app.logger.warning(message)
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany) -> None:
+        """
+        Private helper method to start timing a SQL statement.
+        :return: None
+        """
+        conn.info.setdefault('_query_budget_started_at', []).append(
+            time.perf_counter()
+        )
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany) -> None:
+        """
+        Private helper method to record a SQL statement, for the current
+        request and the current captures.
+        :return: None
+        """
+        started_at = conn.info['_query_budget_started_at'].pop()
+        captures = getattr(self._local, 'captures', None)
+        in_request = (
+            has_app_context() and
+            current_app.extensions.get('query_budget') is self and
+            '_query_records' in g
+        )
+        if not (captures or in_request):
+            return
+        record = QueryRecord(
+            statement, time.perf_counter() - started_at, _origin()
+        )
+        if in_request:
+            g._query_records.append(record)
+        for records in captures or ():
+            records.append(record)
+
+
+def _shape(statement: str) -> str:
+    """
+    Private helper function to get the shape of the given SQL statement, which
+    is the same for all the executions of the same query.
+    :param statement: str
+    :return: str
+    """
+    shape = _WHITESPACE_PATTERN.sub(' ', statement).strip()
+    shape = _IN_LIST_PATTERN.sub('(?)', shape)
+    return _LITERAL_PATTERN.sub('?', shape)
+
+
+def _origin() -> str:
+    """
+    Private helper function to locate the code of the application that runs
+    the current SQL statement, preferably in the resources.
+    :return: str
+    """
+    frame = sys._getframe(2)
+    fallback = None
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_PACKAGE_DIR) and filename != __file__:
+            location = (
+                f'{os.path.relpath(filename, os.path.dirname(_PACKAGE_DIR))}:'
+                f'{frame.f_lineno} in {frame.f_code.co_name}'
+            )
+            if filename.startswith(_RESOURCES_DIR):
+                return location
+            fallback = fallback or location
+        frame = frame.f_back
+    return fallback or 'unknown'
+
+
+def _describe(records: List[QueryRecord]) -> str:
+    """
+    Private helper function to describe the given records, one per line.
+    :param records: list[QueryRecord]
+    :return: str
+    """
+    return '\n'.join(
+        f'{i}. ({record.duration * 1e3:.1f} ms, {record.origin}) '
+        f'{_WHITESPACE_PATTERN.sub(" ", record.statement)[:300]}'
+        for i, record in enumerate(records, 1)
+    )
@@ -4,12 +4,10 @@
 Authentication-related RESTful API module.
 """
 
-import requests
 from flask import g, request
 from flask_restful import Resource
 
-from .. import auth
-from ..utils import USER_SERVICE
+from .. import auth, credential_cache, user_service
 
 
 class UserList(Resource):
@@ -24,7 +22,11 @@ class UserList(Resource):
         """
         # "redirect()" cannot redirect "POST" requests, so we need to manually
         # do the redirecting.
-        r = requests.post(f'{USER_SERVICE}/users', json=request.get_json())
+        r = user_service.post('/users', json=request.get_json())
+        if r.status_code == 201:
+            # Any credentials cached for a previous user with the same username
+            # are no longer valid.
+            credential_cache.invalidate_user(request.get_json()['username'])
         return r.json(), r.status_code
 
 
@@ -44,7 +46,5 @@ class AccessToken(Resource):
         # redirecting.
 
         # After logging-in, we can access the username with "g.username"
-        r = requests.get(
-            f'{USER_SERVICE}/access-token', json={'username': g.username}
-        )
+        r = user_service.get('/access-token', json={'username': g.username})
         return r.json(), r.status_code
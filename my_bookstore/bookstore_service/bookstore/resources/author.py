@@ -4,14 +4,49 @@
 Author-related RESTful API module.
 """
 
+from datetime import datetime
+from typing import List, Tuple
+
 from flask import request
 from flask_restful import Resource
 from flask_sqlalchemy import BaseQuery
 from marshmallow import ValidationError
+from sqlalchemy import cast, func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only, selectinload
+
+from .. import auth, db, response_cache
+from ..conditional import (
+    check_if_match, commit_if_unmodified, make_etag, validator_headers
+)
+from ..fieldsets import project, requested_fields, sparse_schema
+from ..models import (
+    Author, Book, CollectionCount, author_export_schema, author_schema,
+    authors_schema
+)
+from ..serialization import dump
+from ..utils import (
+    FilterParam, SortKey, batch_response, escape_like, export_response,
+    filter_query, load_batch, paginate, read_through, requested_sort,
+    search_terms
+)
 
-from .. import auth, db
-from ..models import Author, author_schema, authors_schema
-from ..utils import paginate
+# Filters of the collection of authors
+# The names are compared in title case, in which they are stored.
+_AUTHOR_FILTERS = (
+    FilterParam(
+        'name_prefix', str.title,
+        lambda prefix: Author.name.like(
+            f'{escape_like(prefix)}%', escape='\\'
+        )
+    ),
+)
+# Sorts of the collection of authors, served by the primary key and by the
+# unique index on the names
+_AUTHOR_SORTS = {
+    'id': [SortKey(Author.id)],
+    'name': [SortKey(Author.name)]
+}
 
 
 class AuthorList(Resource):
@@ -21,13 +56,17 @@ class AuthorList(Resource):
     decorators = [auth.login_required]
 
     @paginate(authors_schema)
-    def get(self) -> BaseQuery:
+    def get(self) -> Tuple[BaseQuery, list]:
         """
-        Returns all the authors in the specified page.
-        :return: BaseQuery
+        Returns the authors in the specified page, filtered and sorted with the
+        query parameters.
+        :return: tuple(BaseQuery, list[SortKey] or None)
         """
         # For pagination, we need to return a query that hasn't run yet.
-        return Author.query
+        # "paginate" only loads the columns dumped by "authors_schema" (or by
+        # the requested fields), and loads the books only if they are dumped.
+        query = filter_query(Author.query, _AUTHOR_FILTERS)
+        return query, requested_sort(_AUTHOR_SORTS)
 
     def post(self):
         """
@@ -41,22 +80,133 @@ class AuthorList(Resource):
                 'message': e.messages
             }, 400
 
-        found_author = Author.query(name=new_author_data['name']).first()
+        found_author = Author.query.filter_by(
+            name=new_author_data['name']
+        ).first()
         if found_author:  # Found existing author
             return {
                 'status': 'Found existing author',
-                'data': author_schema.dump(found_author)
+                'data': dump(author_schema, found_author)
             }, 200
 
         new_author = Author(**new_author_data)
         db.session.add(new_author)
+        CollectionCount.adjust(Author, 1)
         db.session.commit()
+        response_cache.invalidate_lists(Author.__tablename__)
         return {
             'status': 'success',
-            'data': author_schema.dump(new_author)
+            'data': dump(author_schema, new_author)
         }, 201
 
 
+class AuthorBatch(Resource):
+    """
+    Resource for a batch of new authors.
+    """
+    decorators = [auth.login_required]
+
+    def post(self):
+        """
+        Adds a batch of new authors in a single transaction.
+        :return:
+        """
+        valid_items, errors = load_batch(author_schema)
+
+        names = [data['name'] for _, data in valid_items]
+        try:
+            existing_ids = dict(
+                db.session.query(Author.name, Author.id)
+                .filter(Author.name.in_(names))
+            )
+            rows, seen_names = [], set(existing_ids)
+            for _, data in valid_items:
+                if data['name'] not in seen_names:
+                    seen_names.add(data['name'])
+                    rows.append(
+                        {'name': data['name'], 'email': data.get('email')}
+                    )
+            # The authors created concurrently meanwhile are skipped, and found
+            # as existing ones.
+            new_ids = Author.insert_new(rows)
+            concurrent_names = {row['name'] for row in rows} - new_ids.keys()
+            if concurrent_names:
+                existing_ids.update(
+                    db.session.query(Author.name, Author.id)
+                    .filter(Author.name.in_(concurrent_names))
+                )
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return {
+                'message': 'Conflicting concurrent update. Please retry.'
+            }, 409
+        if new_ids:
+            response_cache.invalidate_lists(Author.__tablename__)
+
+        results, created_names = {}, set()
+        for i, data in valid_items:
+            name = data['name']
+            if name in new_ids and name not in created_names:
+                created_names.add(name)
+                results[i] = {'status': 'created', 'id': new_ids[name]}
+            else:
+                results[i] = {
+                    'status': 'Found existing author',
+                    'id': existing_ids.get(name, new_ids.get(name))
+                }
+        return batch_response(results, errors)
+
+
+class AuthorExport(Resource):
+    """
+    Resource for an export of all the authors.
+    """
+    decorators = [auth.login_required]
+
+    def get(self):
+        """
+        Streams all the authors, in NDJSON or CSV format.
+        :return:
+        """
+        query = Author.query.options(load_only('id', 'name')).order_by(
+            Author.id
+        )
+        return export_response(query, author_export_schema, filename='authors')
+
+
+class AuthorSearch(Resource):
+    """
+    Resource for a fuzzy search over the authors' names.
+    """
+    decorators = [auth.login_required]
+
+    @paginate(authors_schema)
+    def get(self) -> Tuple[BaseQuery, list]:
+        """
+        Returns the authors whose names are similar to, or start with the
+        search terms, the most similar first.
+        :return: tuple(BaseQuery, list[SortKey])
+        """
+        terms = search_terms()
+        query = Author.query
+        prefix_match = Author.name.ilike(
+            f'{escape_like(terms)}%', escape='\\'
+        )
+        if db.session.get_bind().dialect.name != 'postgresql':
+            # Without trigram support, fall back to prefix matching.
+            return query.filter(prefix_match), [SortKey(Author.name),
+                                                SortKey(Author.id)]
+
+        # Both the "%" similarity operator and the prefix match are served by
+        # the trigram index on the names.
+        # Cast from "real" to an exact numeric, like the ranks of the books
+        similarity = cast(func.similarity(Author.name, terms), db.Numeric)
+        query = query.filter(or_(Author.name.op('%')(terms), prefix_match))
+        return query, [SortKey(similarity, descending=True),
+                       SortKey(Author.id)]
+
+
 class AuthorItem(Resource):
     """
     Resource for a single author.
@@ -69,11 +219,28 @@ class AuthorItem(Resource):
         :param id: int
         :return:
         """
-        author = Author.query.get_or_404(id, description='Author not found')
-        return {
-            'status': 'success',
-            'data': author_schema.dump(author)
-        }
+        field_names = requested_fields(author_schema)
+        schema = sparse_schema(author_schema, field_names)
+        with_books = 'books' in schema.dump_fields
+
+        def load() -> Tuple[dict, str, datetime]:
+            query = project(Author.query, schema, extra_columns=[
+                'version', 'updated_at', 'books.version', 'books.updated_at'
+            ])
+            author = query.get_or_404(id, description='Author not found')
+            etag, last_modified = _author_validators(author, with_books)
+            if field_names is not None:
+                etag = make_etag(etag, field_names)
+            return {
+                'status': 'success',
+                'data': dump(schema, author)
+            }, etag, last_modified
+
+        # Only the full representations are cached.
+        key = None
+        if field_names is None:
+            key = response_cache.item_key('author', id)
+        return read_through(key, load)
 
     def put(self, id: int):
         """
@@ -81,7 +248,10 @@ class AuthorItem(Resource):
         :param id: int
         :return:
         """
-        author = Author.query.get_or_404(id, description='Author not found')
+        author = _author_with_books().get_or_404(
+            id, description='Author not found'
+        )
+        check_if_match(_author_validators(author)[0])
 
         try:
             author_data_updates = author_schema.load(
@@ -96,11 +266,13 @@ class AuthorItem(Resource):
             author.name = author_data_updates['name']
         if 'email' in author_data_updates:
             author.email = author_data_updates['email']
-        db.session.commit()
+        book_ids = [book.id for book in author.books]
+        commit_if_unmodified()
+        _invalidate_cached_author(id, book_ids)
         return {
             'status': 'success',
-            'data': author_schema.dump(author)
-        }
+            'data': dump(author_schema, author)
+        }, 200, validator_headers(*_author_validators(author))
 
     def delete(self, id: int):
         """
@@ -108,7 +280,67 @@ class AuthorItem(Resource):
         :param id: int
         :return:
         """
-        author = Author.query.get_or_404(id, description='Author not found')
+        # The books need to be loaded anyway to cascade the deletion.
+        author = _author_with_books().get_or_404(
+            id, description='Author not found'
+        )
+        check_if_match(_author_validators(author)[0])
+        book_ids = [book.id for book in author.books]
         db.session.delete(author)
-        db.session.commit()
+        # The author's books are deleted as well.
+        CollectionCount.adjust(Book, -len(book_ids))
+        CollectionCount.adjust(Author, -1)
+        commit_if_unmodified()
+        _invalidate_cached_author(id, book_ids)
         return '', 204
+
+
+def _author_with_books() -> BaseQuery:
+    """
+    Private helper function to make a query of authors, which loads their books
+    in a single additional "SELECT ... IN" query.
+    :return: BaseQuery
+    """
+    return Author.query.options(
+        selectinload(Author.books).load_only(
+            'id', 'title', 'version', 'updated_at'
+        )
+    )
+
+
+def _author_validators(author: Author,
+                       with_books: bool=True) -> Tuple[str, datetime]:
+    """
+    Private helper function to get the validators of the given author's
+    representation, which also contains the titles of the author's books,
+    unless the books are left out of it.
+    :param author: Author
+    :param with_books: bool
+    :return: tuple(str, datetime)
+    """
+    if not with_books:
+        etag = make_etag('author', author.id, author.version)
+        return etag, author.updated_at
+    books = author.books
+    etag = make_etag(
+        'author', author.id, author.version,
+        [(book.id, book.version) for book in books]
+    )
+    last_modified = max(
+        [author.updated_at] + [book.updated_at for book in books]
+    )
+    return etag, last_modified
+
+
+def _invalidate_cached_author(author_id: int, book_ids: List[int]) -> None:
+    """
+    Private helper function to invalidate the cached responses affected by the
+    change of the given author, including the author's books, whose
+    representations contain the author's name.
+    :param author_id: int
+    :param book_ids: list[int]
+    :return: None
+    """
+    response_cache.invalidate_items('author', [author_id])
+    response_cache.invalidate_items('book', book_ids)
+    response_cache.invalidate_lists(Author.__tablename__, Book.__tablename__)
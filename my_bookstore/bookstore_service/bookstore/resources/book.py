@@ -4,14 +4,64 @@
 Book-related RESTful API module.
 """
 
+from datetime import date, datetime
+from typing import List, Tuple
+
 from flask import request
 from flask_restful import Resource
 from flask_sqlalchemy import BaseQuery
 from marshmallow import ValidationError
+from sqlalchemy import cast, func, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
+from .. import auth, db, response_cache
+from ..conditional import (
+    check_if_match, commit_if_unmodified, make_etag, validator_headers
+)
+from ..fieldsets import project, requested_fields, sparse_schema
+from ..models import Author, Book, CollectionCount, book_schema, books_schema
+from ..serialization import dump
+from ..utils import (
+    FilterParam, SortKey, batch_response, bulk_insert, escape_like,
+    export_response, filter_query, load_batch, paginate, read_through,
+    requested_sort, search_terms
+)
 
-from .. import auth, db
-from ..models import Author, Book, book_schema, books_schema
-from ..utils import paginate
+# Filters of the collection of books
+# The titles and the names are compared in title case, in which they are
+# stored.
+_BOOK_FILTERS = (
+    FilterParam('author_id', int, lambda id: Book.author_id == id),
+    FilterParam(
+        'author_name', lambda name: name.strip().title(),
+        # Resolved with the unique index on the names, so that the books are
+        # filtered with the indexes on the author IDs.
+        lambda name: Book.author_id == select([Author.id]).where(
+            Author.name == name
+        ).as_scalar()
+    ),
+    FilterParam(
+        'published_after', date.fromisoformat,
+        lambda day: Book.date_published >= day
+    ),
+    FilterParam(
+        'published_before', date.fromisoformat,
+        lambda day: Book.date_published < day
+    ),
+    FilterParam(
+        'title_prefix', str.title,
+        lambda prefix: Book.title.like(
+            f'{escape_like(prefix)}%', escape='\\'
+        )
+    )
+)
+# Sorts of the collection of books, each served by a composite index
+_BOOK_SORTS = {
+    'id': [SortKey(Book.id)],
+    'date_published': [SortKey(Book.date_published), SortKey(Book.id)],
+    'title': [SortKey(Book.title), SortKey(Book.id)]
+}
 
 
 class BookList(Resource):
@@ -20,14 +70,17 @@ class BookList(Resource):
     """
     decorators = [auth.login_required]
 
-    @paginate(books_schema)
-    def get(self) -> BaseQuery:
+    @paginate(books_schema, depends_on=(Author,))
+    def get(self) -> Tuple[BaseQuery, list]:
         """
-        Returns all the authors.
-        :return: BaseQuery
+        Returns the books, filtered and sorted with the query parameters.
+        :return: tuple(BaseQuery, list[SortKey] or None)
         """
         # For pagination, we need to return a query that hasn't run yet.
-        return Book.query
+        # "paginate" only loads the columns dumped by "books_schema" (or by the
+        # requested fields), and joins the authors only if they are dumped.
+        query = filter_query(Book.query, _BOOK_FILTERS)
+        return query, requested_sort(_BOOK_SORTS)
 
     def post(self):
         """
@@ -41,24 +94,130 @@ class BookList(Resource):
                 'message': e.messages
             }, 400
 
-        author_name = new_book_data['author_name']
-        author = Author.query.filter_by(name=author_name)
-        if not author:
+        author_name = new_book_data.pop('author_name')
+        author = Author.query.filter_by(name=author_name).first()
+        new_author = author is None
+        if new_author:
             # Create a new author
-            new_author = Author(name=author_name)
+            author = Author(name=author_name)
             # In order to get the assigned ID of the new author, we need to
-            # commit the transaction.
-            db.session.add(new_author)
-            db.session.commit()
+            # flush it to the database, within the same transaction.
+            db.session.add(author)
+            db.session.flush()
+            CollectionCount.adjust(Author, 1)
 
         new_book_data['author_id'] = author.id
         new_book = Book(**new_book_data)
         db.session.add(new_book)
+        CollectionCount.adjust(Book, 1)
         db.session.commit()
+        _invalidate_cached_books(
+            [], [new_book_data['author_id']], authors_changed=new_author
+        )
         return {
             'status': 'success',
-            'data': book_schema.dump(new_book)
+            'data': dump(book_schema, new_book)
+        }
+
+
+class BookBatch(Resource):
+    """
+    Resource for a batch of new books.
+    """
+    decorators = [auth.login_required]
+
+    def post(self):
+        """
+        Adds a batch of new books, together with their missing authors, in a
+        single transaction.
+        :return:
+        """
+        valid_items, errors = load_batch(book_schema)
+
+        today = date.today()
+        try:
+            # The missing authors are created without conflicting with the
+            # concurrent transactions.
+            author_ids, new_author_names = Author.ensure_names(
+                data['author_name'] for _, data in valid_items
+            )
+            rows = [
+                {
+                    'title': data['title'],
+                    'author_id': author_ids[data['author_name']],
+                    'description': data.get('description'),
+                    'date_published': data.get('date_published', today)
+                }
+                for _, data in valid_items
+            ]
+            new_ids = bulk_insert(Book, rows)
+            CollectionCount.adjust(Book, len(rows))
+            db.session.commit()
+        except IntegrityError:  # e.g., an author was deleted concurrently
+            db.session.rollback()
+            return {
+                'message': 'Conflicting concurrent update. Please retry.'
+            }, 409
+        _invalidate_cached_books(
+            [], [row['author_id'] for row in rows],
+            authors_changed=bool(new_author_names)
+        )
+
+        results = {
+            i: {'status': 'created', 'id': new_id}
+            for (i, _), new_id in zip(valid_items, new_ids)
         }
+        return batch_response(results, errors)
+
+
+class BookExport(Resource):
+    """
+    Resource for an export of all the books.
+    """
+    decorators = [auth.login_required]
+
+    def get(self):
+        """
+        Streams all the books, in NDJSON or CSV format.
+        :return:
+        """
+        query = Book.query.options(
+            joinedload(Book.author, innerjoin=True).load_only('id', 'name')
+        ).order_by(Book.id)
+        return export_response(query, book_schema, filename='books')
+
+
+class BookSearch(Resource):
+    """
+    Resource for a full-text search over the books.
+    """
+    decorators = [auth.login_required]
+
+    @paginate(books_schema, depends_on=(Author,))
+    def get(self) -> Tuple[BaseQuery, list]:
+        """
+        Returns the books matching the search terms, the most relevant first.
+        :return: tuple(BaseQuery, list[SortKey])
+        """
+        terms = search_terms()
+        query = Book.query
+        if db.session.get_bind().dialect.name != 'postgresql':
+            # Without text search support, fall back to substring matching.
+            pattern = f'%{escape_like(terms)}%'
+            query = query.filter(or_(
+                Book.title.ilike(pattern, escape='\\'),
+                Book.description.ilike(pattern, escape='\\')
+            ))
+            return query, [SortKey(Book.id)]
+
+        # The "@@" match is served by the GIN index on the search documents.
+        ts_query = func.plainto_tsquery(Book.SEARCH_CONFIG, terms)
+        # The rank is cast from "real" to an exact numeric, so that it
+        # round-trips through the cursors and can be compared for equality.
+        rank = cast(func.ts_rank(Book.search_vector, ts_query), db.Numeric)
+        query = query.filter(Book.search_vector.op('@@')(ts_query))
+        return query, [SortKey(rank, descending=True),
+                       SortKey(Book.id)]
 
 
 class BookItem(Resource):
@@ -73,11 +232,28 @@ class BookItem(Resource):
         :param id: int
         :return:
         """
-        book = Book.query.get_or_404(id, description='Book not found')
-        return {
-            'status': 'success',
-            'data': book_schema.dump(book)
-        }
+        field_names = requested_fields(book_schema)
+        schema = sparse_schema(book_schema, field_names)
+        with_author = 'author' in schema.dump_fields
+
+        def load() -> Tuple[dict, str, datetime]:
+            query = project(Book.query, schema, extra_columns=[
+                'version', 'updated_at', 'author.version', 'author.updated_at'
+            ])
+            book = query.get_or_404(id, description='Book not found')
+            etag, last_modified = _book_validators(book, with_author)
+            if field_names is not None:
+                etag = make_etag(etag, field_names)
+            return {
+                'status': 'success',
+                'data': dump(schema, book)
+            }, etag, last_modified
+
+        # Only the full representations are cached.
+        key = None
+        if field_names is None:
+            key = response_cache.item_key('book', id)
+        return read_through(key, load)
 
     def put(self, id: int):
         """
@@ -85,24 +261,28 @@ class BookItem(Resource):
         :param id: int
         :return:
         """
-        book = Book.query.get_or_404(id, description='Book not found')
+        book = _book_with_author().get_or_404(id, description='Book not found')
+        check_if_match(_book_validators(book)[0])
 
         try:
-            book_data_updates = book_schema.load(request.get_json())
+            book_data_updates = book_schema.load(
+                request.get_json(), partial=True
+            )
         except ValidationError as e:
             return {
                 'message': e.messages
-            }
+            }, 400
 
         if 'title' in book_data_updates:
             book.title = book_data_updates['title']
         if 'description' in book_data_updates:
             book.description = book_data_updates['description']
-        db.session.commit()
+        commit_if_unmodified()
+        _invalidate_cached_books([book.id], [book.author_id])
         return {
             'status': 'success',
-            'data': book_schema.dump(book)
-        }
+            'data': dump(book_schema, book)
+        }, 200, validator_headers(*_book_validators(book))
 
     def delete(self, id: int):
         """
@@ -110,7 +290,62 @@ class BookItem(Resource):
         :param id: int
         :return:
         """
-        book = Book.query.get_or_404(id, description='Book not found')
+        book = _book_with_author().get_or_404(id, description='Book not found')
+        check_if_match(_book_validators(book)[0])
+        author_id = book.author_id
         db.session.delete(book)
-        db.session.commit()
+        CollectionCount.adjust(Book, -1)
+        commit_if_unmodified()
+        _invalidate_cached_books([id], [author_id])
         return '', 204
+
+
+def _book_with_author() -> BaseQuery:
+    """
+    Private helper function to make a query of books, which loads their authors
+    in the same query.
+    Since a book has a single author, joining is cheaper than an additional
+    "SELECT ... IN" query.
+    :return: BaseQuery
+    """
+    return Book.query.options(
+        joinedload(Book.author, innerjoin=True).load_only(
+            'id', 'name', 'version', 'updated_at'
+        )
+    )
+
+
+def _book_validators(book: Book,
+                     with_author: bool=True) -> Tuple[str, datetime]:
+    """
+    Private helper function to get the validators of the given book's
+    representation, which also contains its author's name, unless the author
+    is left out of it.
+    :param book: Book
+    :param with_author: bool
+    :return: tuple(str, datetime)
+    """
+    if not with_author:
+        return make_etag('book', book.id, book.version), book.updated_at
+    author = book.author
+    etag = make_etag('book', book.id, book.version, author.id, author.version)
+    return etag, max(book.updated_at, author.updated_at)
+
+
+def _invalidate_cached_books(book_ids: List[int], author_ids: List[int],
+                             authors_changed: bool=False) -> None:
+    """
+    Private helper function to invalidate the cached responses affected by the
+    changes of the given books, including their authors, whose representations
+    contain the titles of their books.
+    :param book_ids: list[int]
+    :param author_ids: list[int]
+    :param authors_changed: bool
+    :return: None
+    """
+    response_cache.invalidate_items('book', book_ids)
+    response_cache.invalidate_items('author', author_ids)
+    namespaces = [Book.__tablename__]
+    if authors_changed:
+        namespaces.append(Author.__tablename__)
+    response_cache.invalidate_lists(*namespaces)
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+"""
+Read-replica routing module.
+"""
+
+import itertools
+import os
+import threading
+import time
+from typing import Optional
+
+from flask import Flask, g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm, text
+from sqlalchemy.engine import Engine
+
+# Methods of the requests that never write, and can be served by replicas
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+# Replication lag of a replica, in seconds: 0 on a primary, or when the replica
+# has replayed all the WAL it received (even if the primary has been idle since
+# the last replayed transaction), and otherwise the age of the last replayed
+# transaction.
+_LAG_QUERY = (
+    'SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 '
+    'WHEN {receive}() IS NOT DISTINCT FROM {replay}() THEN 0 '
+    'ELSE COALESCE('
+    'EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0'
+    ') END'
+)
+# The WAL functions were renamed in PostgreSQL 10.
+_WAL_LAG_QUERY = text(_LAG_QUERY.format(
+    receive='pg_last_wal_receive_lsn', replay='pg_last_wal_replay_lsn'
+))
+_XLOG_LAG_QUERY = text(_LAG_QUERY.format(
+    receive='pg_last_xlog_receive_location',
+    replay='pg_last_xlog_replay_location'
+))
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session which routes the reads of safe requests to a replica, and
+    everything else to the primary.
+    """
+
+    def __init__(self, db: 'RoutingSQLAlchemy', **options):
+        """
+        Constructor with parameters.
+        :param db: RoutingSQLAlchemy
+        :param options:
+        """
+        super().__init__(db, **options)
+        self._db = db
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing:
+            replica = self._db.router.replica_for_request()
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy extension, whose sessions route the reads to the
+    configured read replicas.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.router = ReplicaRouter(self)
+        super().__init__(*args, **kwargs)
+
+    def init_app(self, app: Flask) -> None:
+        super().init_app(app)
+        self.router.init_app(app)
+
+    def create_session(self, options: dict) -> orm.sessionmaker:
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class _Replica:
+    """
+    Read replica, and its health.
+    """
+
+    def __init__(self, name: str):
+        """
+        Constructor with parameters.
+        :param name: str
+        """
+        self.name = name
+        self.healthy = False  # Out of rotation until its first check
+        self.lag = 0.0
+        self.lag_query = None  # Depends on the server version
+        self.error = None
+
+
+class ReplicaRouter:
+    """
+    Router of the reads to the read replicas, which are the configured binds
+    of Flask-SQLAlchemy.
+    * The sessions of safe requests (GET/HEAD/OPTIONS) read from a single
+      replica for the whole request, chosen round-robin or by least
+      connections. All the other sessions use the primary.
+    * After a successful write request, the client is told with a cookie to
+      stick to the primary for a while, so that it reads its own writes despite
+      the replication lag. Clients can also ask for the primary with a header.
+    * The replicas are periodically checked in the background, and the ones
+      that are down or lagging behind the threshold are taken out of rotation
+      until they recover. Without any replica in rotation, the reads go to the
+      primary.
+    """
+
+    ROUND_ROBIN = 'round_robin'
+    LEAST_CONNECTIONS = 'least_connections'
+
+    def __init__(self, db: SQLAlchemy):
+        """
+        Constructor with parameters.
+        :param db: SQLAlchemy
+        """
+        self._db = db
+        self._app = None
+        self._replicas = []
+        self._strategy = self.ROUND_ROBIN
+        self._max_lag = 10.0
+        self._check_interval = 5.0
+        self._sticky_header = ''
+        self._sticky_cookie = ''
+        self._sticky_seconds = 0
+        self._round_robin = itertools.count()
+        self._checker_pid = None
+        self._lock = threading.Lock()
+        self._counters = {'primary_reads': 0, 'replica_reads': 0}
+
+    def init_app(self, app: Flask) -> None:
+        """
+        Initializes the router with the given application's configurations.
+        :param app: Flask
+        :return: None
+        """
+        self._app = app
+        self._replicas = [
+            _Replica(name) for name in app.config['SQLALCHEMY_REPLICA_BINDS']
+        ]
+        self._strategy = app.config['SQLALCHEMY_REPLICA_STRATEGY']
+        self._max_lag = app.config['SQLALCHEMY_REPLICA_MAX_LAG']
+        self._check_interval = app.config['SQLALCHEMY_REPLICA_CHECK_INTERVAL']
+        self._sticky_header = app.config['READ_YOUR_WRITES_HEADER']
+        self._sticky_cookie = app.config['READ_YOUR_WRITES_COOKIE']
+        self._sticky_seconds = app.config['READ_YOUR_WRITES_SECONDS']
+        if self._replicas:
+            app.after_request(self._stick_writers_to_primary)
+
+    def replica_for_request(self) -> Optional[Engine]:
+        """
+        Gets the engine of the replica that the current request reads from, or
+        None if it should use the primary.
+        The replica is chosen once per request.
+        :return: Engine or None
+        """
+        if not self._replicas or not has_request_context():
+            return None
+        if self._checker_pid != os.getpid():
+            self._start_checker()
+        if '_replica_engine' not in g:
+            replica = None
+            if not self._needs_primary():
+                replica = self._choose()
+            g._replica_engine = replica and self._engine(replica)
+            with self._lock:
+                if replica is None:
+                    self._counters['primary_reads'] += 1
+                else:
+                    self._counters['replica_reads'] += 1
+        return g._replica_engine
+
+    def stats(self) -> dict:
+        """
+        Returns the routing counters and the health of the replicas.
+        :return: dict
+        """
+        with self._lock:
+            stats = dict(self._counters)
+        stats['replicas'] = {
+            replica.name: {
+                'healthy': replica.healthy,
+                'lag': replica.lag,
+                'error': replica.error
+            }
+            for replica in self._replicas
+        }
+        return stats
+
+    def _needs_primary(self) -> bool:
+        """
+        Private helper method to check whether the current request needs to
+        use the primary.
+        :return: bool
+        """
+        if request.method not in SAFE_METHODS:
+            return True
+        if request.headers.get(self._sticky_header, '').lower() == 'true':
+            return True
+        return self._sticky_cookie in request.cookies
+
+    def _choose(self) -> Optional[_Replica]:
+        """
+        Private helper method to choose a replica in rotation.
+        :return: _Replica or None
+        """
+        candidates = [replica for replica in self._replicas if replica.healthy]
+        if not candidates:
+            return None
+        if self._strategy == self.LEAST_CONNECTIONS:
+            return min(
+                candidates,
+                key=lambda replica: self._engine(replica).pool.checkedout()
+            )
+        return candidates[next(self._round_robin) % len(candidates)]
+
+    def _start_checker(self) -> None:
+        """
+        Private helper method to start checking the replicas periodically in
+        the background, so that the requests never wait for the checks.
+        Threads don't survive forking, so the checker is lazily started in each
+        worker process. Under gevent, the thread is a greenlet.
+        :return: None
+        """
+        with self._lock:
+            if self._checker_pid == os.getpid():
+                return
+            self._checker_pid = os.getpid()
+
+        def check_periodically() -> None:
+            while True:
+                for replica in self._replicas:
+                    self._check(replica)
+                time.sleep(self._check_interval)
+
+        threading.Thread(target=check_periodically, daemon=True).start()
+
+    def _check(self, replica: _Replica) -> None:
+        """
+        Private helper method to check the health and the lag of the given
+        replica.
+        :param replica: _Replica
+        :return: None
+        """
+        try:
+            with self._engine(replica).connect() as connection:
+                if replica.lag_query is None:
+                    version = int(connection.execute(
+                        text('SHOW server_version_num')
+                    ).scalar())
+                    replica.lag_query = (
+                        _WAL_LAG_QUERY if version >= 100000
+                        else _XLOG_LAG_QUERY
+                    )
+                replica.lag = float(
+                    connection.execute(replica.lag_query).scalar()
+                )
+            replica.healthy = replica.lag <= self._max_lag
+            replica.error = None
+        except Exception as e:  # Any failure takes it out of rotation
+            replica.healthy = False
+            replica.error = str(e)
+
+    def _engine(self, replica: _Replica) -> Engine:
+        """
+        Private helper method to get the engine of the given replica.
+        :param replica: _Replica
+        :return: Engine
+        """
+        return self._db.get_engine(self._app, bind=replica.name)
+
+    def _stick_writers_to_primary(self, response):
+        """
+        Private helper method to tell the client of a successful write request
+        to read from the primary for a while.
+        :param response:
+        :return:
+        """
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            response.set_cookie(
+                self._sticky_cookie, '1', max_age=self._sticky_seconds,
+                httponly=True
+            )
+        return response
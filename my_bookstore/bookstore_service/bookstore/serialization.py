@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fast serialization module.
+
+The responses are serialized with dumpers compiled from the marshmallow
+schemas, which produce exactly the same output as the schemas, but without
+marshmallow's per-field overhead, and with the URLs built from templates
+rather than with a full "url_for()" per object.
+"""
+
+import datetime
+import json
+import re
+import weakref
+from typing import Any, Callable, List, Optional
+
+from flask import current_app, g, make_response, url_for
+from flask_marshmallow import Schema
+from flask_marshmallow.fields import URLFor
+from marshmallow import fields, missing
+from marshmallow.decorators import POST_DUMP, PRE_DUMP
+
+# Compiled dumpers of the schema instances, whose fields (and their order)
+# depend on the "only" and "exclude" options of each instance
+_dumpers = weakref.WeakKeyDictionary()
+
+# Template parameters of "URLFor" fields, like "<id>"
+URL_PARAM_PATTERN = re.compile(r'^<(\S+)>$')
+# Placeholder values of the template parameters when building URL templates
+_URL_PLACEHOLDER_BASE = 987654321000
+
+# The responses never contain reference cycles, so the encoder can skip the
+# bookkeeping to detect them, while producing the same output.
+_json_encoder = json.JSONEncoder(check_circular=False)
+
+
+def dump(schema: Schema, obj: Any) -> Any:
+    """
+    Serializes the given object (or objects, with a "many" schema) with the
+    given schema, through its compiled dumper.
+    :param schema: Schema
+    :param obj: Any
+    :return: Any
+    """
+    dumper = _dumpers.get(schema)
+    if dumper is None:
+        dumper = _dumpers[schema] = _compile(schema)
+    if schema.many:
+        return [dumper(item) for item in obj]
+    return dumper(obj)
+
+
+def output_json(data: Any, code: int, headers: Optional[dict]=None):
+    """
+    Makes a JSON response, as the representation of the flask_restful API.
+    The output is the same as flask_restful's default representation.
+    :param data: Any
+    :param code: int
+    :param headers: dict
+    :return:
+    """
+    settings = current_app.config.get('RESTFUL_JSON', {})
+    if current_app.debug:
+        settings.setdefault('indent', 4)
+        settings.setdefault('sort_keys', False)
+    if settings:
+        dumped = json.dumps(data, **settings).encode('utf-8')
+    else:
+        dumped = encode_json(data)
+    # Always end the JSON document with a new line, like flask_restful
+    resp = make_response(dumped + b'\n', code)
+    resp.headers.extend(headers or {})
+    return resp
+
+
+def encode_json(data: Any) -> bytes:
+    """
+    Encodes the given data into a JSON document, byte for byte like
+    "json.dumps()" with its default settings.
+    :param data: Any
+    :return: bytes
+    """
+    # The non-ASCII characters are escaped, so the document is ASCII.
+    return _json_encoder.encode(data).encode('ascii')
+
+
+def _compile(schema: Schema) -> Callable[[Any], dict]:
+    """
+    Private helper function to compile the dumper of a single object with the
+    given schema.
+    Schemas with dump processors fall back to marshmallow.
+    :param schema: Schema
+    :return: Callable
+    """
+    if schema._has_processors(PRE_DUMP) or schema._has_processors(POST_DUMP):
+        return lambda obj: schema.dump(obj, many=False)
+
+    getters = [
+        (field.data_key or name, _compile_field(schema, name, field))
+        for name, field in schema.dump_fields.items()
+    ]
+
+    def dumper(obj: Any) -> dict:
+        result = {}
+        for key, getter in getters:
+            value = getter(obj)
+            if value is not missing:
+                result[key] = value
+        return result
+
+    return dumper
+
+
+def _compile_field(schema: Schema, name: str,
+                   field: fields.Field) -> Callable[[Any], Any]:
+    """
+    Private helper function to compile the getter of the serialized value of
+    the given field, from an object.
+    The field types that are not known to be safe to compile fall back to
+    marshmallow.
+    :param schema: Schema
+    :param name: str
+    :param field: Field
+    :return: Callable
+    """
+    if isinstance(field, URLFor):
+        return _compile_url(field)
+
+    attribute = field.attribute or name
+    plain = '.' not in attribute and field.default is missing
+    field_type = type(field)
+    if plain and field_type in (fields.String, fields.Email):
+        return _none_or(attribute, str)
+    if plain and field_type is fields.Integer and not field.as_string:
+        return _none_or(attribute, int)
+    if plain and field_type is fields.Date and field.format in (None, 'iso'):
+        return _none_or(attribute, datetime.date.isoformat)
+    if plain and field_type is fields.Nested:
+        nested_schema = field.schema
+        many = nested_schema.many or field.many
+        nested_dumper = _compile(nested_schema)
+
+        def get_nested(obj: Any) -> Any:
+            value = getattr(obj, attribute)
+            if value is None:
+                return None
+            if many:
+                return [nested_dumper(item) for item in value]
+            return nested_dumper(value)
+
+        return get_nested
+
+    def get_field(obj: Any) -> Any:
+        return field.serialize(name, obj, accessor=schema.get_attribute)
+
+    return get_field
+
+
+def _none_or(attribute: str, convert: Callable) -> Callable[[Any], Any]:
+    """
+    Private helper function to make the getter of the given attribute, which
+    converts it unless it's None.
+    :param attribute: str
+    :param convert: Callable
+    :return: Callable
+    """
+    def get(obj: Any) -> Any:
+        value = getattr(obj, attribute)
+        return None if value is None else convert(value)
+
+    return get
+
+
+def _compile_url(field: URLFor) -> Callable[[Any], Optional[str]]:
+    """
+    Private helper function to compile the getter of the URL of an object with
+    the given "URLFor" field.
+    The URL is built from a template of the current request, in which only the
+    integer attributes of the object need to be filled in.
+    :param field: URLFor
+    :return: Callable
+    """
+    attributes = {}
+    for name, value in field.params.items():
+        match = URL_PARAM_PATTERN.match(str(value))
+        if match:
+            attributes[name] = match.group(1)
+
+    def get_url(obj: Any) -> Optional[str]:
+        values = []
+        for name, attribute in attributes.items():
+            value = getattr(obj, attribute)
+            if value is None:
+                return None
+            if type(value) is not int:  # Not templated
+                return field.serialize(name, obj)
+            values.append(value)
+        parts = _url_template(field, attributes)
+        if parts is None:
+            return field.serialize(None, obj)
+        url = [parts[0]]
+        for value, part in zip(values, parts[1:]):
+            url.append(str(value))
+            url.append(part)
+        return ''.join(url)
+
+    return get_url
+
+
+def _url_template(field: URLFor, attributes: dict) -> Optional[List[str]]:
+    """
+    Private helper function to get the template of the URLs of the given
+    "URLFor" field for the current request, as the literal parts around the
+    templated attributes.
+    Returns None if the URLs cannot be templated.
+    :param field: URLFor
+    :param attributes: dict
+    :return: list[str] or None
+    """
+    templates = g.setdefault('_url_templates', {})
+    key = id(field)
+    if key not in templates:
+        params = dict(field.params)
+        placeholders = []
+        for i, name in enumerate(attributes):
+            placeholder = str(_URL_PLACEHOLDER_BASE + i)
+            params[name] = int(placeholder)
+            placeholders.append(placeholder)
+        url = url_for(field.endpoint, **params)
+        templates[key] = _split_url(url, placeholders)
+    return templates[key]
+
+
+def _split_url(url: str,
+               placeholders: List[str]) -> Optional[List[str]]:
+    """
+    Private helper function to split the given URL around the given
+    placeholders, which must appear once each and in order.
+    :param url: str
+    :param placeholders: list[str]
+    :return: list[str] or None
+    """
+    parts = []
+    for placeholder in placeholders:
+        if url.count(placeholder) != 1:
+            return None
+        head, url = url.split(placeholder)
+        parts.append(head)
+    parts.append(url)
+    return parts
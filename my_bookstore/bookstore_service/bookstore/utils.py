@@ -4,16 +4,52 @@
 Utility functions.
 """
 
+import base64
+import csv
 import functools
-import requests
-from typing import Callable
+import io
+import json
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+)
 
-from flask import g, request, url_for
+from flask import (
+    Response, abort, current_app, g, make_response, request,
+    stream_with_context, url_for
+)
 from flask_marshmallow import Schema
+from flask_sqlalchemy import BaseQuery, Pagination
+from itsdangerous import (
+    BadSignature, SignatureExpired,
+    TimedJSONWebSignatureSerializer as Serializer
+)
+from marshmallow import ValidationError, fields
+from sqlalchemy import and_, func, inspect, or_, select, tuple_
+from werkzeug.urls import url_encode
 
-from . import auth
+from . import auth, credential_cache, db, response_cache, user_service
+from .conditional import is_not_modified, make_etag, validator_headers
+from .fieldsets import (
+    dumped_models, project, requested_fields, sparse_schema
+)
+from .models import CollectionCount
+from .serialization import dump
 
-USER_SERVICE = 'http://auth_service:8000'
+# Query parameters controlling the pagination
+PAGINATION_PARAMS = frozenset(['page', 'per_page', 'cursor', 'count'])
+
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+EXPORT_CHUNK_ROWS = 100  # Number of rows sent in each chunk of an export
+
+# WSGI environment key of the outcome of the credentials' verification, when
+# it's done by a coroutine of the ASGI application before the request is
+# handled, as a tuple (username or token, password, auth_service's response)
+USER_AUTH_ENVIRON_KEY = 'bookstore.user_auth'
 
 
 # If we want to use "auth.login_required" decorator on routes, we need to
@@ -29,75 +65,817 @@ def verify_password_or_access_token(username_or_token: str,
     :param password: str
     :return: bool
     """
-    r = requests.get(
-        f'{USER_SERVICE}/user-auth',
-        json={
-            'username_or_token': username_or_token,
-            'password': password
-        }
-    )
-    if r.status_code == 401:
-        return False
+    if current_app.config['LOCAL_TOKEN_VERIFICATION']:
+        username = verify_access_token_locally(
+            username_or_token, current_app.config['ACCESS_TOKEN_SECRET_KEY']
+        )
+        if username is not None:
+            g.username = username
+            return True
+
+    # Recently verified credentials are resolved without calling auth_service
+    username = credential_cache.get(username_or_token, password)
+    if username is None:
+        verified = request.environ.get(USER_AUTH_ENVIRON_KEY)
+        if verified is not None and verified[:2] == (username_or_token,
+                                                     password):
+            r = verified[2]
+        else:
+            r = user_service.get(
+                '/user-auth',
+                json={
+                    'username_or_token': username_or_token,
+                    'password': password
+                },
+                # For auth_service to throttle the failed attempts per IP
+                headers={'X-Forwarded-For': request.remote_addr}
+            )
+        if r.status_code == 401:
+            return False
+        if r.status_code == 429:  # Too many failed attempts
+            abort(make_response(
+                {'message': r.json()['message']}, 429,
+                {'Retry-After': r.headers.get('Retry-After', '60')}
+            ))
+        if r.status_code != 200:
+            abort(503, description='Authentication service unavailable')
+        username = r.json()['data']
+        credential_cache.set(username_or_token, password, username)
     # Save the found username for the current request processing
-    g.username = r.json()['data']
+    g.username = username
     return True
 
 
-def paginate(collection_schema: Schema, max_per_page: int=10) -> Callable:
+@functools.lru_cache(maxsize=None)
+def _token_serializer(secret_key: str) -> Serializer:
+    """
+    Private helper function to get the serializer to verify access tokens with
+    the given key.
+    :param secret_key: str
+    :return: Serializer
+    """
+    return Serializer(secret_key=secret_key)
+
+
+def verify_access_token_locally(access_token: str,
+                                secret_key: str) -> Optional[str]:
+    """
+    Verifies the given access token with the given key shared with
+    auth_service, without any network call or database query.
+    :param access_token: str
+    :param secret_key: str
+    :return: str or None
+    """
+    serializer = _token_serializer(secret_key)
+    try:
+        data = serializer.loads(access_token)
+    except SignatureExpired:  # Valid access token, but expired
+        return None
+    except BadSignature:  # Invalid access token, or actually a username
+        return None
+    # Access tokens issued before the username was put in the claims can only
+    # be verified by auth_service.
+    return data.get('username')
+
+
+class SortKey(NamedTuple):
+    """
+    Key to sort a collection by, which is either a column or a SQL expression.
+    """
+    expression: Any
+    descending: bool = False
+
+    @property
+    def python_type(self) -> Optional[type]:
+        """
+        The Python type of the key's values, if known.
+        :return: type or None
+        """
+        try:
+            return self.expression.type.python_type
+        except NotImplementedError:
+            return None
+
+    def ordering(self, reverse: bool=False):
+        """
+        Gets the ORDER BY clause element of the key.
+        :param reverse: bool
+        :return:
+        """
+        if self.descending != reverse:
+            return self.expression.desc()
+        return self.expression.asc()
+
+
+class FilterParam(NamedTuple):
+    """
+    Query parameter to filter a collection by, whose value is parsed with the
+    given function, and turned into the filter criterion with the other one.
+    """
+    name: str
+    parse: Callable[[str], Any]
+    criterion: Callable[[Any], Any]
+
+
+def filter_query(query: BaseQuery,
+                 filter_params: Iterable[FilterParam]) -> BaseQuery:
+    """
+    Filters the given query with the given filter parameters that the current
+    request gives, and aborts with 400 if any of their values is invalid.
+    :param query: BaseQuery
+    :param filter_params: iterable[FilterParam]
+    :return: BaseQuery
+    """
+    for param in filter_params:
+        value = request.args.get(param.name)
+        if value is None:
+            continue
+        try:
+            parsed = param.parse(value)
+        except ValueError:
+            abort(400, description=f'Invalid "{param.name}": {value}')
+        query = query.filter(param.criterion(parsed))
+    return query
+
+
+def requested_sort(
+        sorts: Dict[str, List[SortKey]]) -> Optional[List[SortKey]]:
+    """
+    Gets the sort keys of the sort given by the current request's "sort" query
+    parameter, among the given sorts, prefixed with "-" for the descending
+    order.
+    Returns None if the parameter is not given, and aborts with 400 if the sort
+    is unknown.
+    :param sorts: dict{str: list[SortKey]}
+    :return: list[SortKey] or None
+    """
+    param = request.args.get('sort')
+    if param is None:
+        return None
+    descending = param.startswith('-')
+    sort_keys = sorts.get(param[1:] if descending else param)
+    if sort_keys is None:
+        abort(
+            400,
+            description=f'Unknown sort: {param}. Must be one of: '
+                        f'{", ".join(sorted(sorts))}, optionally prefixed '
+                        f'with "-"'
+        )
+    return [
+        SortKey(key.expression, key.descending != descending)
+        for key in sort_keys
+    ]
+
+
+def paginate(collection_schema: Schema, max_per_page: int=10,
+             depends_on: Tuple[db.Model, ...]=()) -> Callable:
     """
     Pagination decorator, with the collections serialized using the given
     collection schema.
+    By default, the collections are paginated by page number. If the "cursor"
+    query parameter is given, they are paginated by cursor instead.
+    The decorated view returns the query of the collection, and optionally the
+    list of SortKey to order it by. The query only loads the columns and the
+    relationships dumped by the collection schema, restricted to the fields
+    given by the "fields" query parameter, if any.
+    The pages are validated with weak ETags and Last-Modified dates, derived
+    from the collection's total count and latest modification time, as well as
+    those of the given models that the representation depends on.
     :param collection_schema: Schema
     :param max_per_page: int
+    :param depends_on: tuple(db.Model)
     :return: Callable
     """
     def decorator(f: Callable) -> Callable:
 
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
-            page = request.args.get('page', type=int, default=1)
             per_page = min(
                 request.args.get('per_page', type=int, default=10), max_per_page
             )
+            if per_page < 1:
+                abort(404)
+            schema = sparse_schema(
+                collection_schema, requested_fields(collection_schema)
+            )
 
             query = f(*args, **kwargs)
-            p = query.paginate(page, per_page)
-            # "p" is a Pagination object.
-
-            # Populate the pagination metadata
-            pagination_meta = {
-                'page': page,
-                'per_page': per_page,
-                'pages': p.pages,
-                'total': p.total
-            }
-            if p.has_prev:
-                pagination_meta['prev'] = url_for(
-                    request.endpoint, page=p.prev_num, per_page=per_page,
-                    _external=True
+            # The view can also return the sort keys along with the query.
+            sort_keys = None
+            if isinstance(query, tuple):
+                query, sort_keys = query
+            query = project(query, schema)
+            # The pages also depend on the models of the nested objects that
+            # they dump (e.g., with "?fields=books.title").
+            dependencies = tuple(depends_on) + tuple(
+                model for model in dumped_models(_query_model(query), schema)
+                if model not in depends_on
+            )
+
+            # The cached pages are invalidated by the changes of the tables
+            # that they depend on.
+            namespaces = [_query_model(query).__tablename__] + [
+                model.__tablename__ for model in dependencies
+            ]
+            cache_key = response_cache.list_key(namespaces, request.url)
+            entry = response_cache.get(cache_key)
+            if entry is not None:
+                return _cached_response(entry, weak=True)
+
+            etag, last_modified, total = _collection_validators(
+                query, dependencies
+            )
+            headers = validator_headers(etag, last_modified, weak=True)
+            if is_not_modified(etag, last_modified):
+                return '', 304, headers
+
+            if 'cursor' in request.args:
+                items, pagination_meta = _paginate_by_cursor(
+                    query, sort_keys, per_page, total
                 )
             else:
-                pagination_meta['prev'] = None
-            if p.has_next:
-                pagination_meta['next'] = url_for(
-                    request.endpoint, page=p.next_num, per_page=per_page,
-                    _external=True
+                items, pagination_meta = _paginate_by_page(
+                    query, sort_keys, per_page, total
                 )
-            else:
-                pagination_meta['next'] = None
-            pagination_meta['first'] = url_for(
-                request.endpoint, page=1, per_page=per_page, _external=True
-            )
-            pagination_meta['last'] = url_for(
-                request.endpoint, page=p.pages, per_page=per_page,
-                _external=True
-            )
 
-            return {
+            body = {
                 'status': 'success',
-                'data': collection_schema.dump(p.items),
+                'data': dump(schema, items),
                 'pagination_meta': pagination_meta
-            }, 200
+            }
+            response_cache.set(
+                cache_key, _cache_entry(body, etag, last_modified)
+            )
+            return body, 200, headers
         return wrapper
 
     return decorator
+
+
+def read_through(key: str,
+                 load: Callable[[], Tuple[dict, str, datetime]]) -> tuple:
+    """
+    Serves the response cached under the given key, or loads it with the given
+    function and caches it.
+    The loading function returns the response body, as well as its ETag and
+    Last-Modified date, so that conditional requests can be answered from the
+    cache as well.
+    :param key: str
+    :param load: Callable
+    :return: tuple
+    """
+    entry = response_cache.get(key)
+    if entry is None:
+        entry = _cache_entry(*load())
+        response_cache.set(key, entry)
+    return _cached_response(entry)
+
+
+def _cache_entry(body: dict, etag: str,
+                 last_modified: Optional[datetime]) -> dict:
+    """
+    Private helper function to make the cache entry of the given response body
+    and validators.
+    :param body: dict
+    :param etag: str
+    :param last_modified: datetime
+    :return: dict
+    """
+    return {
+        'body': body,
+        'etag': etag,
+        'last_modified': last_modified and last_modified.isoformat()
+    }
+
+
+def _cached_response(entry: dict, weak: bool=False) -> tuple:
+    """
+    Private helper function to make the response from the given cache entry,
+    or a 304 response if the client already has it.
+    :param entry: dict
+    :param weak: bool
+    :return: tuple
+    """
+    last_modified = entry['last_modified']
+    if last_modified is not None:
+        last_modified = datetime.fromisoformat(last_modified)
+    headers = validator_headers(entry['etag'], last_modified, weak=weak)
+    if is_not_modified(entry['etag'], last_modified):
+        return '', 304, headers
+    return entry['body'], 200, headers
+
+
+def load_batch(schema: Schema) -> Tuple[List[Tuple[int, dict]], dict]:
+    """
+    Deserializes the batch of items in the current request's JSON body with the
+    given schema.
+    Aborts with 400 if the body is not an array, or has too many items.
+    :param schema: Schema
+    :return: tuple(list[tuple(int, dict)], dict)
+    """
+    items = request.get_json()
+    if not isinstance(items, list):
+        abort(400, description='Expected an array of items')
+    max_items = current_app.config['BATCH_MAX_ITEMS']
+    if len(items) > max_items:
+        abort(400, description=f'At most {max_items} items per batch')
+
+    try:
+        return list(enumerate(schema.load(items, many=True))), {}
+    except ValidationError as e:
+        errors = e.messages  # Keyed by the indices of the invalid items
+    valid_indices = [i for i in range(len(items)) if i not in errors]
+    # The "post_load" hooks only run if all the items are valid, so the valid
+    # items need to be deserialized again.
+    valid_data = schema.load([items[i] for i in valid_indices], many=True)
+    return list(zip(valid_indices, valid_data)), errors
+
+
+def bulk_insert(model: db.Model, rows: List[dict],
+                chunk_size: int=500) -> List[int]:
+    """
+    Inserts the given rows of the given model with multi-row INSERT statements,
+    within the current transaction, and returns their IDs in the same order.
+    All the rows should have the same keys.
+    :param model: db.Model
+    :param rows: list[dict]
+    :param chunk_size: int
+    :return: list[int]
+    """
+    table = model.__table__
+    if db.session.get_bind().dialect.name != 'postgresql':
+        # Without multi-row RETURNING support, insert the rows one by one.
+        return [
+            db.session.execute(table.insert().values(row))
+            .inserted_primary_key[0]
+            for row in rows
+        ]
+
+    ids = []
+    for start in range(0, len(rows), chunk_size):
+        result = db.session.execute(
+            table.insert().values(rows[start:start + chunk_size])
+            .returning(table.c.id)
+        )
+        # The IDs are drawn from the sequence in the order of the rows, but
+        # RETURNING doesn't guarantee the order of its results.
+        ids.extend(sorted(id for id, in result))
+    return ids
+
+
+def batch_response(results: Dict[int, dict], errors: dict) -> Tuple[dict, int]:
+    """
+    Makes the response to a batch request from the given per-item results and
+    validation errors.
+    The batch fails as a whole if none of its items succeeds.
+    :param results: dict{int: dict}
+    :param errors: dict
+    :return: tuple(dict, int)
+    """
+    n_succeeded = len(results)
+    for i, messages in errors.items():
+        results[i] = {'status': 'error', 'message': messages}
+    n_created = sum(
+        1 for result in results.values() if result['status'] == 'created'
+    )
+    if n_created:
+        status_code = 201
+    elif errors:
+        status_code = 400
+    else:
+        status_code = 200
+    if not errors:
+        status = 'success'
+    elif n_succeeded:
+        status = 'partial'
+    else:
+        status = 'error'
+    return {
+        'status': status,
+        'data': {
+            'created': n_created,
+            'failed': len(errors),
+            'results': [
+                dict(index=i, **results[i]) for i in sorted(results)
+            ]
+        }
+    }, status_code
+
+
+def search_terms() -> str:
+    """
+    Gets the search terms of the current request, from the "q" query
+    parameter.
+    Aborts with 400 if there is no search term.
+    :return: str
+    """
+    terms = request.args.get('q', default='').strip()
+    if not terms:
+        abort(400, description='Missing search terms "q"')
+    return terms
+
+
+def escape_like(value: str, escape: str='\\') -> str:
+    """
+    Escapes the wildcard characters in the given value, to be matched literally
+    by LIKE patterns with the given escape character.
+    :param value: str
+    :param escape: str
+    :return: str
+    """
+    for char in (escape, '%', '_'):
+        value = value.replace(char, escape + char)
+    return value
+
+
+def export_response(query: BaseQuery, schema: Schema,
+                    filename: str) -> Response:
+    """
+    Makes a streaming response, which exports all the rows of the given query
+    serialized with the given schema, in the format given by the "format" query
+    parameter ("ndjson" or "csv").
+    The rows are fetched in batches from a server-side cursor and serialized one
+    by one, so the memory usage doesn't depend on the number of rows, and the
+    first bytes are sent before the query finishes.
+    :param query: BaseQuery
+    :param schema: Schema
+    :param filename: str
+    :return: Response
+    """
+    export_format = request.args.get('format', default='ndjson')
+    if export_format not in EXPORT_MIMETYPES:
+        abort(400, description='Format must be one of "ndjson" and "csv"')
+    rows = query.execution_options(stream_results=True).yield_per(
+        current_app.config['EXPORT_BATCH_SIZE']
+    )
+    if export_format == 'ndjson':
+        chunks = _export_ndjson(rows, schema)
+    else:
+        chunks = _export_csv(rows, schema)
+    return Response(
+        stream_with_context(chunks),
+        mimetype=EXPORT_MIMETYPES[export_format],
+        headers={
+            'Content-Disposition':
+                f'attachment; filename={filename}.{export_format}'
+        }
+    )
+
+
+def _export_ndjson(rows: Iterable, schema: Schema) -> Iterator[str]:
+    """
+    Private helper function to serialize the given rows into NDJSON chunks.
+    :param rows: iterable
+    :param schema: Schema
+    :return: iterator[str]
+    """
+    buffer = []
+    for row in rows:
+        buffer.append(json.dumps(dump(schema, row)))
+        if len(buffer) == EXPORT_CHUNK_ROWS:
+            yield '\n'.join(buffer) + '\n'
+            buffer = []
+    if buffer:
+        yield '\n'.join(buffer) + '\n'
+
+
+def _export_csv(rows: Iterable, schema: Schema) -> Iterator[str]:
+    """
+    Private helper function to serialize the given rows into CSV chunks, where
+    the nested objects are flattened into "<field>.<nested field>" columns.
+    :param rows: iterable
+    :param schema: Schema
+    :return: iterator[str]
+    """
+    header = []
+    for name, field in schema.dump_fields.items():
+        if isinstance(field, fields.Nested):
+            header.extend(
+                f'{name}.{nested_name}'
+                for nested_name in field.schema.dump_fields
+            )
+        else:
+            header.append(name)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for i, row in enumerate(rows, start=1):
+        data = dump(schema, row)
+        values = []
+        for column in header:
+            name, _, nested_name = column.partition('.')
+            value = data.get(name)
+            if nested_name and value is not None:
+                value = value.get(nested_name)
+            values.append(value)
+        writer.writerow(values)
+        if i % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _collection_validators(
+        query: BaseQuery,
+        depends_on: Tuple[db.Model, ...]) -> Tuple[str, Optional[datetime], int]:
+    """
+    Private helper function to get the validators of a page of the given query,
+    as well as the unfiltered total count of the queried collection.
+    They are derived with a single cheap query, from the maintained total
+    counts and the indexed latest modification times of the queried model and
+    of the given models (the counts also catch the deletions).
+    :param query: BaseQuery
+    :param depends_on: tuple(db.Model)
+    :return: tuple(str, datetime or None, int)
+    """
+    model = _query_model(query)
+    models = (model,) + tuple(depends_on)
+    columns = [
+        select([func.max(m.updated_at)]).as_scalar() for m in models
+    ]
+    columns.extend(
+        select([CollectionCount.total])
+        .where(CollectionCount.name == m.__tablename__)
+        .as_scalar()
+        for m in models
+    )
+    row = db.session.query(*columns).one()
+    latest, totals = row[:len(models)], row[len(models):]
+    total = totals[0]
+    if total is None:  # Not seeded yet
+        total = model.query.count()
+
+    etag = make_etag(request.full_path, totals, latest)
+    known_latest = [dt for dt in latest if dt is not None]
+    last_modified = max(known_latest) if known_latest else None
+    return etag, last_modified, total
+
+
+def _paginate_by_page(query: BaseQuery, sort_keys: Optional[List[SortKey]],
+                      per_page: int,
+                      unfiltered_total: int) -> Tuple[list, dict]:
+    """
+    Private helper function to paginate the given query by page number.
+    :param query: BaseQuery
+    :param sort_keys: list[SortKey] or None
+    :param per_page: int
+    :param unfiltered_total: int
+    :return: tuple(list, dict)
+    """
+    page = request.args.get('page', type=int, default=1)
+    if page < 1:
+        abort(404)
+    page_query = query
+    if sort_keys is not None:
+        page_query = query.order_by(None).order_by(
+            *[key.ordering() for key in sort_keys]
+        )
+    items = page_query.limit(per_page).offset((page - 1) * per_page).all()
+    if not items and page != 1:
+        abort(404)
+    total, approximate = _count_total(query, unfiltered_total)
+    p = Pagination(query, page, per_page, total, items)
+    # "p" is a Pagination object.
+
+    # Populate the pagination metadata
+    pagination_meta = {
+        'page': page,
+        'per_page': per_page,
+        'pages': p.pages,
+        'total': p.total
+    }
+    if approximate:
+        pagination_meta['approximate'] = True
+    if p.has_prev:
+        pagination_meta['prev'] = _page_url(page=p.prev_num, per_page=per_page)
+    else:
+        pagination_meta['prev'] = None
+    if p.has_next:
+        pagination_meta['next'] = _page_url(page=p.next_num, per_page=per_page)
+    else:
+        pagination_meta['next'] = None
+    pagination_meta['first'] = _page_url(page=1, per_page=per_page)
+    pagination_meta['last'] = _page_url(page=p.pages, per_page=per_page)
+    return p.items, pagination_meta
+
+
+def _paginate_by_cursor(query: BaseQuery, sort_keys: Optional[List[SortKey]],
+                        per_page: int,
+                        unfiltered_total: int) -> Tuple[list, dict]:
+    """
+    Private helper function to paginate the given query by cursor (keyset
+    pagination).
+    The rows are ordered by the given sort keys (by default, the primary key),
+    and each page is fetched by seeking past the last (or before the first) row
+    of the previous page, so the cost of a page doesn't depend on how deep it
+    is. The total count is only computed when explicitly asked for with
+    "count=true".
+    :param query: BaseQuery
+    :param sort_keys: list[SortKey] or None
+    :param per_page: int
+    :param unfiltered_total: int
+    :return: tuple(list, dict)
+    """
+    if sort_keys is None:
+        model = _query_model(query)
+        sort_keys = [
+            SortKey(getattr(model, column.key))
+            for column in inspect(model).primary_key
+        ]
+
+    cursor = request.args['cursor']
+    if cursor:
+        backwards, values = _decode_cursor(cursor, sort_keys)
+    else:  # First page
+        backwards, values = False, None
+
+    # The values of the sort keys are queried along with the rows, in order to
+    # make the cursors.
+    page_query = query.order_by(None).add_columns(
+        *[key.expression for key in sort_keys]
+    )
+    if values is not None:
+        page_query = page_query.filter(
+            _keyset_seek(sort_keys, values, backwards)
+        )
+    page_query = page_query.order_by(
+        *[key.ordering(reverse=backwards) for key in sort_keys]
+    )
+    rows = page_query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = values is not None, has_more
+    items = [row[0] for row in rows]
+
+    # Populate the pagination metadata
+    pagination_meta = {
+        'cursor': cursor,
+        'per_page': per_page
+    }
+    if request.args.get('count', default='').lower() == 'true':
+        pagination_meta['total'], approximate = _count_total(
+            query, unfiltered_total
+        )
+        if approximate:
+            pagination_meta['approximate'] = True
+    if has_prev and rows:
+        pagination_meta['prev'] = _page_url(
+            cursor=_encode_cursor(rows[0][1:], backwards=True),
+            per_page=per_page
+        )
+    else:
+        pagination_meta['prev'] = None
+    if has_next and rows:
+        pagination_meta['next'] = _page_url(
+            cursor=_encode_cursor(rows[-1][1:]), per_page=per_page
+        )
+    else:
+        pagination_meta['next'] = None
+    pagination_meta['first'] = _page_url(cursor='', per_page=per_page)
+    return items, pagination_meta
+
+
+def _page_url(**params) -> str:
+    """
+    Private helper function to make the URL of another page of the current
+    collection, keeping the other query parameters of the current request.
+    The URL of the collection is only built once per request, and the query
+    string is encoded the same way as "url_for()" does.
+    :param params:
+    :return: str
+    """
+    args = {
+        name: value for name, value in request.args.items()
+        if name not in PAGINATION_PARAMS
+    }
+    args.update(params)
+    base_url = g.get('_collection_url')
+    if base_url is None:
+        base_url = g._collection_url = url_for(
+            request.endpoint, **request.view_args, _external=True
+        )
+    url_map = current_app.url_map
+    query_string = url_encode(
+        args, charset=url_map.charset, sort=url_map.sort_parameters,
+        key=url_map.sort_key
+    )
+    return f'{base_url}?{query_string}' if query_string else base_url
+
+
+def _query_model(query: BaseQuery) -> db.Model:
+    """
+    Private helper function to get the model queried by the given query.
+    :param query: BaseQuery
+    :return: db.Model
+    """
+    return query.column_descriptions[0]['entity']
+
+
+def _count_total(query: BaseQuery,
+                 unfiltered_total: int) -> Tuple[int, bool]:
+    """
+    Private helper function to count the total number of rows of the given
+    query, and whether the count is approximate.
+    Unfiltered collections are counted with the maintained counts, and filtered
+    ones either exactly, or with the query planner's estimate.
+    :param query: BaseQuery
+    :param unfiltered_total: int
+    :return: tuple(int, bool)
+    """
+    if query.whereclause is None:
+        return unfiltered_total, False
+
+    query = query.order_by(None)
+    bind = db.session.get_bind()
+    if (current_app.config['PAGINATION_FILTERED_TOTAL'] == 'estimate' and
+            bind.dialect.name == 'postgresql'):
+        compiled = query.statement.compile(dialect=bind.dialect)
+        plan = db.session.connection().execute(
+            f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params
+        ).scalar()
+        return int(plan[0]['Plan']['Plan Rows']), True
+    return query.count(), False
+
+
+def _keyset_seek(sort_keys: List[SortKey], values: list,
+                 backwards: bool=False):
+    """
+    Private helper function to make the filter criterion, which seeks past
+    (or before) the row with the given values of the given sort keys.
+    :param sort_keys: list[SortKey]
+    :param values: list
+    :param backwards: bool
+    :return:
+    """
+    directions = {key.descending != backwards for key in sort_keys}
+    if len(directions) == 1:
+        # Row-value comparison, which can be served by a composite index
+        descending = directions.pop()
+        if len(sort_keys) == 1:
+            lhs, rhs = sort_keys[0].expression, values[0]
+        else:
+            lhs = tuple_(*[key.expression for key in sort_keys])
+            rhs = tuple_(*values)
+        return lhs < rhs if descending else lhs > rhs
+
+    # With mixed directions, expand the comparison into
+    # "k1 > v1 OR (k1 = v1 AND k2 < v2) OR ..."
+    criteria = []
+    for i, key in enumerate(sort_keys):
+        if key.descending != backwards:
+            seek = key.expression < values[i]
+        else:
+            seek = key.expression > values[i]
+        criteria.append(and_(
+            *[sort_keys[j].expression == values[j] for j in range(i)], seek
+        ))
+    return or_(*criteria)
+
+
+def _encode_cursor(values: tuple, backwards: bool=False) -> str:
+    """
+    Private helper function to encode the given values of the sort keys into an
+    opaque cursor.
+    :param values: tuple
+    :param backwards: bool
+    :return: str
+    """
+    values = [
+        value.isoformat() if isinstance(value, (date, datetime)) else
+        str(value) if isinstance(value, Decimal) else value
+        for value in values
+    ]
+    data = json.dumps({'b': backwards, 'v': values}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor: str,
+                   sort_keys: List[SortKey]) -> Tuple[bool, list]:
+    """
+    Private helper function to decode the given opaque cursor into the
+    direction and the values of the given sort keys.
+    Aborts with 400 if the cursor is invalid.
+    :param cursor: str
+    :param sort_keys: list[SortKey]
+    :return: tuple(bool, list)
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        backwards, values = bool(data['b']), data['v']
+        if len(values) != len(sort_keys):
+            raise ValueError
+        for i, key in enumerate(sort_keys):
+            python_type = key.python_type
+            if python_type in (date, datetime):
+                values[i] = python_type.fromisoformat(values[i])
+            elif python_type is not None and values[i] is not None:
+                values[i] = python_type(values[i])
+    except (KeyError, TypeError, ValueError, InvalidOperation):
+        abort(400, description='Invalid cursor')
+    return backwards, values
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test fixtures module.
+
+The tests run the application against a seeded SQLite database, with the
+access tokens verified locally, so that neither PostgreSQL nor auth_service is
+needed.
+"""
+
+import base64
+import os
+from datetime import date, timedelta
+
+import pytest
+from flask import Flask
+
+# The configurations require these.
+os.environ.setdefault('FLASK_SECRET_KEY', 'test')
+os.environ.setdefault('POSTGRES_USER', 'test')
+os.environ.setdefault('POSTGRES_PASSWORD', 'test')
+
+from itsdangerous import (  # noqa: E402
+    TimedJSONWebSignatureSerializer as Serializer
+)
+
+from bookstore import create_app, db  # noqa: E402
+from bookstore.config import Config  # noqa: E402
+from bookstore.migrations import migrate  # noqa: E402
+from bookstore.models import Author, Book, CollectionCount  # noqa: E402
+
+AUTHORS = 3
+BOOKS = 30
+
+
+class TestConfig(Config):
+    """
+    Testing configuration class.
+    """
+    TESTING = True
+    ACCESS_TOKEN_SECRET_KEY = 'test-access-token'
+    LOCAL_TOKEN_VERIFICATION = True
+    SQLALCHEMY_BINDS = {}
+    SQLALCHEMY_REPLICA_BINDS = []
+    RESPONSE_CACHE_BACKEND = None  # Every request queries the database.
+    METRICS_ENABLED = False
+    SQL_BUDGET_ENABLED = True
+
+
+def _create_app(database) -> Flask:
+    """
+    Private helper function to create the application on an SQLite database in
+    the given file, and to migrate it.
+    :param database: Path
+    :return: Flask
+    """
+    class _Config(TestConfig):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{database}'
+
+    app = create_app(_Config)
+    with app.app_context():
+        migrate()
+    return app
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    app = _create_app(tmp_path_factory.mktemp('db') / 'bookstore.db')
+    with app.app_context():
+        authors = [Author(name=f'Author {i}') for i in range(AUTHORS)]
+        db.session.add_all(authors)
+        db.session.flush()
+        db.session.add_all(
+            Book(
+                title=f'Book {i}', author_id=authors[i % AUTHORS].id,
+                description='Description',
+                date_published=date(2000, 1, 1) + timedelta(days=i)
+            )
+            for i in range(BOOKS)
+        )
+        CollectionCount.adjust(Author, AUTHORS)
+        CollectionCount.adjust(Book, BOOKS)
+        db.session.commit()
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def empty_client(tmp_path):
+    """
+    Client of an application on an empty database of its own, for the tests
+    which write.
+    """
+    return _create_app(tmp_path / 'bookstore.db').test_client()
+
+
+@pytest.fixture(scope='session')
+def headers(app):
+    serializer = Serializer(
+        app.config['ACCESS_TOKEN_SECRET_KEY'], expires_in=3600
+    )
+    access_token = serializer.dumps({'id': 1, 'username': 'test'})
+    credentials = base64.b64encode(access_token + b':unused')
+    return {'Authorization': f'Basic {credentials.decode("ascii")}'}
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the ASGI application, against a fake auth_service.
+"""
+
+import asyncio
+import base64
+import json
+
+import pytest
+from aiohttp import web
+
+from bookstore import credential_cache, user_service
+from bookstore.asgi import AsgiApplication
+from bookstore.http_client import CircuitBreaker
+from bookstore.serialization import encode_json
+
+PASSWORD = 'secret'
+
+
+@pytest.fixture
+def asgi_app(app, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('auth_service called synchronously')
+
+    # auth_service must only be called by the coroutines.
+    monkeypatch.setattr(user_service, 'request', fail)
+    monkeypatch.setattr(user_service, 'breaker', CircuitBreaker())
+    credential_cache.clear()
+    yield AsgiApplication(app, 2)
+    credential_cache.clear()
+
+
+def _basic(username: str, password: str) -> dict:
+    credentials = base64.b64encode(f'{username}:{password}'.encode('utf-8'))
+    return {'Authorization': f'Basic {credentials.decode("ascii")}'}
+
+
+async def _fake_auth_service(monkeypatch, calls: list) -> web.AppRunner:
+    """
+    Private helper function to start a fake auth_service, which records the
+    paths of the calls in the given list.
+    :param monkeypatch:
+    :param calls: list
+    :return: web.AppRunner
+    """
+    async def user_auth(request):
+        calls.append(request.path)
+        data = await request.json()
+        if data['password'] != PASSWORD:
+            return web.json_response({'message': 'Unauthorized'}, status=401)
+        return web.json_response({'data': data['username_or_token']})
+
+    async def add_user(request):
+        calls.append(request.path)
+        data = await request.json()
+        return web.json_response(
+            {'message': 'Successfully created user', 'data': data['username']},
+            status=201
+        )
+
+    async def access_token(request):
+        calls.append(request.path)
+        data = await request.json()
+        return web.json_response({'token': f"token-of-{data['username']}"})
+
+    application = web.Application()
+    application.router.add_get('/user-auth', user_auth)
+    application.router.add_post('/users', add_user)
+    application.router.add_get('/access-token', access_token)
+    runner = web.AppRunner(application)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    monkeypatch.setattr(user_service, 'base_url', f'http://127.0.0.1:{port}')
+    return runner
+
+
+async def _call(asgi_app, method: str, path: str, headers: dict=None,
+                body: bytes=b'') -> tuple:
+    """
+    Private helper function to send a request to the given ASGI application.
+    :param asgi_app:
+    :param method: str
+    :param path: str
+    :param headers: dict
+    :param body: bytes
+    :return: tuple(int, dict, bytes)
+    """
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'query_string': b'',
+        'root_path': '',
+        'headers': [
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in (headers or {}).items()
+        ],
+        'client': ('127.0.0.1', 50000),
+        'server': ('localhost', 80)
+    }
+    received = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    messages = []
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi_app(scope, receive, send)
+    start = messages[0]
+    response_headers = {
+        name.decode('latin-1'): value.decode('latin-1')
+        for name, value in start['headers']
+    }
+    return start['status'], response_headers, b''.join(
+        message.get('body', b'') for message in messages[1:]
+    )
+
+
+def _run(asgi_app, monkeypatch, *requests) -> tuple:
+    """
+    Private helper function to send the given requests to the given ASGI
+    application, with a fake auth_service.
+    Returns the responses and the paths of the calls to auth_service.
+    :param asgi_app:
+    :param monkeypatch:
+    :param requests: tuple
+    :return: tuple(list, list)
+    """
+    async def run() -> list:
+        runner = await _fake_auth_service(monkeypatch, calls)
+        try:
+            return [await _call(asgi_app, *request) for request in requests]
+        finally:
+            await asgi_app._user_service.close()
+            await runner.cleanup()
+
+    calls = []
+    return asyncio.run(run()), calls
+
+
+def test_credentials_verified_asynchronously(asgi_app, monkeypatch):
+    headers = _basic('alice', PASSWORD)
+    responses, calls = _run(
+        asgi_app, monkeypatch,
+        ('GET', '/bookstore/books', headers),
+        ('GET', '/bookstore/books', headers)
+    )
+    assert [status for status, _, _ in responses] == [200, 200]
+    # The second request is resolved by the credential cache.
+    assert calls == ['/user-auth']
+
+
+def test_wrong_credentials_answered_by_flask(asgi_app, monkeypatch):
+    responses, calls = _run(
+        asgi_app, monkeypatch,
+        ('GET', '/bookstore/books', _basic('alice', 'wrong'))
+    )
+    assert responses[0][0] == 401
+    assert calls == ['/user-auth']
+
+
+def test_missing_credentials_answered_by_flask(asgi_app, monkeypatch):
+    responses, calls = _run(asgi_app, monkeypatch, ('GET', '/bookstore/books'))
+    assert responses[0][0] == 401
+    assert calls == ['/user-auth']
+
+
+def test_user_added_asynchronously(asgi_app, monkeypatch):
+    responses, calls = _run(
+        asgi_app, monkeypatch,
+        (
+            'POST', '/bookstore/users',
+            {'Content-Type': 'application/json'},
+            json.dumps({'username': 'bob', 'password': PASSWORD}).encode()
+        )
+    )
+    status, headers, body = responses[0]
+    assert status == 201
+    assert headers['content-type'] == 'application/json'
+    assert body == encode_json(
+        {'message': 'Successfully created user', 'data': 'bob'}
+    ) + b'\n'
+    assert calls == ['/users']
+
+
+def test_access_token_got_asynchronously(asgi_app, monkeypatch):
+    responses, calls = _run(
+        asgi_app, monkeypatch,
+        ('GET', '/bookstore/access-token', _basic('alice', PASSWORD))
+    )
+    status, _, body = responses[0]
+    assert status == 200
+    assert json.loads(body) == {'token': 'token-of-alice'}
+    assert calls == ['/user-auth', '/access-token']
+
+
+def test_auth_service_unavailable(asgi_app, monkeypatch):
+    async def run():
+        monkeypatch.setattr(user_service, 'base_url', 'http://127.0.0.1:9')
+        try:
+            return await _call(
+                asgi_app, 'POST', '/bookstore/users',
+                {'Content-Type': 'application/json'}, b'{"username": "bob"}'
+            )
+        finally:
+            await asgi_app._user_service.close()
+
+    status, _, body = asyncio.run(run())
+    assert status == 503
+    assert json.loads(body) == {
+        'message': 'Authentication service unavailable'
+    }
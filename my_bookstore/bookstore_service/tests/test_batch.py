@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the batch creations.
+"""
+
+import pytest
+
+from bookstore import db
+from bookstore.models import Author
+
+
+def test_book_batch_reports_the_created_ids(empty_client, headers):
+    response = empty_client.post('/bookstore/books:batch', json=[
+        {'title': 'first book', 'author_name': 'some author'},
+        {'title': '', 'author_name': 'some author'},
+        {'title': 'second book', 'author_name': 'other author'}
+    ], headers=headers)
+    assert response.status_code == 201
+    body = response.get_json()
+    assert body['status'] == 'partial'
+    assert body['data']['created'] == 2
+    assert body['data']['failed'] == 1
+    first, invalid, second = body['data']['results']
+    assert invalid['status'] == 'error'
+    for result, title in ((first, 'First Book'), (second, 'Second Book')):
+        assert result['status'] == 'created'
+        book = empty_client.get(
+            f'/bookstore/books/{result["id"]}', headers=headers
+        ).get_json()['data']
+        assert book['title'] == title
+
+
+def test_author_batch_reports_the_created_ids(empty_client, headers):
+    response = empty_client.post('/bookstore/authors:batch', json=[
+        {'name': 'some author'}, {'name': 'Some Author'}, {'name': 'other'}
+    ], headers=headers)
+    assert response.status_code == 201
+    body = response.get_json()
+    assert body['status'] == 'success'
+    created, existing, other = body['data']['results']
+    assert created['status'] == 'created'
+    assert existing['id'] == created['id']
+    assert other['status'] == 'created'
+    author = empty_client.get(
+        f'/bookstore/authors/{other["id"]}', headers=headers
+    ).get_json()['data']
+    assert author['name'] == 'Other'
+
+
+def test_batch_fails_if_all_items_fail(empty_client, headers):
+    response = empty_client.post('/bookstore/books:batch', json=[
+        {'title': ''}, {'author_name': 'some author'}
+    ], headers=headers)
+    assert response.status_code == 400
+    body = response.get_json()
+    assert body['status'] == 'error'
+    assert body['data']['created'] == 0
+    assert body['data']['failed'] == 2
+
+
+@pytest.fixture
+def concurrent_author(monkeypatch):
+    """
+    Creates an author named "Concurrent Author" in another transaction, after
+    the batches look up the existing authors and before they insert the new
+    ones.
+    """
+    insert_new = Author.insert_new.__func__
+
+    def insert_new_after_concurrent_author(cls, rows):
+        db.engine.execute(
+            Author.__table__.insert().values(name='Concurrent Author')
+        )
+        return insert_new(cls, rows)
+
+    monkeypatch.setattr(
+        Author, 'insert_new', classmethod(insert_new_after_concurrent_author)
+    )
+
+
+def test_author_batch_finds_concurrently_created_authors(
+        empty_client, headers, concurrent_author):
+    response = empty_client.post('/bookstore/authors:batch', json=[
+        {'name': 'concurrent author'}, {'name': 'new author'}
+    ], headers=headers)
+    assert response.status_code == 201
+    concurrent, new = response.get_json()['data']['results']
+    assert concurrent['status'] == 'Found existing author'
+    assert new['status'] == 'created'
+    author = empty_client.get(
+        f'/bookstore/authors/{concurrent["id"]}', headers=headers
+    ).get_json()['data']
+    assert author['name'] == 'Concurrent Author'
+
+
+def test_book_batch_uses_concurrently_created_authors(
+        empty_client, headers, concurrent_author):
+    response = empty_client.post('/bookstore/books:batch', json=[
+        {'title': 'first book', 'author_name': 'Concurrent Author'},
+        {'title': 'second book', 'author_name': 'new author'}
+    ], headers=headers)
+    assert response.status_code == 201
+    first, _ = response.get_json()['data']['results']
+    book = empty_client.get(
+        f'/bookstore/books/{first["id"]}', headers=headers
+    ).get_json()['data']
+    assert book['author']['name'] == 'Concurrent Author'
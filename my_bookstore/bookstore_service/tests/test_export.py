@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the collection exports.
+"""
+
+import csv
+import io
+
+import pytest
+
+from .conftest import AUTHORS, BOOKS
+
+
+@pytest.mark.parametrize('url, rows, header', [
+    (
+        '/bookstore/books/export?format=csv', BOOKS,
+        [
+            'id', 'title', 'author.name', 'author.url_self', 'description',
+            'date_published', 'url_self', 'url_collection'
+        ]
+    ),
+    (
+        '/bookstore/authors/export?format=csv', AUTHORS,
+        ['id', 'name', 'url_self', 'url_collection']
+    )
+])
+def test_csv_columns_in_declaration_order(client, headers, url, rows, header):
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200
+    lines = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+    assert lines[0] == header
+    assert len(lines) == rows + 1
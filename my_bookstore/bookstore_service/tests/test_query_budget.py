@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the SQL query budget.
+"""
+
+import pytest
+
+from bookstore import query_budget
+from bookstore.query_budget import QueryBudgetExceeded
+
+
+def test_assert_max_queries_within_budget(client, headers):
+    with query_budget.assert_max_queries(2) as records:
+        response = client.get('/bookstore/books', headers=headers)
+    assert response.status_code == 200
+    assert len(records) == 2
+
+
+def test_assert_max_queries_over_budget(client, headers):
+    with pytest.raises(QueryBudgetExceeded, match='over the budget of 1'):
+        with query_budget.assert_max_queries(1):
+            client.get('/bookstore/books', headers=headers)
+
+
+def test_request_over_budget_raises(app, client, headers, monkeypatch):
+    monkeypatch.setattr(query_budget, '_raise', True)
+    monkeypatch.setitem(query_budget._budgets, 'GET api.books', 1)
+    with pytest.raises(QueryBudgetExceeded, match='GET api.books'):
+        client.get('/bookstore/books', headers=headers)
+
+
+def test_request_within_budget(app, client, headers, monkeypatch):
+    monkeypatch.setattr(query_budget, '_raise', True)
+    response = client.get('/bookstore/books', headers=headers)
+    assert response.status_code == 200
+    assert response.headers['X-SQL-Statements'] == '2'
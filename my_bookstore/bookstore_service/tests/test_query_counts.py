@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the number of SQL statements run per request, which must not grow
+with the number of rows (no N+1 pattern), whatever the projected fields.
+"""
+
+import pytest
+
+from bookstore import query_budget
+
+
+@pytest.mark.parametrize('url, statements', [
+    # The validators (maintained total and latest modification times), and the
+    # page with the authors joined
+    ('/bookstore/books', 2),
+    ('/bookstore/books?page=2', 2),
+    ('/bookstore/books?cursor=', 2),
+    ('/bookstore/books?fields=title', 2),
+    ('/bookstore/books?fields=title,author.name', 2),
+    # Plus the count of the filtered total
+    ('/bookstore/books?author_id=1&sort=-date_published', 3),
+    # The validators and the page, and the books of the authors in a single
+    # "SELECT ... IN" query
+    ('/bookstore/authors', 2),
+    ('/bookstore/authors?fields=name,books.title', 3),
+    ('/bookstore/books/search?q=book', 3)
+])
+def test_collection_statements(client, headers, url, statements):
+    with query_budget.capture() as records:
+        response = client.get(url, headers=headers)
+    assert response.status_code == 200
+    assert len(response.get_json()['data']) > 1
+    assert len(records) == statements
+    assert response.headers['X-SQL-Statements'] == str(statements)
+
+
+@pytest.mark.parametrize('url, statements', [
+    # The book with its author joined
+    ('/bookstore/books/1', 1),
+    ('/bookstore/books/1?fields=title', 1),
+    ('/bookstore/books/1?fields=title,author.name', 1),
+    # The author, and its books in a single "SELECT ... IN" query
+    ('/bookstore/authors/1', 2),
+    ('/bookstore/authors/1?fields=name', 1),
+    ('/bookstore/authors/1?fields=books.title', 2)
+])
+def test_item_statements(client, headers, url, statements):
+    with query_budget.capture() as records:
+        response = client.get(url, headers=headers)
+    assert response.status_code == 200
+    assert len(records) == statements
+
+
+def test_projected_columns(client, headers):
+    with query_budget.capture() as records:
+        client.get('/bookstore/books?fields=title', headers=headers)
+    page_statement = records[-1].statement
+    assert 'books.title' in page_statement
+    assert 'books.description' not in page_statement
+    assert 'authors' not in page_statement
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the serialization of the responses, which must be byte for byte the
+same as with the marshmallow schemas and the standard library's encoder.
+"""
+
+import json
+from datetime import date
+
+import pytest
+
+from bookstore.models import (
+    Author, Book, author_schema, authors_schema, book_schema, books_schema
+)
+from bookstore.serialization import dump, encode_json
+
+
+def _catalog() -> list:
+    """
+    Private helper function to make books by authors with non-ASCII names,
+    without the database.
+    :return: list[Book]
+    """
+    authors = [Author(id=1, name='Zoë Ångström'), Author(id=2, name='李白')]
+    return [
+        Book(
+            id=i, title=title, author=authors[i % 2],
+            description='Déjà vu — “quoted” \\ \t tab',
+            date_published=date(2000, 1, 1)
+        )
+        for i, title in enumerate(['Café Society', 'Plain', '静夜思'], 1)
+    ]
+
+
+@pytest.mark.parametrize('data', [
+    {'status': 'success', 'data': [{'title': 'Café', 'id': 1}]},
+    {'title': '静夜思 😀', 'nested': {'value': 1.5, 'none': None}},
+    {1: 'non-string key', 'list': ['a', True, False, 0]}
+])
+def test_encode_json_is_byte_for_byte_json_dumps(data):
+    assert encode_json(data) + b'\n' == (json.dumps(data) + '\n').encode()
+
+
+@pytest.mark.parametrize('schema', [books_schema, book_schema])
+def test_dump_books_is_byte_for_byte_marshmallow(app, schema):
+    books = _catalog()
+    obj = books if schema.many else books[0]
+    with app.test_request_context(base_url='http://localhost/bookstore'):
+        expected = json.dumps(schema.dump(obj)).encode()
+        assert encode_json(dump(schema, obj)) == expected
+
+
+@pytest.mark.parametrize('schema', [authors_schema, author_schema])
+def test_dump_authors_is_byte_for_byte_marshmallow(app, schema):
+    author = _catalog()[0].author
+    obj = [author] if schema.many else author
+    with app.test_request_context(base_url='http://localhost/bookstore'):
+        expected = json.dumps(schema.dump(obj)).encode()
+        assert encode_json(dump(schema, obj)) == expected
+
+
+def test_response_is_byte_for_byte_json_dumps(client, headers):
+    response = client.get('/bookstore/books/1', headers=headers)
+    body = response.get_data()
+    assert body == (json.dumps(json.loads(body)) + '\n').encode()
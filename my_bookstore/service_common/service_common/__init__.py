@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+
+"""
+Common modules shared by the services.
+"""
@@ -0,0 +1,544 @@
+# -*- coding: utf-8 -*-
+
+"""
+Metrics module.
+
+The metrics are recorded in memory by each worker process, and periodically
+flushed to a file per process in a shared directory. The "/metrics" route
+aggregates the files of all the workers, in Prometheus text format.
+"""
+
+import atexit
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable, Optional, Sequence
+
+from flask import (
+    Flask, Response, current_app, g, has_app_context, has_request_context,
+    request
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+# Upper bounds of the buckets of the SQL statement durations, in seconds
+SQL_LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1
+)
+# Upper bounds of the buckets of the numbers of SQL statements per request
+SQL_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter:
+    """
+    Counter, with a value for each combination of label values.
+    """
+    TYPE = 'counter'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str]=()):
+        """
+        Constructor with parameters.
+        :param name: str
+        :param documentation: str
+        :param labelnames: sequence[str]
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues: str, amount: float=1) -> None:
+        """
+        Increments the value of the given label values by the given amount.
+        :param labelvalues: str
+        :param amount: float
+        :return: None
+        """
+        with self._lock:
+            self._values[labelvalues] = (
+                self._values.get(labelvalues, 0) + amount
+            )
+
+    def snapshot(self) -> list:
+        """
+        Returns the values of all the label values.
+        :return: list[list]
+        """
+        with self._lock:
+            return [[list(labels), value]
+                    for labels, value in self._values.items()]
+
+
+class Histogram:
+    """
+    Histogram, with a distribution for each combination of label values.
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str]=(),
+                 buckets: Sequence[float]=LATENCY_BUCKETS):
+        """
+        Constructor with parameters.
+        :param name: str
+        :param documentation: str
+        :param labelnames: sequence[str]
+        :param buckets: sequence[float]
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Label values -> [count of each bucket..., count above, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        """
+        Records the given value, for the given label values.
+        :param value: float
+        :param labelvalues: str
+        :return: None
+        """
+        with self._lock:
+            data = self._values.get(labelvalues)
+            if data is None:
+                data = self._values[labelvalues] = [0] * (
+                    len(self.buckets) + 1
+                ) + [0.0]
+            data[bisect_left(self.buckets, value)] += 1
+            data[-1] += value
+
+    def snapshot(self) -> list:
+        """
+        Returns the distributions of all the label values.
+        :return: list[list]
+        """
+        with self._lock:
+            return [[list(labels), list(data)]
+                    for labels, data in self._values.items()]
+
+
+class Metrics:
+    """
+    Metrics of the application:
+    * Latency histograms and status counts of the requests, per endpoint
+    * Numbers and durations of the SQL statements, per request and overall
+    * Any other metrics registered with "counter()" and "histogram()"
+    * The statistics of the components registered with "collect()", as gauges
+    The hot path only updates in-memory values. Each worker process flushes
+    them to its own file every flush interval, so the aggregated metrics may be
+    that much behind.
+    """
+
+    def __init__(self, namespace: str, app: Optional[Flask]=None):
+        """
+        Constructor with parameters.
+        :param namespace: str
+        :param app: Flask
+        """
+        self.namespace = namespace
+        self.enabled = False
+        self._dir = None
+        self._flush_interval = 5.0
+        self._metrics = {}
+        self._collectors = {}
+        self._flusher_pid = None
+        self._sql_listening = False
+
+        self.request_duration = self.histogram(
+            'http_request_duration_seconds', 'Latency of the requests',
+            ['endpoint', 'method']
+        )
+        self.requests = self.counter(
+            'http_requests_total', 'Requests by response status',
+            ['endpoint', 'method', 'status']
+        )
+        self.request_sql_statements = self.histogram(
+            'http_request_sql_statements', 'SQL statements per request',
+            ['endpoint'], buckets=SQL_COUNT_BUCKETS
+        )
+        self.request_sql_duration = self.histogram(
+            'http_request_sql_duration_seconds',
+            'Total duration of the SQL statements per request', ['endpoint']
+        )
+        self.sql_duration = self.histogram(
+            'db_statement_duration_seconds', 'Duration of the SQL statements',
+            buckets=SQL_LATENCY_BUCKETS
+        )
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """
+        Initializes the metrics with the given application's configurations,
+        and adds the "/metrics" route to it.
+        :param app: Flask
+        :return: None
+        """
+        self.enabled = app.config['METRICS_ENABLED']
+        if not self.enabled:
+            return
+        self._dir = app.config['METRICS_DIR'] or os.path.join(
+            tempfile.gettempdir(), f'{self.namespace}_metrics'
+        )
+        self._flush_interval = app.config['METRICS_FLUSH_INTERVAL']
+        os.makedirs(self._dir, exist_ok=True)
+        self._remove_dead_files()
+
+        app.extensions['metrics'] = self
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        if not self._sql_listening:
+            event.listen(
+                Engine, 'before_cursor_execute', self._before_cursor_execute
+            )
+            event.listen(
+                Engine, 'after_cursor_execute', self._after_cursor_execute
+            )
+            self._sql_listening = True
+        app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+
+    def counter(self, name: str, documentation: str,
+                labelnames: Sequence[str]=()) -> Counter:
+        """
+        Registers a counter, or gets the one already registered with the given
+        name.
+        :param name: str
+        :param documentation: str
+        :param labelnames: sequence[str]
+        :return: Counter
+        """
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str,
+                  labelnames: Sequence[str]=(),
+                  buckets: Sequence[float]=LATENCY_BUCKETS) -> Histogram:
+        """
+        Registers a histogram, or gets the one already registered with the
+        given name.
+        :param name: str
+        :param documentation: str
+        :param labelnames: sequence[str]
+        :param buckets: sequence[float]
+        :return: Histogram
+        """
+        return self._register(
+            Histogram(name, documentation, labelnames, buckets)
+        )
+
+    def collect(self, name: str, stats: Callable[[], dict]) -> None:
+        """
+        Registers the given function returning the statistics of a component,
+        which are exported as gauges prefixed with the given name when flushing.
+        The numeric statistics are summed over the worker processes, except for
+        the maxima ("*_max"), while the ratios are left to be computed from the
+        counts.
+        :param name: str
+        :param stats: Callable
+        :return: None
+        """
+        self._collectors[name] = stats
+
+    def flush(self) -> None:
+        """
+        Flushes the metrics of the current process to its file.
+        :return: None
+        """
+        snapshot = {
+            'metrics': {
+                name: metric.snapshot()
+                for name, metric in self._metrics.items()
+            },
+            'gauges': self._collect_gauges()
+        }
+        path = self._path(os.getpid())
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)  # Atomically
+
+    def render(self) -> str:
+        """
+        Renders the metrics aggregated over all the worker processes, in
+        Prometheus text format.
+        The gauges of the processes which are gone are left out.
+        :return: str
+        """
+        self.flush()
+        totals = {name: {} for name in self._metrics}
+        gauges = {}
+        for path in glob.glob(os.path.join(self._dir, '*.json')):
+            pid = int(os.path.basename(path)[:-len('.json')])
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):  # Removed, or being replaced
+                continue
+            for name, samples in snapshot['metrics'].items():
+                if name in totals:
+                    _merge(totals[name], samples)
+            if _is_alive(pid):
+                for name, value in snapshot['gauges'].items():
+                    if name.endswith('_max'):
+                        gauges[name] = max(gauges.get(name, value), value)
+                    else:
+                        gauges[name] = gauges.get(name, 0) + value
+
+        lines = []
+        for name, metric in self._metrics.items():
+            full_name = f'{self.namespace}_{name}'
+            lines.append(f'# HELP {full_name} {metric.documentation}')
+            lines.append(f'# TYPE {full_name} {metric.TYPE}')
+            for labelvalues, value in sorted(totals[name].items()):
+                labels = list(zip(metric.labelnames, labelvalues))
+                if metric.TYPE == Counter.TYPE:
+                    lines.append(_sample(full_name, labels, value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ('+Inf',), value):
+                    cumulative += count
+                    lines.append(_sample(
+                        f'{full_name}_bucket',
+                        labels + [('le', _format_bound(bound))], cumulative
+                    ))
+                lines.append(_sample(f'{full_name}_sum', labels, value[-1]))
+                lines.append(_sample(f'{full_name}_count', labels, cumulative))
+        for name, value in sorted(gauges.items()):
+            full_name = f'{self.namespace}_{name}'
+            lines.append(f'# TYPE {full_name} gauge')
+            lines.append(_sample(full_name, [], value))
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        """
+        Private helper method to register the given metric, unless a metric of
+        the same type is already registered with its name.
+        :param metric: Counter or Histogram
+        :return: Counter or Histogram
+        """
+        registered = self._metrics.setdefault(metric.name, metric)
+        assert registered.TYPE == metric.TYPE, 'Conflicting metric types'
+        return registered
+
+    def _collect_gauges(self) -> dict:
+        """
+        Private helper method to collect the statistics of the registered
+        components, as flat gauges.
+        :return: dict
+        """
+        gauges = {}
+        for name, stats in list(self._collectors.items()):
+            try:
+                _flatten(gauges, name, stats())
+            except Exception:  # A broken component must not break the metrics
+                continue
+        return gauges
+
+    def _start_request(self) -> None:
+        """
+        Private helper method to start measuring the current request.
+        :return: None
+        """
+        if self._flusher_pid != os.getpid():
+            self._start_flusher()
+        g._metrics_started_at = time.perf_counter()
+
+    def _end_request(self, response):
+        """
+        Private helper method to record the measurements of the current request.
+        :param response:
+        :return:
+        """
+        # Resolve the context locals once, since this runs on every request
+        app_globals = g._get_current_object()
+        started_at = app_globals.pop('_metrics_started_at', None)
+        if started_at is None:
+            return response
+        duration = time.perf_counter() - started_at
+        current_request = request._get_current_object()
+        endpoint = current_request.endpoint or 'unmatched'
+        method = current_request.method
+        self.request_duration.observe(duration, endpoint, method)
+        self.requests.inc(endpoint, method, str(response.status_code))
+        statements, seconds = app_globals.pop('_metrics_sql', (0, 0.0))
+        self.request_sql_statements.observe(statements, endpoint)
+        self.request_sql_duration.observe(seconds, endpoint)
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany) -> None:
+        """
+        Private helper method to start measuring a SQL statement.
+        :return: None
+        """
+        conn.info.setdefault('_metrics_started_at', []).append(
+            time.perf_counter()
+        )
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany) -> None:
+        """
+        Private helper method to record the duration of a SQL statement, for
+        the current request as well.
+        The listeners are global, so only the statements of this application
+        are recorded, in case several applications run in the same process.
+        :return: None
+        """
+        elapsed = time.perf_counter() - conn.info['_metrics_started_at'].pop()
+        if not (has_app_context() and
+                current_app.extensions.get('metrics') is self):
+            return
+        self.sql_duration.observe(elapsed)
+        if has_request_context():
+            statements, seconds = g.get('_metrics_sql', (0, 0.0))
+            g._metrics_sql = (statements + 1, seconds + elapsed)
+
+    def _metrics_view(self):
+        """
+        Private helper method to serve the aggregated metrics.
+        :return:
+        """
+        return Response(self.render(), content_type=PROMETHEUS_MIMETYPE)
+
+    def _start_flusher(self) -> None:
+        """
+        Private helper method to start flushing the metrics of the current
+        process periodically, and when it exits.
+        Threads don't survive forking, so the flusher is lazily started in each
+        worker process. Under gevent, the thread is a greenlet.
+        :return: None
+        """
+        self._flusher_pid = os.getpid()
+
+        def flush_periodically() -> None:
+            while True:
+                time.sleep(self._flush_interval)
+                self.flush()
+
+        threading.Thread(target=flush_periodically, daemon=True).start()
+        atexit.register(self.flush)
+
+    def _remove_dead_files(self) -> None:
+        """
+        Private helper method to remove the files of the processes which are
+        gone, so that they don't pile up over restarts.
+        :return: None
+        """
+        for path in glob.glob(os.path.join(self._dir, '*.json')):
+            pid = int(os.path.basename(path)[:-len('.json')])
+            if not _is_alive(pid):
+                try:
+                    os.remove(path)
+                except OSError:  # Removed concurrently
+                    pass
+
+    def _path(self, pid: int) -> str:
+        """
+        Private helper method to get the path of the given process's file.
+        :param pid: int
+        :return: str
+        """
+        return os.path.join(self._dir, f'{pid}.json')
+
+
+def _merge(totals: dict, samples: Iterable[list]) -> None:
+    """
+    Private helper function to add the given samples of a metric to the given
+    totals.
+    :param totals: dict
+    :param samples: iterable[list]
+    :return: None
+    """
+    for labelvalues, value in samples:
+        key = tuple(labelvalues)
+        total = totals.get(key)
+        if total is None:
+            totals[key] = value
+        elif isinstance(value, list):
+            totals[key] = [a + b for a, b in zip(total, value)]
+        else:
+            totals[key] = total + value
+
+
+def _flatten(gauges: dict, prefix: str, stats: dict) -> None:
+    """
+    Private helper function to flatten the numeric values of the given
+    (nested) statistics into the given gauges.
+    :param gauges: dict
+    :param prefix: str
+    :param stats: dict
+    :return: None
+    """
+    for key, value in stats.items():
+        name = f'{prefix}_{key}'
+        if isinstance(value, dict):
+            _flatten(gauges, name, value)
+        elif isinstance(value, (bool, int, float)) and not (
+                key.endswith('ratio') or key == 'utilization'):
+            gauges[name] = float(value)
+
+
+def _sample(name: str, labels: list, value: float) -> str:
+    """
+    Private helper function to format a sample in Prometheus text format.
+    :param name: str
+    :param labels: list[tuple(str, str)]
+    :param value: float
+    :return: str
+    """
+    if not labels:
+        return f'{name} {value}'
+    formatted = ','.join(
+        f'{label}="{_escape(str(labelvalue))}"'
+        for label, labelvalue in labels
+    )
+    return f'{name}{{{formatted}}} {value}'
+
+
+def _escape(value: str) -> str:
+    """
+    Private helper function to escape a label value.
+    :param value: str
+    :return: str
+    """
+    return (
+        value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+    )
+
+
+def _format_bound(bound) -> str:
+    """
+    Private helper function to format the upper bound of a bucket.
+    :param bound: float or str
+    :return: str
+    """
+    return bound if isinstance(bound, str) else repr(float(bound))
+
+
+def _is_alive(pid: int) -> bool:
+    """
+    Private helper function to check whether the given process is alive.
+    :param pid: int
+    :return: bool
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # Alive, but owned by another user
+        return True
+    return True
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+"""
+Database connection pooling module.
+"""
+
+import threading
+import time
+from typing import Optional
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+
+
+class _InstrumentedPoolMixin:
+    """
+    Mixin of a connection pool, which records how long the checkouts wait for
+    a connection (including the time to connect, if a new connection is
+    needed), how many of them time out, and how many connections are in use.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._counters = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'in_use': 0,
+            'in_use_max': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0
+        }
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self._record_checkout(time.perf_counter() - started_at, False)
+            raise
+        self._record_checkout(time.perf_counter() - started_at, True)
+        return connection
+
+    def _do_return_conn(self, conn) -> None:
+        with self._stats_lock:
+            self._counters['in_use'] -= 1
+        super()._do_return_conn(conn)
+
+    def stats(self) -> dict:
+        """
+        Returns the checkout statistics and the utilization of the pool.
+        :return: dict
+        """
+        with self._stats_lock:
+            stats = dict(self._counters)
+        capacity = self.capacity()
+        stats['capacity'] = capacity
+        stats['utilization'] = capacity and stats['in_use'] / capacity
+        return stats
+
+    def capacity(self) -> Optional[int]:
+        """
+        Returns the max number of connections of the pool, or None if it's
+        unbounded.
+        :return: int or None
+        """
+        return None
+
+    def _record_checkout(self, wait: float, succeeded: bool) -> None:
+        """
+        Private helper method to record a checkout, which waited for the given
+        time.
+        :param wait: float
+        :param succeeded: bool
+        :return: None
+        """
+        with self._stats_lock:
+            counters = self._counters
+            counters['wait_seconds_total'] += wait
+            counters['wait_seconds_max'] = max(
+                counters['wait_seconds_max'], wait
+            )
+            if succeeded:
+                counters['checkouts'] += 1
+                counters['in_use'] += 1
+                counters['in_use_max'] = max(
+                    counters['in_use_max'], counters['in_use']
+                )
+            else:
+                counters['timeouts'] += 1
+
+
+class InstrumentedQueuePool(_InstrumentedPoolMixin, QueuePool):
+    """
+    Pool of a bounded number of connections, which are kept open and reused.
+    """
+
+    def capacity(self) -> Optional[int]:
+        return self.size() + max(self._max_overflow, 0)
+
+
+class InstrumentedNullPool(_InstrumentedPoolMixin, NullPool):
+    """
+    "Pool" which opens a new connection for each checkout, for when the
+    connections are pooled by PgBouncer.
+    """
+
+
+def init_pooling(app: Flask) -> None:
+    """
+    Configures the database connections of the given application, before
+    Flask-SQLAlchemy is initialized with it.
+    * In gevent mode, psycopg2 waits for the database cooperatively, so that a
+      query only blocks its own greenlet rather than the whole worker.
+    * The PostgreSQL engines get a pool sized and timed out from the
+      configurations, or no pool of their own behind PgBouncer.
+    :param app: Flask
+    :return: None
+    """
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if not make_url(uri).drivername.startswith('postgres'):
+        return  # Keep Flask-SQLAlchemy's defaults (e.g., for SQLite)
+    if app.config['DB_GEVENT_MODE'] and _gevent_patched():
+        _make_psycopg2_green()
+
+    options = {
+        'pool_pre_ping': app.config['DB_POOL_PRE_PING'],
+        'pool_recycle': app.config['DB_POOL_RECYCLE']
+    }
+    if app.config['DB_PGBOUNCER']:
+        # PgBouncer in transaction pooling mode already pools the server
+        # connections, and hands a server connection to a client connection
+        # only for the duration of a transaction. Keeping client-side pooled
+        # connections on top of it would only hold PgBouncer's slots.
+        options['poolclass'] = InstrumentedNullPool
+    else:
+        options.update({
+            'poolclass': InstrumentedQueuePool,
+            'pool_size': app.config['DB_POOL_SIZE'],
+            'max_overflow': app.config['DB_MAX_OVERFLOW'],
+            'pool_timeout': app.config['DB_POOL_TIMEOUT']
+        })
+    # Explicitly configured engine options take precedence.
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def pool_stats(db: SQLAlchemy, app: Flask) -> dict:
+    """
+    Returns the statistics of the connection pools of the given application's
+    engines, by bind ("primary" for the default one).
+    Only the engines which are already created are reported.
+    :param db: SQLAlchemy
+    :param app: Flask
+    :return: dict
+    """
+    state = db.get_app(app).extensions['sqlalchemy']
+    stats = {}
+    for bind, connector in list(state.connectors.items()):
+        engine = connector._engine
+        if engine is not None and hasattr(engine.pool, 'stats'):
+            stats[bind or 'primary'] = engine.pool.stats()
+    return stats
+
+
+def _make_psycopg2_green() -> None:
+    """
+    Private helper function to make psycopg2 wait for the database through the
+    gevent event loop, rather than blocking in the C driver.
+    :return: None
+    """
+    from psycopg2 import extensions
+
+    if extensions.get_wait_callback() is None:
+        extensions.set_wait_callback(_gevent_wait_callback)
+
+
+def _gevent_wait_callback(conn, timeout: Optional[float]=None) -> None:
+    """
+    Private helper function to wait for the given psycopg2 connection to be
+    ready, while letting the other greenlets run.
+    :param conn:
+    :param timeout: float
+    :return: None
+    """
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import OperationalError, extensions
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise OperationalError(f'Bad result from poll: {state!r}')
+
+
+def _gevent_patched() -> bool:
+    """
+    Private helper function to check whether the standard library's sockets are
+    monkey-patched by gevent, i.e., whether the app runs in a gevent worker.
+    :return: bool
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
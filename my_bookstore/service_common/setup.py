@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+"""
+Setup module of the common modules shared by the services.
+"""
+
+from setuptools import setup
+
+setup(
+    name='service_common',
+    version='1.0.0',
+    description='Common modules shared by the services of my_bookstore',
+    packages=['service_common'],
+    python_requires='>=3.7',
+    # The versions are pinned in "requirements.txt".
+    install_requires=['flask', 'flask-sqlalchemy', 'sqlalchemy']
+)